@@ -18,17 +18,89 @@ def create_app():
     
     # Configuration
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
+    app.config['FAST_START'] = os.getenv('FAST_START', 'false').lower() == 'true'
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///whatsapp.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['UPLOAD_FOLDER'] = os.getenv('UPLOAD_FOLDER', 'static/uploads')
     app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 16777216))
+    app.config['MAX_UPLOAD_SIZE'] = int(os.getenv('MAX_UPLOAD_SIZE', 536870912))
+    app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 4194304))
+    app.config['MAX_PENDING_UPLOADS'] = int(os.getenv('MAX_PENDING_UPLOADS', 5))
+    app.config['UPLOAD_SESSION_TTL'] = int(os.getenv('UPLOAD_SESSION_TTL', 86400))
     app.config['GROQ_API_KEY'] = os.getenv('GROQ_API_KEY', '')
+    app.config['GROQ_BASE_URL'] = os.getenv('GROQ_BASE_URL', '')
+    app.config['AI_POOL_MAX_CONNECTIONS'] = int(os.getenv('AI_POOL_MAX_CONNECTIONS', 20))
+    app.config['AI_POOL_MAX_KEEPALIVE'] = int(os.getenv('AI_POOL_MAX_KEEPALIVE', 10))
+    app.config['AI_KEEPALIVE_EXPIRY'] = float(os.getenv('AI_KEEPALIVE_EXPIRY', 60))
+    app.config['AI_TIMEOUT'] = float(os.getenv('AI_TIMEOUT', 60))
+    app.config['AI_CONNECT_TIMEOUT'] = float(os.getenv('AI_CONNECT_TIMEOUT', 5))
+    app.config['AI_MAX_RETRIES'] = int(os.getenv('AI_MAX_RETRIES', 0))
+    app.config['AI_WORKERS'] = int(os.getenv('AI_WORKERS', 16))
+    app.config['AI_QUEUE_SIZE'] = int(os.getenv('AI_QUEUE_SIZE', 200))
+    app.config['AI_USER_QUEUE_LIMIT'] = int(os.getenv('AI_USER_QUEUE_LIMIT', 10))
+    app.config['AI_SYSTEM_QUEUE_LIMIT'] = int(os.getenv('AI_SYSTEM_QUEUE_LIMIT', 50))
+    app.config['AI_RETRY_ATTEMPTS'] = int(os.getenv('AI_RETRY_ATTEMPTS', 4))
+    app.config['AI_RETRY_BASE_DELAY'] = float(os.getenv('AI_RETRY_BASE_DELAY', 0.5))
+    app.config['AI_RETRY_MAX_DELAY'] = float(os.getenv('AI_RETRY_MAX_DELAY', 8))
+    app.config['AI_CONTEXT_TOKENS'] = int(os.getenv('AI_CONTEXT_TOKENS', 6000))
+    app.config['AI_REQUEST_TOKEN_BUDGET'] = int(os.getenv('AI_REQUEST_TOKEN_BUDGET', 60000))
+    app.config['AI_CONTEXT_WORKERS'] = int(os.getenv('AI_CONTEXT_WORKERS', 4))
+    app.config['AI_CACHE_ENABLED'] = os.getenv('AI_CACHE_ENABLED', 'true').lower() == 'true'
+    app.config['AI_CACHE_SIZE'] = int(os.getenv('AI_CACHE_SIZE', 10000))
+    app.config['AI_CACHE_TTL'] = int(os.getenv('AI_CACHE_TTL', 604800))
+    app.config['AI_CACHE_PATH'] = os.getenv('AI_CACHE_PATH', os.path.join(app.instance_path, 'ai_cache.db'))
+    app.config['MODERATION_WORDLISTS'] = os.getenv('MODERATION_WORDLISTS') or os.path.join(app.root_path, 'wordlists')
+    app.config['MODERATION_BATCH_SIZE'] = int(os.getenv('MODERATION_BATCH_SIZE', 16))
+    app.config['MODERATION_BATCH_WAIT'] = float(os.getenv('MODERATION_BATCH_WAIT', 0.05))
+    app.config['SENTIMENT_LEXICON'] = os.getenv('SENTIMENT_LEXICON') or os.path.join(app.root_path, 'wordlists', 'sentiment.txt')
+    app.config['SENTIMENT_CONFIDENCE_THRESHOLD'] = float(os.getenv('SENTIMENT_CONFIDENCE_THRESHOLD', 0.55))
+    app.config['SENTIMENT_BATCH_MAX'] = int(os.getenv('SENTIMENT_BATCH_MAX', 200))
+    app.config['AUTOCOMPLETE_HISTORY'] = int(os.getenv('AUTOCOMPLETE_HISTORY', 2000))
+    app.config['AUTOCOMPLETE_MAX_USERS'] = int(os.getenv('AUTOCOMPLETE_MAX_USERS', 1000))
+    app.config['AUTOCOMPLETE_AI'] = os.getenv('AUTOCOMPLETE_AI', 'true').lower() == 'true'
+    app.config['SMART_REPLIES_PRECOMPUTE'] = os.getenv('SMART_REPLIES_PRECOMPUTE', 'true').lower() == 'true'
+    app.config['TRANSCRIBE_ON_SEND'] = os.getenv('TRANSCRIBE_ON_SEND', 'true').lower() == 'true'
+    app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN', '')
+    app.config['QUERY_DEBUG'] = os.getenv('QUERY_DEBUG', '').lower()
+    app.config['QUERY_DEBUG_THRESHOLD'] = int(os.getenv('QUERY_DEBUG_THRESHOLD', 5))
+    app.config['PROFILING_TOKEN'] = os.getenv('PROFILING_TOKEN', '')
+    app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+    app.config['PROFILE_INTERVAL'] = float(os.getenv('PROFILE_INTERVAL', 0.005))
+    app.config['PROFILE_WINDOW_MAX'] = float(os.getenv('PROFILE_WINDOW_MAX', 300))
+    app.config['WATCHDOG'] = os.getenv('WATCHDOG', '').lower()
+    app.config['WATCHDOG_THRESHOLD'] = float(os.getenv('WATCHDOG_THRESHOLD', 0.1))
+    app.config['WATCHDOG_INTERVAL'] = float(os.getenv('WATCHDOG_INTERVAL', 0.02))
+    app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('PASSWORD_HASH_QUEUE', 32))
+    app.config['PASSWORD_HASH_TIMEOUT'] = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+    app.config['LOGIN_IP_LIMIT'] = int(os.getenv('LOGIN_IP_LIMIT', 20))
+    app.config['LOGIN_IP_WINDOW'] = int(os.getenv('LOGIN_IP_WINDOW', 60))
+    app.config['LOGIN_ACCOUNT_LIMIT'] = int(os.getenv('LOGIN_ACCOUNT_LIMIT', 5))
+    app.config['LOGIN_ACCOUNT_WINDOW'] = int(os.getenv('LOGIN_ACCOUNT_WINDOW', 900))
+    app.config['LOGIN_ACCOUNT_CEILING'] = int(os.getenv('LOGIN_ACCOUNT_CEILING', 100))
+    app.config['LOGIN_ACCOUNT_CEILING_WINDOW'] = int(os.getenv('LOGIN_ACCOUNT_CEILING_WINDOW', 3600))
+    app.config['REGISTER_IP_LIMIT'] = int(os.getenv('REGISTER_IP_LIMIT', 5))
+    app.config['REGISTER_IP_WINDOW'] = int(os.getenv('REGISTER_IP_WINDOW', 3600))
+    app.config['TRUSTED_PROXY_HOPS'] = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO').upper()
+    app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'json').lower()
+    app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    app.config['LOG_SAMPLE_RATES'] = os.getenv('LOG_SAMPLE_RATES', '')
+    app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))
+    app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'local')
+    app.config['S3_BUCKET'] = os.getenv('S3_BUCKET', '')
+    app.config['S3_ENDPOINT_URL'] = os.getenv('S3_ENDPOINT_URL', '')
+    app.config['S3_REGION'] = os.getenv('S3_REGION', '')
+    app.config['S3_ACCESS_KEY_ID'] = os.getenv('S3_ACCESS_KEY_ID', '')
+    app.config['S3_SECRET_ACCESS_KEY'] = os.getenv('S3_SECRET_ACCESS_KEY', '')
+    app.config['S3_PUBLIC_URL'] = os.getenv('S3_PUBLIC_URL', '')
+    app.config['PRESIGNED_URL_EXPIRES'] = int(os.getenv('PRESIGNED_URL_EXPIRES', 3600))
     
-    # Ensure upload folder exists
-    os.makedirs(os.path.join(app.root_path, app.config['UPLOAD_FOLDER']), exist_ok=True)
-    os.makedirs(os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], 'profiles'), exist_ok=True)
-    os.makedirs(os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], 'media'), exist_ok=True)
-    os.makedirs(os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], 'status'), exist_ok=True)
+    # Structured logging through a background queue, before anything logs
+    from app.logs import configure_logging
+    configure_logging(app)
     
     # Initialize extensions with app
     db.init_app(app)
@@ -36,6 +108,17 @@ def create_app():
     login_manager.login_view = 'auth.login'
     socketio.init_app(app)
     
+    # Client address and scheme from X-Forwarded-For/-Proto, as set by the
+    # TRUSTED_PROXY_HOPS reverse proxies in front of the app (rate limits are per client IP)
+    if app.config['TRUSTED_PROXY_HOPS']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        hops = app.config['TRUSTED_PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    
+    # Storage backend for uploaded files
+    from app.storage import create_storage
+    app.extensions['storage'] = create_storage(app)
+    
     # Import models
     from app import models
     
@@ -43,16 +126,56 @@ def create_app():
     from app import socket_events
     
     # Register blueprints
-    from app.routes import auth, main, chat, status, media, ai
+    from app.routes import auth, main, chat, status, media, ai, metrics as metrics_routes, profiling as profiling_routes
     app.register_blueprint(auth.bp)
     app.register_blueprint(main.bp)
     app.register_blueprint(chat.bp)
     app.register_blueprint(status.bp)
     app.register_blueprint(media.bp)
     app.register_blueprint(ai.bp)
+    app.register_blueprint(metrics_routes.bp)
+    app.register_blueprint(profiling_routes.bp)
+    
+    # Request, socket event and AI call metrics (after all handlers are registered)
+    from app import metrics
+    metrics.init_app(app, socketio)
+    
+    # N+1 query detection and query budgets in debug and test mode
+    from app import query_debug
+    query_debug.init_app(app, socketio)
+    
+    # On-demand request, socket event and worker profiles (off without PROFILING_TOKEN)
+    from app import profiling
+    profiling.init_app(app, socketio)
+    
+    # Report code that blocks the eventlet/gevent hub (no-op in threading mode)
+    from app import watchdog
+    watchdog.init_app(app, socketio)
+    
+    # Template helpers
+    from app.image_utils import derivative_url
+    from app.storage import profile_pic_url
+    app.add_template_filter(derivative_url)
+    app.add_template_filter(profile_pic_url)
+    
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the upload folders and database tables"""
+        setup_instance(app)
+    
+    # Schema and upload folders; with FAST_START (serverless, pre-fork workers)
+    # they are left to `flask --app run init-db` or the preloading master
+    if not app.config['FAST_START']:
+        setup_instance(app)
+    
+    return app
+
+def setup_instance(app):
+    """Create the upload folders and any missing database tables"""
+    # Ensure upload folder exists
+    for folder in ('', 'profiles', 'media', 'status', 'tmp', 'blobs'):
+        os.makedirs(os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], folder), exist_ok=True)
     
     # Create database tables
     with app.app_context():
         db.create_all()
-    
-    return app
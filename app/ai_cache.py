@@ -0,0 +1,241 @@
+"""
+AI Result Cache for ChatSphere
+Two-tier (in-memory LRU + SQLite) cache for deterministic AI helpers
+"""
+from flask import current_app, has_app_context
+from collections import OrderedDict
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Expired rows are purged from SQLite once every this many writes
+PURGE_INTERVAL = 1000
+
+_skip = threading.local()
+
+def skip_cache():
+    """Mark the result being computed on this thread as not cacheable
+    Called when an AI call fails, so fallbacks and error text are not cached."""
+    _skip.flag = True
+
+def normalize_text(text, casefold=False):
+    """Collapse whitespace (and optionally case) so trivial variants share an entry"""
+    text = re.sub(r'\s+', ' ', text or '').strip()
+    return text.casefold() if casefold else text
+
+def make_key(name, text, params, model):
+    """Cache key for one call: SHA-256 over function, text, parameters and model"""
+    payload = json.dumps([name, text, params, model], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class AICache:
+    """
+    In-memory LRU in front of a persistent SQLite table, both with TTL
+    The memory tier is per process; the SQLite tier is shared by every
+    worker on the host and survives restarts. Values are stored as JSON so
+    callers always get a fresh copy they can modify.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._local = threading.local()
+        self._settings = None
+        self._writes = 0
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._by_function = {}
+
+    def configure(self, config):
+        """Apply cache settings from the Flask config; returns False if disabled"""
+        if not config.get('AI_CACHE_ENABLED', True):
+            return False
+        settings = (
+            config.get('AI_CACHE_SIZE', 10000),
+            config.get('AI_CACHE_TTL', 604800),
+            config.get('AI_CACHE_PATH') or None
+        )
+        if settings != self._settings:
+            with self._lock:
+                if settings != self._settings:
+                    self._memory.clear()
+                    self._settings = settings
+        return True
+
+    def _connection(self):
+        path = self._settings[2]
+        if not path:
+            return None
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.path != path or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS ai_cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._local.conn = conn
+            self._local.path = path
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name, stat):
+        with self._lock:
+            self._stats[stat] += 1
+            if name is not None:
+                counts = self._by_function.setdefault(name, {'hits': 0, 'misses': 0})
+                counts['misses' if stat == 'misses' else 'hits'] += 1
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._memory[key] = (value, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._settings[0]:
+                self._memory.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def get(self, key, name=None, record_miss=True):
+        """
+        Look up a cached result
+        Args:
+            key: Key from make_key
+            name: Function name for per-function stats
+            record_miss: Count a miss (off for peeks that are retried later)
+        Returns:
+            Tuple of (found, value)
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                else:
+                    del self._memory[key]
+                    entry = None
+        if entry is not None:
+            self._count(name, 'memory_hits')
+            return True, json.loads(entry[0])
+
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT value, expires_at FROM ai_cache WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone() if conn else None
+        except sqlite3.Error as e:
+            logger.warning("AI cache read error: %s", e)
+            row = None
+        if row is not None:
+            self._remember(key, row[0], row[1])
+            self._count(name, 'disk_hits')
+            return True, json.loads(row[0])
+
+        if record_miss:
+            self._count(name, 'misses')
+        return False, None
+
+    def set(self, key, value):
+        """Store a JSON-serializable result in both tiers"""
+        encoded = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self._settings[1]
+        self._remember(key, encoded, expires_at)
+        with self._lock:
+            self._stats['stores'] += 1
+            self._writes += 1
+            purge = self._writes % PURGE_INTERVAL == 0
+        try:
+            conn = self._connection()
+            if conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO ai_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, encoded, expires_at)
+                )
+                if purge:
+                    conn.execute('DELETE FROM ai_cache WHERE expires_at <= ?', (time.time(),))
+        except sqlite3.Error as e:
+            logger.warning("AI cache write error: %s", e)
+
+    def clear(self):
+        """Drop every entry from both tiers"""
+        with self._lock:
+            self._memory.clear()
+        conn = self._connection() if self._settings else None
+        if conn:
+            conn.execute('DELETE FROM ai_cache')
+
+    def stats(self):
+        """Hit/miss counters as a dict"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['by_function'] = {name: dict(counts) for name, counts in self._by_function.items()}
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 3) if lookups else None
+        return stats
+
+ai_cache = AICache()
+
+def cached(name, model, casefold=False):
+    """
+    Decorator caching an AI helper whose first argument is the text
+    Args:
+        name: Function name used in the cache key and stats
+        model: Model the helper calls, so switching models misses the cache
+        casefold: Also ignore case when normalizing the text
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def cache_key(args, kwargs):
+            if not has_app_context() or not ai_cache.configure(current_app.config):
+                return None
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            text = normalize_text(params.pop('text'), casefold)
+            return make_key(name, text, params, model) if text else None
+
+        def cached_result(*args, **kwargs):
+            """Look up a call's result without computing it; returns (found, value)"""
+            key = cache_key(args, kwargs)
+            if key is None:
+                return False, None
+            return ai_cache.get(key, name, record_miss=False)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = cache_key(args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+
+            found, value = ai_cache.get(key, name)
+            if found:
+                return value
+
+            _skip.flag = False
+            value = func(*args, **kwargs)
+            if not _skip.flag:
+                ai_cache.set(key, value)
+            _skip.flag = False
+            return value
+
+        def store_result(value, *args, **kwargs):
+            """Cache a result computed elsewhere (e.g. by a batch call) for these arguments"""
+            key = cache_key(args, kwargs)
+            if key is not None:
+                ai_cache.set(key, value)
+
+        wrapper.cached_result = cached_result
+        wrapper.store_result = store_result
+        return wrapper
+    return decorator
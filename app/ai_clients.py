@@ -0,0 +1,217 @@
+"""
+AI Client Manager for ChatSphere
+Shares pooled keep-alive Groq clients across requests and worker threads
+"""
+from collections import deque
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+class ClientMetrics:
+    """Thread-safe counters for connection reuse and time-to-first-byte"""
+
+    def __init__(self, window=512):
+        self._lock = threading.Lock()
+        self._ttfb = deque(maxlen=window)
+        self.requests = 0
+        self.connections = 0
+        self.errors = 0
+        self.ttfb_total = 0.0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_ttfb(self, seconds):
+        with self._lock:
+            self._ttfb.append(seconds)
+            self.ttfb_total += seconds
+
+    def snapshot(self):
+        """Current metrics as a dict"""
+        with self._lock:
+            samples = sorted(self._ttfb)
+            requests = self.requests
+            connections = self.connections
+            errors = self.errors
+            ttfb_total = self.ttfb_total
+
+        def percentile(p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 1)
+
+        return {
+            'requests': requests,
+            'connections_opened': connections,
+            'connection_reuse_ratio': round(1 - connections / requests, 3) if requests else None,
+            'errors': errors,
+            'ttfb_avg_ms': round(ttfb_total / requests * 1000, 1) if requests else None,
+            'ttfb_p50_ms': percentile(0.5),
+            'ttfb_p95_ms': percentile(0.95),
+            'ttfb_max_ms': round(samples[-1] * 1000, 1) if samples else None
+        }
+
+class GroqClientManager:
+    """
+    Process-wide owner of the Groq clients
+    One sync client (safe to share between threads) and one async client per
+    event loop, each backed by an httpx connection pool with keep-alive.
+    Clients are rebuilt if the settings change or the process forks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._settings = None
+        self._pid = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._loop = None
+        self._loop_thread = None
+        self._loop_pid = None
+        self.metrics = ClientMetrics()
+
+    @staticmethod
+    def settings_from_config(config):
+        """Client settings read from the Flask config"""
+        api_key = config.get('GROQ_API_KEY')
+        if not api_key:
+            raise ValueError("GROQ_API_KEY not configured")
+        return (
+            api_key,
+            config.get('GROQ_BASE_URL') or None,
+            config.get('AI_POOL_MAX_CONNECTIONS', 20),
+            config.get('AI_POOL_MAX_KEEPALIVE', 10),
+            config.get('AI_KEEPALIVE_EXPIRY', 60.0),
+            config.get('AI_TIMEOUT', 60.0),
+            config.get('AI_CONNECT_TIMEOUT', 5.0),
+            config.get('AI_MAX_RETRIES', 2)
+        )
+
+    def _http_options(self, settings, is_async):
+        import httpx
+
+        _, _, max_connections, max_keepalive, keepalive_expiry, timeout, connect_timeout, _ = settings
+        metrics = self.metrics
+
+        # httpcore reports each new TCP connection through the trace extension
+        if is_async:
+            async def trace(event, info):
+                if event == 'connection.connect_tcp.complete':
+                    metrics.record_connection()
+
+            async def on_request(request):
+                metrics.record_request()
+                request.extensions['trace'] = trace
+                request.extensions['chatsphere_start'] = time.perf_counter()
+
+            async def on_response(response):
+                # Response hooks run once headers arrive, before the body is read
+                metrics.record_ttfb(time.perf_counter() - response.request.extensions['chatsphere_start'])
+                if response.status_code >= 400:
+                    metrics.record_error()
+        else:
+            def trace(event, info):
+                if event == 'connection.connect_tcp.complete':
+                    metrics.record_connection()
+
+            def on_request(request):
+                metrics.record_request()
+                request.extensions['trace'] = trace
+                request.extensions['chatsphere_start'] = time.perf_counter()
+
+            def on_response(response):
+                metrics.record_ttfb(time.perf_counter() - response.request.extensions['chatsphere_start'])
+                if response.status_code >= 400:
+                    metrics.record_error()
+
+        return {
+            'limits': httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=keepalive_expiry
+            ),
+            'timeout': httpx.Timeout(timeout, connect=connect_timeout),
+            'event_hooks': {'request': [on_request], 'response': [on_response]}
+        }
+
+    def get_client(self, config):
+        """Shared sync Groq client for the current settings"""
+        settings = self.settings_from_config(config)
+        client = self._client
+        if client is not None and self._settings == settings and self._pid == os.getpid():
+            return client
+
+        with self._lock:
+            if self._client is None or self._settings != settings or self._pid != os.getpid():
+                import httpx
+                from groq import Groq
+
+                api_key, base_url = settings[0], settings[1]
+                self._client = Groq(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=settings[7],
+                    http_client=httpx.Client(**self._http_options(settings, is_async=False))
+                )
+                self._settings = settings
+                self._pid = os.getpid()
+            return self._client
+
+    def get_async_client(self, config):
+        """Async Groq client for the running event loop"""
+        import httpx
+        from groq import AsyncGroq
+
+        settings = self.settings_from_config(config)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._async_clients.get(loop)
+            if entry is None or entry[0] != settings:
+                api_key, base_url = settings[0], settings[1]
+                client = AsyncGroq(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=settings[7],
+                    http_client=httpx.AsyncClient(**self._http_options(settings, is_async=True))
+                )
+                entry = (settings, client)
+                self._async_clients[loop] = entry
+            return entry[1]
+
+    def run_async(self, coro, timeout=None):
+        """
+        Run a coroutine on the manager's background event loop
+        The loop lives for the whole process, so its async client keeps its
+        connections alive between calls made from sync code.
+        """
+        with self._lock:
+            if self._loop is None or not self._loop_thread.is_alive() or self._loop_pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever, name='groq-async-loop', daemon=True
+                )
+                self._loop_thread.start()
+                self._loop_pid = os.getpid()
+            loop = self._loop
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    def close(self):
+        """Close the sync client and release its connections"""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._settings = None
+
+clients = GroqClientManager()
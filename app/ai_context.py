@@ -0,0 +1,175 @@
+"""
+AI Context Builder for ChatSphere
+Token estimates, bounded chunking, per-request token budgets and
+concurrent map-reduce for AI calls over long message histories
+"""
+from flask import current_app
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import threading
+
+# Rough tokens per character for Llama-style tokenizers; errs on the high side
+CHARS_PER_TOKEN = 3.5
+# Role and formatting overhead per chat message / transcript line
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+class BudgetExceeded(Exception):
+    """Raised when a call would exceed the request's token budget"""
+
+class TokenBudget:
+    """Tokens (prompt + completion) one request may spend across all its AI calls"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        return self.limit - self.used
+
+    def reserve(self, tokens):
+        """Claim tokens for a call, or raise BudgetExceeded"""
+        with self._lock:
+            if self.used + tokens > self.limit:
+                raise BudgetExceeded(f"Token budget of {self.limit} exhausted")
+            self.used += tokens
+
+def new_budget():
+    """Token budget for one request, from AI_REQUEST_TOKEN_BUDGET"""
+    return TokenBudget(current_app.config['AI_REQUEST_TOKEN_BUDGET'])
+
+def estimate_tokens(text):
+    """Estimate the token count of a text without a tokenizer"""
+    return int(len(text or '') / CHARS_PER_TOKEN) + 1
+
+def prompt_tokens(messages):
+    """Estimated tokens of a chat prompt (list of role/content dicts)"""
+    return sum(estimate_tokens(m['content']) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+def line_tokens(msg):
+    """Estimated tokens of one 'sender: content' transcript line"""
+    return estimate_tokens(msg['sender']) + estimate_tokens(msg['content']) + MESSAGE_OVERHEAD_TOKENS
+
+def truncate(text, max_tokens):
+    """Cut a text to roughly max_tokens, marking the cut"""
+    max_chars = int(max_tokens * CHARS_PER_TOKEN)
+    return text if len(text) <= max_chars else text[:max_chars] + " …"
+
+def chunk_messages(messages, max_tokens=None):
+    """
+    Split messages into consecutive chunks that each fit one prompt
+    Args:
+        messages: Message dicts with 'sender' and 'content'
+        max_tokens: Input tokens per chunk (defaults to AI_CONTEXT_TOKENS)
+    Returns:
+        List of message lists; an oversized single message is truncated
+    """
+    max_tokens = max_tokens or current_app.config['AI_CONTEXT_TOKENS']
+    chunks, current, size = [], [], 0
+    for msg in messages:
+        tokens = line_tokens(msg)
+        if tokens > max_tokens:
+            msg = dict(msg, content=truncate(msg['content'], max_tokens - MESSAGE_OVERHEAD_TOKENS * 4))
+            tokens = line_tokens(msg)
+        if current and size + tokens > max_tokens:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(msg)
+        size += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def fit_recent(messages, max_tokens=None):
+    """The most recent messages that fit in max_tokens, oldest first"""
+    max_tokens = max_tokens or current_app.config['AI_CONTEXT_TOKENS']
+    kept, size = [], 0
+    for msg in reversed(messages):
+        size += line_tokens(msg)
+        if size > max_tokens:
+            break
+        kept.append(msg)
+    return kept[::-1]
+
+def affordable(chunks, budget, cost, reserve=0):
+    """
+    Newest chunks whose calls fit in the budget, kept in their original order
+    Args:
+        chunks: Chunks in chronological order
+        budget: TokenBudget for the request
+        cost: Function giving the token cost of the call for one chunk
+        reserve: Tokens to leave for later (e.g. reduce) calls
+    """
+    available = budget.remaining - reserve
+    kept = []
+    for chunk in reversed(chunks):
+        available -= cost(chunk)
+        if available < 0:
+            break
+        kept.append(chunk)
+    return kept[::-1]
+
+def get_executor():
+    """Thread pool for concurrent chunk calls, created on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config['AI_CONTEXT_WORKERS'],
+                                           thread_name_prefix='ai-context')
+        return _executor
+
+def map_chunks(fn, chunks):
+    """
+    Call fn(chunk) for every chunk concurrently
+    Calls run in the app context and under the deadline of the calling job.
+    Returns:
+        List of results in chunk order
+    """
+    from app.ai_jobs import current_deadline, deadline_scope
+
+    if len(chunks) == 1:
+        return [fn(chunks[0])]
+
+    app = current_app._get_current_object()
+    deadline = current_deadline()
+
+    def run(chunk):
+        with app.app_context(), deadline_scope(deadline):
+            return fn(chunk)
+
+    return list(get_executor().map(run, chunks))
+
+def top_k(scored_lists, k):
+    """
+    Merge per-chunk (score, item) lists into the k best overall
+    Returns:
+        Items ordered by descending score
+    """
+    merged = heapq.nlargest(k, (entry for entries in scored_lists for entry in entries), key=lambda e: e[0])
+    return [item for _, item in merged]
+
+def reduce_texts(texts, combine, max_tokens=None):
+    """
+    Combine partial results until one remains
+    Groups of texts that fit one prompt are combined concurrently, level by
+    level, so any number of partial summaries reduces in O(log n) rounds.
+    Args:
+        texts: Partial results in order
+        combine: Function taking a list of texts and returning one text
+        max_tokens: Input tokens per combine call (defaults to AI_CONTEXT_TOKENS)
+    Returns:
+        Single combined text
+    """
+    max_tokens = max_tokens or current_app.config['AI_CONTEXT_TOKENS']
+    while len(texts) > 1:
+        parts = [{'sender': f"Part {i + 1}", 'content': text} for i, text in enumerate(texts)]
+        groups = chunk_messages(parts, max_tokens)
+        if len(groups) == len(parts) and len(groups) > 1:
+            # Each part fills a prompt on its own; pair them up to make progress
+            groups = [parts[i:i + 2] for i in range(0, len(parts), 2)]
+        texts = map_chunks(lambda group: combine([p['content'] for p in group]), groups)
+    return texts[0]
@@ -0,0 +1,358 @@
+"""
+AI Job Scheduler for ChatSphere
+Runs Groq calls on a bounded worker pool with priorities, per-feature
+concurrency caps, per-user fairness, deadlines and rate-limit-aware retry
+"""
+from flask import current_app, has_app_context
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+import heapq
+import itertools
+import math
+import os
+import random
+import threading
+import time
+
+# Feature -> (priority (lower runs first), max concurrent jobs, deadline seconds)
+FEATURES = {
+    'chat': (0, 8, 60),
+    'transcribe': (1, 2, 120),
+    'moderate': (1, 4, 15),
+    'translate': (2, 4, 20),
+    'enhance': (2, 4, 20),
+    'sentiment': (3, 4, 15),
+    'summarize': (3, 2, 90),
+    'search': (3, 2, 60),
+    'smart_replies': (4, 4, 10),
+    'autocomplete': (5, 4, 5)
+}
+
+class QueueFull(Exception):
+    """Raised when a job is rejected because the queue is at capacity"""
+
+    def __init__(self, message, status_code=503, retry_after=1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class DeadlineExceeded(Exception):
+    """Raised when a job does not finish before its deadline"""
+
+class AIUnavailable(Exception):
+    """Raised when the Groq API still fails once retries are used up"""
+
+    def __init__(self, message, status_code=503, retry_after=1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class Job:
+    """A queued call; its result is delivered through a Future"""
+
+    def __init__(self, feature, user_id, fn, args, kwargs, deadline, tag):
+        self.feature = feature
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = deadline
+        self.tag = tag
+        self.future = Future()
+        self.future.deadline = deadline
+
+_current = threading.local()
+
+def current_deadline():
+    """Deadline (time.monotonic) of the job running on this thread, or None"""
+    return getattr(_current, 'deadline', None)
+
+@contextmanager
+def deadline_scope(deadline):
+    """Apply a job's deadline to AI calls made on another thread"""
+    previous = current_deadline()
+    _current.deadline = deadline
+    try:
+        yield
+    finally:
+        _current.deadline = previous
+
+class AIScheduler:
+    """
+    Bounded queue of AI jobs served by a fixed set of worker threads
+    Each feature has its own heap. The next job is the one with the best
+    (priority, fairness tag) among features below their concurrency cap.
+    Fairness tags follow start-time fair queuing: a user's jobs are spaced
+    one virtual tick apart, so a burst from one user cannot starve others
+    of the same priority.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {feature: [] for feature in FEATURES}
+        self._running = {feature: 0 for feature in FEATURES}
+        self._pending_by_user = {}
+        self._user_tags = {}
+        self._vtime = 0
+        self._seq = itertools.count()
+        self._size = 0
+        self._app = None
+        self._pid = None
+        self._workers = []
+        self._stats = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0,
+            'expired': 0, 'cancelled': 0, 'retries': 0
+        }
+
+    def _ensure_workers(self, app):
+        # Called with the condition held
+        if self._pid == os.getpid() and self._workers:
+            return
+        self._app = app
+        self._pid = os.getpid()
+        self._workers = []
+        for i in range(app.config['AI_WORKERS']):
+            worker = threading.Thread(target=self._work, name=f'ai-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @staticmethod
+    def _limit_key(feature, user_id):
+        # Background jobs (no user) are limited per feature, not as one shared user
+        return (None, feature) if user_id is None else user_id
+
+    def count(self, stat):
+        with self._cond:
+            self._stats[stat] += 1
+
+    def submit(self, feature, fn, args=(), kwargs=None, user_id=None, deadline=None):
+        """
+        Queue a call without waiting for it
+        Args:
+            feature: Key of FEATURES, selects priority, cap and default deadline
+            fn: Callable run inside an app context on a worker thread
+            args, kwargs: Arguments for fn
+            user_id: Submitting user, for fairness and per-user limits; None
+                for background jobs, limited per feature by AI_SYSTEM_QUEUE_LIMIT
+            deadline: Seconds from now; defaults to the feature's deadline
+        Returns:
+            concurrent.futures.Future with the result
+        Raises:
+            QueueFull: 429 if the user has too many pending jobs, 503 if the
+                queue or the feature's background limit is full
+        """
+        app = current_app._get_current_object()
+        priority, _, default_deadline = FEATURES[feature]
+        deadline = time.monotonic() + (deadline or default_deadline)
+
+        with self._cond:
+            self._ensure_workers(app)
+            if self._size >= app.config['AI_QUEUE_SIZE']:
+                self._stats['rejected'] += 1
+                raise QueueFull("AI service is busy, please retry shortly", 503)
+            key = self._limit_key(feature, user_id)
+            if user_id is None:
+                if self._pending_by_user.get(key, 0) >= app.config['AI_SYSTEM_QUEUE_LIMIT']:
+                    self._stats['rejected'] += 1
+                    raise QueueFull(f"Too many background {feature} jobs queued", 503)
+            elif self._pending_by_user.get(key, 0) >= app.config['AI_USER_QUEUE_LIMIT']:
+                self._stats['rejected'] += 1
+                raise QueueFull("Too many AI requests in progress", 429)
+
+            tag = max(self._vtime, self._user_tags.get(user_id, 0)) + 1
+            self._user_tags[user_id] = tag
+            job = Job(feature, user_id, fn, args, kwargs or {}, deadline, tag)
+            heapq.heappush(self._queues[feature], (tag, next(self._seq), job))
+            self._size += 1
+            self._pending_by_user[key] = self._pending_by_user.get(key, 0) + 1
+            self._stats['submitted'] += 1
+            self._cond.notify()
+        return job.future
+
+    def _pop_next(self):
+        # Called with the condition held; returns a runnable job or None
+        best = None
+        for feature, queue in self._queues.items():
+            if queue and self._running[feature] < FEATURES[feature][1]:
+                key = (FEATURES[feature][0], queue[0][0], queue[0][1])
+                if best is None or key < best[0]:
+                    best = (key, feature)
+        if best is None:
+            return None
+
+        _, _, job = heapq.heappop(self._queues[best[1]])
+        self._size -= 1
+        key = self._limit_key(job.feature, job.user_id)
+        pending = self._pending_by_user[key] - 1
+        if pending:
+            self._pending_by_user[key] = pending
+        else:
+            del self._pending_by_user[key]
+        self._vtime = max(self._vtime, job.tag)
+        if not pending and self._user_tags.get(job.user_id, 0) <= self._vtime:
+            self._user_tags.pop(job.user_id, None)
+        return job
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                job = self._pop_next()
+                if job is None:
+                    self._cond.wait()
+                    continue
+                if not job.future.set_running_or_notify_cancel():
+                    # The waiter gave up while the job was queued
+                    self._stats['cancelled'] += 1
+                    continue
+                if time.monotonic() >= job.deadline:
+                    self._stats['expired'] += 1
+                    job.future.set_exception(DeadlineExceeded(f"{job.feature} job expired in queue"))
+                    continue
+                self._running[job.feature] += 1
+                return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            _current.deadline = job.deadline
+            try:
+                with self._app.app_context():
+                    result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                self.count('failed')
+                job.future.set_exception(e)
+            else:
+                self.count('completed')
+                job.future.set_result(result)
+            finally:
+                _current.deadline = None
+                with self._cond:
+                    self._running[job.feature] -= 1
+                    self._cond.notify()
+
+    def stats(self):
+        """Queue depth, running jobs and counters as a dict"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queued'] = self._size
+            stats['workers'] = len(self._workers)
+            stats['features'] = {
+                feature: {'queued': len(self._queues[feature]), 'running': self._running[feature]}
+                for feature in FEATURES
+                if self._queues[feature] or self._running[feature]
+            }
+        return stats
+
+scheduler = AIScheduler()
+
+def wait(future):
+    """Wait for a job's result until its deadline"""
+    try:
+        return future.result(timeout=max(0, future.deadline - time.monotonic()))
+    except FutureTimeoutError:
+        future.cancel()
+        raise DeadlineExceeded("AI request timed out")
+
+def run_job(feature, fn, *args, **kwargs):
+    """
+    Run an AI call on the scheduler from a request and wait for the result
+    Cached results are returned without queueing. The request's database
+    session is released before waiting so no connection is held during
+    the network call.
+    """
+    from flask_login import current_user
+    from app import db
+
+    cached_result = getattr(fn, 'cached_result', None)
+    if cached_result:
+        found, value = cached_result(*args, **kwargs)
+        if found:
+            return value
+
+    user_id = current_user.id if current_user.is_authenticated else None
+    future = scheduler.submit(feature, fn, args, kwargs, user_id=user_id)
+    db.session.close()
+    return wait(future)
+
+def submit_job(feature, fn, *args, user_id=None, **kwargs):
+    """Queue an AI call in the background; returns its Future"""
+    return scheduler.submit(feature, fn, args, kwargs, user_id=user_id)
+
+def _retry_after(error):
+    """Server-requested delay in seconds from a rate limit response, if any"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        if 'retry-after-ms' in response.headers:
+            return float(response.headers['retry-after-ms']) / 1000
+        if 'retry-after' in response.headers:
+            return float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+def retry_delay(attempt, error=None):
+    """Full-jitter exponential backoff, never shorter than Retry-After"""
+    config = current_app.config
+    cap = min(config['AI_RETRY_MAX_DELAY'], config['AI_RETRY_BASE_DELAY'] * 2 ** attempt)
+    return max(random.uniform(0, cap), _retry_after(error) or 0)
+
+def api_error(error, deadline=None):
+    """
+    Typed exception for a Groq API error that is not retried (again)
+    Returns:
+        DeadlineExceeded once the deadline has passed, else AIUnavailable:
+        429 for rate limits, 503 for connection and server errors, 502 for
+        other API errors; any other error is returned unchanged
+    """
+    from groq import APIConnectionError, APIError, InternalServerError, RateLimitError
+
+    if deadline is not None and time.monotonic() >= deadline:
+        return DeadlineExceeded("AI request deadline passed")
+    retry_after = math.ceil(_retry_after(error) or 1)
+    if isinstance(error, RateLimitError):
+        return AIUnavailable("AI rate limit reached, please retry shortly", 429, retry_after)
+    if isinstance(error, (APIConnectionError, InternalServerError)):
+        return AIUnavailable("AI service unavailable, please retry shortly", 503, retry_after)
+    if isinstance(error, APIError):
+        return AIUnavailable("AI service error", 502, retry_after)
+    return error
+
+def call_with_retry(call):
+    """
+    Call the Groq API, retrying rate limits and transient failures
+    Retries stop once the next attempt could not finish before the running
+    job's deadline, and each attempt's timeout is capped at the time left.
+    Args:
+        call: Callable taking optional request options (e.g. timeout=)
+    Returns:
+        Result of call
+    Raises:
+        AIUnavailable or DeadlineExceeded (see api_error) for API errors
+    """
+    from groq import APIConnectionError, APIError, InternalServerError, RateLimitError
+
+    attempts = current_app.config['AI_RETRY_ATTEMPTS'] if has_app_context() else 0
+    deadline = current_deadline()
+    attempt = 0
+    while True:
+        options = {}
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("AI request deadline passed")
+            options['timeout'] = remaining
+        try:
+            return call(**options)
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if attempt >= attempts:
+                raise api_error(e, deadline) from e
+            delay = retry_delay(attempt, e)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise api_error(e, deadline) from e
+        except APIError as e:
+            raise api_error(e, deadline) from e
+        scheduler.count('retries')
+        time.sleep(delay)
+        attempt += 1
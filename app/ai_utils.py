@@ -2,19 +2,44 @@
 AI Utilities for ChatSphere
 Handles all Groq API integrations for AI features
 """
-from groq import Groq
 from flask import current_app
+from app.ai_clients import clients
+from app.ai_cache import cached, skip_cache
+from app.ai_jobs import call_with_retry, api_error
+from app.metrics import timed_ai
+from app.ai_context import (
+    BudgetExceeded, new_budget, estimate_tokens, prompt_tokens, line_tokens,
+    chunk_messages, fit_recent, affordable, map_chunks, top_k, reduce_texts, truncate
+)
+import asyncio
 import json
+import logging
 import re
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+
+# Input tokens of conversation context for short-answer features
+SMART_REPLY_CONTEXT_TOKENS = 1500
+# Returned when the AI gives no usable suggestions; never cached
+SMART_REPLY_FALLBACK = ["Thanks!", "Got it!", "Sure thing!"]
+AUTOCOMPLETE_CONTEXT_TOKENS = 300
+
+# Errors from reading a model answer as JSON; only these fall back to a default
+# answer, API failures are raised (ai_jobs.AIUnavailable, DeadlineExceeded)
+PARSE_ERRORS = (ValueError, TypeError, KeyError, AttributeError)
+
 def get_groq_client():
-    """Initialize and return Groq client"""
-    api_key = current_app.config.get('GROQ_API_KEY')
-    if not api_key:
-        raise ValueError("GROQ_API_KEY not configured")
-    return Groq(api_key=api_key)
+    """Return the shared, connection-pooled Groq client"""
+    return clients.get_client(current_app.config)
+
+def get_async_groq_client():
+    """Return the async Groq client for the running event loop"""
+    return clients.get_async_client(current_app.config)
 
-def chat_with_ai(messages, model="llama-3.3-70b-versatile", temperature=0.7, max_tokens=1024):
+@timed_ai
+def chat_with_ai(messages, model=DEFAULT_MODEL, temperature=0.7, max_tokens=1024):
     """
     Send messages to Groq AI and get response
     Args:
@@ -24,19 +49,86 @@ def chat_with_ai(messages, model="llama-3.3-70b-versatile", temperature=0.7, max
         max_tokens: Max response length
     Returns:
         AI response text
+    Raises:
+        AIUnavailable: Rate limited or unreachable once retries are used up
+        DeadlineExceeded: The running job's deadline passed
     """
+    client = get_groq_client()
+    completion = call_with_retry(lambda **options: client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        **options
+    ))
+    return completion.choices[0].message.content
+
+@timed_ai
+async def achat_with_ai(messages, model=DEFAULT_MODEL, temperature=0.7, max_tokens=1024):
+    """
+    Async variant of chat_with_ai for running many completions concurrently
+    Must be awaited inside an app context (see chat_with_ai_many)
+    """
+    from groq import APIError
+
+    client = get_async_groq_client()
     try:
-        client = get_groq_client()
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
         )
-        return completion.choices[0].message.content
-    except Exception as e:
-        return f"Error: {str(e)}"
+    except APIError as e:
+        raise api_error(e) from e
+    return completion.choices[0].message.content
 
+def stream_chat_with_ai(messages, model=DEFAULT_MODEL, temperature=0.7, max_tokens=1024):
+    """
+    Stream a chat completion as it is generated
+    Args:
+        messages: List of message dicts with 'role' and 'content'
+        model: Groq model to use
+        temperature: Response randomness (0-2)
+        max_tokens: Max response length
+    Returns:
+        Generator of text deltas; API errors are raised to the caller
+    """
+    client = get_groq_client()
+    stream = call_with_retry(lambda **options: client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        **options
+    ))
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.response.close()
+
+@timed_ai
+def chat_with_ai_many(message_lists, **kwargs):
+    """
+    Run several chat completions concurrently over the shared async client
+    Args:
+        message_lists: List of message lists, one per completion
+        **kwargs: Passed to achat_with_ai (model, temperature, max_tokens)
+    Returns:
+        List of AI response texts in the same order
+    """
+    app = current_app._get_current_object()
+
+    async def run_all():
+        with app.app_context():
+            return await asyncio.gather(*[achat_with_ai(messages, **kwargs) for messages in message_lists])
+
+    return clients.run_async(run_all(), timeout=app.config['AI_TIMEOUT'] * 2)
+
+@timed_ai
 def generate_smart_replies(message_history, num_replies=3):
     """
     Generate smart reply suggestions based on conversation history
@@ -46,7 +138,7 @@ def generate_smart_replies(message_history, num_replies=3):
     Returns:
         List of suggested replies
     """
-    context = "\n".join([f"{msg['sender']}: {msg['content']}" for msg in message_history[-10:]])
+    context = "\n".join([f"{msg['sender']}: {msg['content']}" for msg in fit_recent(message_history[-10:], SMART_REPLY_CONTEXT_TOKENS)])
     
     prompt = f"""Based on this conversation, generate {num_replies} short, natural reply suggestions (max 10 words each).
 Return ONLY a JSON array of strings, nothing else.
@@ -68,11 +160,13 @@ Reply suggestions:"""
         if json_match:
             replies = json.loads(json_match.group())
             return replies[:num_replies]
-        return ["Thanks!", "Got it!", "Sure thing!"]
-    except Exception as e:
-        print(f"Smart reply error: {e}")
-        return ["Thanks!", "Got it!", "Sure thing!"]
+        return list(SMART_REPLY_FALLBACK)
+    except PARSE_ERRORS as e:
+        logger.warning("Smart reply error: %s", e)
+        return list(SMART_REPLY_FALLBACK)
 
+@cached('translate', DEFAULT_MODEL)
+@timed_ai
 def translate_message(text, target_language):
     """
     Translate message to target language
@@ -82,15 +176,14 @@ def translate_message(text, target_language):
     Returns:
         Translated text
     """
-    try:
-        messages = [
-            {"role": "system", "content": f"You are a translator. Translate the following text to {target_language}. Return ONLY the translation, nothing else."},
-            {"role": "user", "content": text}
-        ]
-        return chat_with_ai(messages, temperature=0.3, max_tokens=500)
-    except Exception as e:
-        return f"Translation error: {str(e)}"
+    messages = [
+        {"role": "system", "content": f"You are a translator. Translate the following text to {target_language}. Return ONLY the translation, nothing else."},
+        {"role": "user", "content": text}
+    ]
+    return chat_with_ai(messages, temperature=0.3, max_tokens=500)
 
+@cached('enhance', DEFAULT_MODEL)
+@timed_ai
 def enhance_message(text, tone="professional"):
     """
     Improve message with specified tone
@@ -110,36 +203,47 @@ def enhance_message(text, tone="professional"):
     
     instruction = tone_instructions.get(tone, tone_instructions["professional"])
     
-    try:
-        messages = [
-            {"role": "system", "content": f"{instruction} Return ONLY the improved message, nothing else."},
-            {"role": "user", "content": text}
-        ]
-        return chat_with_ai(messages, temperature=0.7, max_tokens=500)
-    except Exception as e:
-        return f"Enhancement error: {str(e)}"
+    messages = [
+        {"role": "system", "content": f"{instruction} Return ONLY the improved message, nothing else."},
+        {"role": "user", "content": text}
+    ]
+    return chat_with_ai(messages, temperature=0.7, max_tokens=500)
 
-def transcribe_audio(audio_file_path):
+@timed_ai
+def transcribe_audio(storage_key):
     """
-    Transcribe audio file using Groq Whisper
+    Transcribe a stored audio file using Groq Whisper
+    The file is streamed from storage into the upload, never read into
+    memory, and reopened for each retry.
     Args:
-        audio_file_path: Path to audio file
+        storage_key: Key of the audio file in the storage backend
     Returns:
         Transcription text
     """
-    try:
-        client = get_groq_client()
-        with open(audio_file_path, "rb") as file:
-            transcription = client.audio.transcriptions.create(
-                file=(audio_file_path, file.read()),
+    from app.storage import get_storage
+
+    storage = get_storage()
+    filename = storage_key.rsplit('/', 1)[-1]
+
+    def transcribe(**options):
+        with storage.open(storage_key) as audio:
+            return client.audio.transcriptions.create(
+                file=(filename, audio),
                 model="whisper-large-v3",
                 response_format="json",
-                language="en"
+                language="en",
+                **options
             )
+
+    try:
+        client = get_groq_client()
+        transcription = call_with_retry(transcribe)
         return transcription.text
     except Exception as e:
         return f"Transcription error: {str(e)}"
 
+@cached('moderate', DEFAULT_MODEL)
+@timed_ai
 def moderate_content(text):
     """
     Check if message content is appropriate
@@ -168,11 +272,65 @@ Return ONLY a JSON object with this exact format:
         if json_match:
             result = json.loads(json_match.group())
             return result
+        skip_cache()
         return {"is_safe": True, "reason": "", "filtered_text": text}
-    except Exception as e:
-        print(f"Moderation error: {e}")
+    except PARSE_ERRORS as e:
+        logger.warning("Moderation error: %s", e)
+        skip_cache()
         return {"is_safe": True, "reason": "", "filtered_text": text}
 
+@timed_ai
+def moderate_content_batch(texts):
+    """
+    Moderate several messages in one AI call
+    Args:
+        texts: List of messages to moderate
+    Returns:
+        List with a moderate_content style dict per message, or None where
+        the AI gave no usable verdict
+    """
+    numbered = "\n".join(f"[{i}] {json.dumps(text, ensure_ascii=False)}" for i, text in enumerate(texts))
+    try:
+        messages = [
+            {"role": "system", "content": """You are a content moderator. For each numbered message, decide if it contains:
+- Hate speech or discrimination
+- Explicit sexual content
+- Violence or threats
+- Spam or scams
+- Personal attacks
+
+Judge each message on its own; ordinary uses of words like "kill time" are safe.
+Return ONLY a JSON array with one object per message, in order:
+[{"id": 0, "is_safe": true/false, "reason": "brief reason or empty string"}]"""},
+            {"role": "user", "content": numbered}
+        ]
+        response = chat_with_ai(messages, temperature=0.1, max_tokens=60 + 40 * len(texts))
+        
+        verdicts = {}
+        json_match = re.search(r'\[.*\]', response, re.DOTALL)
+        if json_match:
+            for item in json.loads(json_match.group()):
+                if isinstance(item, dict) and isinstance(item.get('id'), int):
+                    verdicts[item['id']] = item
+        
+        results = []
+        for i, text in enumerate(texts):
+            item = verdicts.get(i)
+            if item is None or 'is_safe' not in item:
+                results.append(None)
+            else:
+                results.append({
+                    "is_safe": bool(item['is_safe']),
+                    "reason": item.get('reason') or "",
+                    "filtered_text": text
+                })
+        return results
+    except PARSE_ERRORS as e:
+        logger.warning("Batch moderation error: %s", e)
+        return [None] * len(texts)
+
+@cached('sentiment', DEFAULT_MODEL, casefold=True)
+@timed_ai
 def analyze_sentiment(text):
     """
     Analyze message sentiment
@@ -194,11 +352,56 @@ def analyze_sentiment(text):
         if json_match:
             result = json.loads(json_match.group())
             return result
+        skip_cache()
         return {"sentiment": "neutral", "confidence": 0.5, "emoji": "😐"}
-    except Exception as e:
-        print(f"Sentiment error: {e}")
+    except PARSE_ERRORS as e:
+        logger.warning("Sentiment error: %s", e)
+        skip_cache()
         return {"sentiment": "neutral", "confidence": 0.5, "emoji": "😐"}
 
+@timed_ai
+def analyze_sentiment_batch(texts):
+    """
+    Analyze the sentiment of several messages in one AI call
+    Args:
+        texts: List of messages
+    Returns:
+        List with an analyze_sentiment style dict per message, or None where
+        the AI gave no usable answer
+    """
+    numbered = "\n".join(f"[{i}] {json.dumps(text, ensure_ascii=False)}" for i, text in enumerate(texts))
+    try:
+        messages = [
+            {"role": "system", "content": """Analyze the sentiment of each numbered message. Return ONLY a JSON array with one object per message, in order:
+[{"id": 0, "sentiment": "positive/negative/neutral", "confidence": 0.0-1.0, "emoji": "appropriate emoji"}]"""},
+            {"role": "user", "content": numbered}
+        ]
+        response = chat_with_ai(messages, temperature=0.3, max_tokens=60 + 40 * len(texts))
+        
+        verdicts = {}
+        json_match = re.search(r'\[.*\]', response, re.DOTALL)
+        if json_match:
+            for item in json.loads(json_match.group()):
+                if isinstance(item, dict) and isinstance(item.get('id'), int):
+                    verdicts[item['id']] = item
+        
+        results = []
+        for i in range(len(texts)):
+            item = verdicts.get(i)
+            if item is None or item.get('sentiment') not in ('positive', 'negative', 'neutral'):
+                results.append(None)
+            else:
+                results.append({
+                    "sentiment": item['sentiment'],
+                    "confidence": item.get('confidence', 0.5),
+                    "emoji": item.get('emoji') or "😐"
+                })
+        return results
+    except PARSE_ERRORS as e:
+        logger.warning("Batch sentiment error: %s", e)
+        return [None] * len(texts)
+
+@timed_ai
 def summarize_conversation(messages, max_length=200):
     """
     Generate conversation summary
@@ -210,52 +413,172 @@ def summarize_conversation(messages, max_length=200):
     """
     conversation = "\n".join([f"{msg['sender']}: {msg['content']}" for msg in messages])
     
+    prompt_messages = [
+        {"role": "system", "content": f"Summarize this conversation in {max_length} words or less. Include key points and action items."},
+        {"role": "user", "content": conversation}
+    ]
+    return chat_with_ai(prompt_messages, temperature=0.5, max_tokens=500)
+
+# Completion tokens for summaries and the prompt around a summarized chunk
+SUMMARY_MAX_TOKENS = 500
+SUMMARY_PROMPT_TOKENS = 60
+
+def _format_transcript(messages):
+    return "\n".join([f"{msg['sender']}: {msg['content']}" for msg in messages])
+
+def _budgeted_chat(budget, messages, temperature, max_tokens):
+    """chat_with_ai that first claims its tokens from the request's budget"""
     try:
-        prompt_messages = [
-            {"role": "system", "content": f"Summarize this conversation in {max_length} words or less. Include key points and action items."},
-            {"role": "user", "content": conversation}
-        ]
-        return chat_with_ai(prompt_messages, temperature=0.5, max_tokens=500)
-    except Exception as e:
-        return f"Summary error: {str(e)}"
+        budget.reserve(prompt_tokens(messages) + max_tokens)
+    except BudgetExceeded as e:
+        skip_cache()
+        return f"Error: {str(e)}"
+    return chat_with_ai(messages, temperature=temperature, max_tokens=max_tokens)
+
+@timed_ai
+def summarize_long_conversation(messages, max_length=200, budget=None):
+    """
+    Summarize a conversation of any length
+    The transcript is split into chunks that fit the context window; chunks
+    are summarized concurrently, then the partial summaries are reduced the
+    same way until one remains. If the token budget cannot cover the whole
+    history, the most recent chunks are summarized.
+    Args:
+        messages: List of message dicts with 'sender' and 'content'
+        max_length: Max summary length in words
+        budget: TokenBudget shared with the rest of the request
+    Returns:
+        Summary text
+    """
+    budget = budget or new_budget()
+    chunks = chunk_messages(messages)
+    
+    def cost(chunk):
+        # The chunk's own call plus its partial summary being read again when reducing
+        return sum(line_tokens(m) for m in chunk) + SUMMARY_PROMPT_TOKENS + 2 * SUMMARY_MAX_TOKENS
+    
+    if len(chunks) == 1:
+        return summarize_conversation(messages, max_length)
+    
+    kept = affordable(chunks, budget, cost, reserve=SUMMARY_PROMPT_TOKENS + SUMMARY_MAX_TOKENS)
+    if not kept:
+        return "Error: Conversation is too long for the token budget"
+    
+    def summarize_chunk(chunk):
+        return _budgeted_chat(budget, [
+            {"role": "system", "content": f"Summarize this part of a longer conversation in {max_length} words or less. Keep names, decisions and action items."},
+            {"role": "user", "content": _format_transcript(chunk)}
+        ], temperature=0.5, max_tokens=SUMMARY_MAX_TOKENS)
+    
+    def combine(partials):
+        return _budgeted_chat(budget, [
+            {"role": "system", "content": f"These are summaries of consecutive parts of one conversation. Combine them into a single summary of {max_length} words or less. Include key points and action items."},
+            {"role": "user", "content": "\n\n".join(partials)}
+        ], temperature=0.5, max_tokens=SUMMARY_MAX_TOKENS)
+    
+    partials = map_chunks(summarize_chunk, kept)
+    failed = next((p for p in partials if p.startswith("Error:")), None)
+    if failed:
+        return failed
+    
+    summary = reduce_texts(partials, combine)
+    if len(kept) < len(chunks):
+        covered = sum(len(chunk) for chunk in kept)
+        summary = f"(Covers the most recent {covered} of {len(messages)} messages.)\n{summary}"
+    return summary
 
-def smart_search(query, messages):
+@timed_ai
+def fold_summary(previous_summary, messages, max_length=200):
+    """
+    Update a stored conversation summary with the messages that followed it
+    Args:
+        previous_summary: Summary so far ('' if none)
+        messages: New message dicts with 'sender' and 'content'
+        max_length: Max summary length in words
+    Returns:
+        Updated summary text
+    """
+    budget = new_budget()
+    if len(chunk_messages(messages)) > 1:
+        # Long backlog: condense it first so the update prompt stays small
+        new_part = summarize_long_conversation(messages, max_length, budget)
+        if new_part.startswith("Error:") or not previous_summary:
+            return new_part
+        new_part = f"(summary of {len(messages)} new messages)\n{new_part}"
+    elif not previous_summary:
+        return summarize_conversation(messages, max_length)
+    else:
+        new_part = _format_transcript(messages)
+    
+    prompt_messages = [
+        {"role": "system", "content": f"You maintain a running summary of a conversation. Update the summary with the new messages, keeping it to {max_length} words or less. Include key points and action items. Return ONLY the updated summary."},
+        {"role": "user", "content": f"Current summary:\n{previous_summary}\n\nNew messages:\n{new_part}"}
+    ]
+    return _budgeted_chat(budget, prompt_messages, temperature=0.5, max_tokens=SUMMARY_MAX_TOKENS)
+
+@timed_ai
+def smart_search(query, messages, limit=20):
     """
     Semantic search through messages
+    Long histories are searched in chunks concurrently and the best matches
+    of every chunk are merged by score.
     Args:
         query: Search query
         messages: List of message dicts to search
+        limit: Max number of results
     Returns:
-        List of relevant messages with scores
+        List of relevant messages, most relevant first
     """
-    conversation = "\n".join([f"[{i}] {msg['sender']}: {msg['content']}" for i, msg in enumerate(messages)])
+    budget = new_budget()
+    # Global indices in the sender field keep them stable across chunks
+    lines = [{'sender': f"[{i}] {msg['sender']}", 'content': msg['content'], 'index': i}
+             for i, msg in enumerate(messages)]
+    query_tokens = estimate_tokens(query) + 80
+    # About 15 tokens per {"i": ..., "score": ...} entry of the answer
+    max_tokens = 20 + 15 * limit
+    chunks = chunk_messages(lines, current_app.config['AI_CONTEXT_TOKENS'] - query_tokens)
+    kept = affordable(chunks, budget, lambda chunk: sum(line_tokens(m) for m in chunk) + query_tokens + max_tokens)
     
-    try:
+    def search_chunk(chunk):
         prompt_messages = [
-            {"role": "system", "content": """Find messages relevant to the query. Return ONLY a JSON array of message indices (numbers), ordered by relevance.
-Example: [5, 12, 3, 8]"""},
-            {"role": "user", "content": f"Query: {query}\n\nMessages:\n{conversation}"}
+            {"role": "system", "content": f"""Find messages relevant to the query. Return ONLY a JSON array of at most {limit} objects, ordered by relevance, with the message index and a relevance score from 0 to 1.
+Example: [{{"i": 5, "score": 0.9}}, {{"i": 12, "score": 0.6}}]"""},
+            {"role": "user", "content": f"Query: {query}\n\nMessages:\n{_format_transcript(chunk)}"}
         ]
-        response = chat_with_ai(prompt_messages, temperature=0.3, max_tokens=200)
-        
-        # Extract JSON array
+        response = _budgeted_chat(budget, prompt_messages, temperature=0.3, max_tokens=max_tokens)
+        valid = {m['index'] for m in chunk}
+        scored = []
         json_match = re.search(r'\[.*\]', response, re.DOTALL)
-        if json_match:
-            indices = json.loads(json_match.group())
-            return [messages[i] for i in indices if 0 <= i < len(messages)]
-        return []
-    except Exception as e:
-        print(f"Search error: {e}")
-        return []
+        if not json_match:
+            return scored
+        try:
+            items = json.loads(json_match.group())
+        except PARSE_ERRORS as e:
+            # One unparseable answer only drops the matches of its chunk
+            logger.warning("Search error: %s", e)
+            return scored
+        if isinstance(items, list):
+            for rank, item in enumerate(items):
+                # Plain index lists are accepted too, scored by rank
+                if isinstance(item, dict):
+                    index, score = item.get('i'), item.get('score', 0)
+                else:
+                    index, score = item, 1 - rank / (limit + 1)
+                if isinstance(index, int) and index in valid and isinstance(score, (int, float)):
+                    scored.append((score, index))
+        return scored
+    
+    indices = top_k(map_chunks(search_chunk, kept), limit)
+    return [messages[i] for i in indices]
 
-def get_ai_response(user_message, conversation_history=None):
+def build_ai_messages(user_message, conversation_history=None):
     """
-    Get AI assistant response for chat bot
+    Build the chat bot prompt from the user's message and recent history
     Args:
         user_message: User's message
         conversation_history: Previous messages for context
     Returns:
-        AI response
+        List of message dicts for the completion API
     """
     messages = [
         {"role": "system", "content": """You are ChatSphere AI, a helpful and friendly AI assistant integrated into a chat application. 
@@ -276,9 +599,32 @@ Be conversational, helpful, and concise. Use emojis occasionally to be friendly.
             messages.append({"role": role, "content": msg['content']})
     
     messages.append({"role": "user", "content": user_message})
-    
+    return messages
+
+
+@timed_ai
+def get_ai_response(user_message, conversation_history=None):
+    """
+    Get AI assistant response for chat bot
+    Args:
+        user_message: User's message
+        conversation_history: Previous messages for context
+    Returns:
+        AI response
+    """
+    messages = build_ai_messages(user_message, conversation_history)
     return chat_with_ai(messages, temperature=0.8, max_tokens=1000)
 
+def stream_ai_response(user_message, conversation_history=None):
+    """
+    Stream the chat bot response token by token
+    Returns:
+        Generator of text deltas (see stream_chat_with_ai)
+    """
+    messages = build_ai_messages(user_message, conversation_history)
+    return stream_chat_with_ai(messages, temperature=0.8, max_tokens=1000)
+
+@timed_ai
 def autocomplete_text(partial_text, context=""):
     """
     Generate text completion suggestions
@@ -291,7 +637,7 @@ def autocomplete_text(partial_text, context=""):
     try:
         messages = [
             {"role": "system", "content": "Complete the partial message naturally. Return ONLY a JSON array of 3 completion suggestions (complete sentences)."},
-            {"role": "user", "content": f"Context: {context}\n\nPartial message: {partial_text}\n\nCompletions:"}
+            {"role": "user", "content": f"Context: {truncate(context, AUTOCOMPLETE_CONTEXT_TOKENS)}\n\nPartial message: {partial_text}\n\nCompletions:"}
         ]
         response = chat_with_ai(messages, temperature=0.8, max_tokens=200)
         
@@ -300,6 +646,6 @@ def autocomplete_text(partial_text, context=""):
             completions = json.loads(json_match.group())
             return completions[:3]
         return []
-    except Exception as e:
-        print(f"Autocomplete error: {e}")
+    except PARSE_ERRORS as e:
+        logger.warning("Autocomplete error: %s", e)
         return []
@@ -0,0 +1,196 @@
+"""
+Local Autocomplete for ChatSphere
+Per-user n-gram model built from the user's own sent messages, answering
+completions in well under a millisecond; the AI only refines in the background
+"""
+from flask import current_app
+from collections import Counter, OrderedDict
+import bisect
+import re
+import threading
+
+WORD_RE = re.compile(r"[\w']+")
+END = '</s>'
+
+SUGGESTIONS = 3
+# Words appended after the current word when extending a suggestion
+MAX_EXTENSION = 4
+# A continuation must have been seen at least this often to be appended
+MIN_EXTENSION_COUNT = 2
+PREFIX_CACHE_SIZE = 256
+
+class CompletionModel:
+    """
+    Trigram model with backoff over one user's messages
+    The vocabulary is kept sorted so the words starting with a prefix are a
+    contiguous slice found by binary search. Results are cached by prefix
+    until the model learns a new message.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.unigrams = Counter()
+        self.bigrams = {}
+        self.trigrams = {}
+        self.vocabulary = []
+        self._completions = OrderedDict()
+        self._refinements = OrderedDict()
+
+    def learn(self, text):
+        """Add one sent message to the model"""
+        words = WORD_RE.findall((text or '').lower())
+        if not words:
+            return
+        with self._lock:
+            history = [None, None] + words + [END]
+            for i in range(2, len(history)):
+                word = history[i]
+                if word != END and word not in self.unigrams:
+                    bisect.insort(self.vocabulary, word)
+                self.unigrams[word] += 1
+                self.bigrams.setdefault(history[i - 1], Counter())[word] += 1
+                self.trigrams.setdefault((history[i - 2], history[i - 1]), Counter())[word] += 1
+            self._completions.clear()
+
+    def _candidates(self, previous, partial, limit):
+        """Words that can follow previous (the last two words) and start with partial, best first"""
+        # Back off from trigram to bigram counts, then (only to finish a word
+        # being typed) to every known word with that prefix
+        ranked = []
+        for counts in (self.trigrams.get(tuple(previous)), self.bigrams.get(previous[1])):
+            if counts:
+                ranked += [w for w, _ in counts.most_common() if w != END and w.startswith(partial)]
+        if partial:
+            start = bisect.bisect_left(self.vocabulary, partial)
+            end = bisect.bisect_left(self.vocabulary, partial + '\uffff')
+            ranked += sorted(self.vocabulary[start:end], key=self.unigrams.__getitem__, reverse=True)
+        return list(dict.fromkeys(ranked))[:limit]
+
+    def _extend(self, previous):
+        """Most likely continuation of previous, stopping at uncommon words"""
+        words = []
+        for _ in range(MAX_EXTENSION):
+            counts = self.trigrams.get(tuple(previous)) or self.bigrams.get(previous[1])
+            if not counts:
+                break
+            word, count = counts.most_common(1)[0]
+            if word == END or count < MIN_EXTENSION_COUNT:
+                break
+            words.append(word)
+            previous = [previous[1], word]
+        return words
+
+    def complete(self, text, limit=SUGGESTIONS):
+        """
+        Suggest completions for a partially typed message
+        Args:
+            text: Text typed so far
+            limit: Maximum number of suggestions
+        Returns:
+            List of full message suggestions (text plus completion)
+        """
+        key = text.lower()
+        with self._lock:
+            cached = self._completions.get(key)
+            if cached is not None:
+                self._completions.move_to_end(key)
+                return list(cached)
+
+            words = WORD_RE.findall(key)
+            partial = words.pop() if words and WORD_RE.match(text[-1:]) else ''
+            previous = ([None, None] + words)[-2:]
+
+            suggestions = []
+            for word in self._candidates(previous, partial, limit):
+                tail = [word[len(partial):]] + self._extend([previous[1], word])
+                suggestion = text + tail[0] + ''.join(' ' + w for w in tail[1:])
+                if suggestion.strip() != text.strip():
+                    suggestions.append(suggestion)
+
+            self._completions[key] = suggestions
+            if len(self._completions) > PREFIX_CACHE_SIZE:
+                self._completions.popitem(last=False)
+            return list(suggestions)
+
+    def refinement(self, text):
+        """AI completions previously fetched for this text, or None"""
+        with self._lock:
+            return self._refinements.get(text.lower())
+
+    def store_refinement(self, text, completions):
+        with self._lock:
+            self._refinements[text.lower()] = list(completions)
+            if len(self._refinements) > PREFIX_CACHE_SIZE:
+                self._refinements.popitem(last=False)
+
+_models = OrderedDict()
+_models_lock = threading.Lock()
+
+def get_model(user_id):
+    """
+    Completion model for a user, built from their recent messages on first use
+    Models are kept for the AUTOCOMPLETE_MAX_USERS most recently active users.
+    """
+    from app.models import Message
+
+    with _models_lock:
+        model = _models.get(user_id)
+        if model is not None:
+            _models.move_to_end(user_id)
+            return model
+
+    model = CompletionModel()
+    rows = Message.query.with_entities(Message.content).filter(
+        Message.sender_id == user_id,
+        Message.message_type == 'text',
+        Message.content.isnot(None)
+    ).order_by(Message.id.desc()).limit(current_app.config['AUTOCOMPLETE_HISTORY']).all()
+    for (content,) in reversed(rows):
+        model.learn(content)
+
+    with _models_lock:
+        model = _models.setdefault(user_id, model)
+        while len(_models) > current_app.config['AUTOCOMPLETE_MAX_USERS']:
+            _models.popitem(last=False)
+    return model
+
+def learn_message(user_id, text):
+    """Update a user's model with a message they sent, if the model is loaded"""
+    with _models_lock:
+        model = _models.get(user_id)
+    if model is not None:
+        model.learn(text)
+
+def refine_completions(user_id, text, chat_type, chat_id, request_id):
+    """
+    AI job: fetch AI completions for text and push them to the user
+    Emits 'autocomplete' to the user's room with the AI suggestions.
+    """
+    from app import db, socketio
+    from app.models import Message
+    from app.ai_utils import autocomplete_text
+
+    context = ""
+    if chat_id:
+        if chat_type == 'user':
+            query = Message.query.filter(
+                db.or_(
+                    db.and_(Message.sender_id == user_id, Message.recipient_id == chat_id),
+                    db.and_(Message.sender_id == chat_id, Message.recipient_id == user_id)
+                )
+            )
+        else:
+            query = Message.query.filter_by(group_id=chat_id)
+        messages = query.order_by(Message.timestamp.desc()).limit(3).all()
+        context = " ".join([msg.content for msg in reversed(messages) if msg.message_type == 'text'])
+    db.session.close()
+
+    completions = autocomplete_text(text, context)
+    if completions:
+        get_model(user_id).store_refinement(text, completions)
+    socketio.emit('autocomplete', {
+        'request_id': request_id,
+        'text': text,
+        'completions': completions,
+        'source': 'ai'
+    }, room=f'user_{user_id}')
@@ -0,0 +1,184 @@
+"""
+Image Utilities for ChatSphere
+Generates image size variants and modern formats in a process pool
+"""
+from flask import current_app
+from app.storage import get_storage, fetch_to_tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Variant name -> (width, height, crop to fill)
+VARIANTS = {
+    'avatar': (200, 200, True),
+    'thumb': (320, 320, False),
+    'preview': (1280, 1280, False)
+}
+
+# Output formats per variant: file extension -> Pillow format and save options
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})
+}
+
+# Source extensions the pipeline processes; animated GIFs are served as-is
+PROCESSABLE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp'}
+
+_executor = None
+_remote_executor = None
+_executor_lock = threading.Lock()
+
+# Derivative jobs in flight, keyed by storage key
+_pending = set()
+_pending_lock = threading.Lock()
+
+def get_executor():
+    """Return the process pool used for image work, creating it on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'])
+        return _executor
+
+def get_remote_executor():
+    """Threads that move images between remote storage and the process pool"""
+    global _remote_executor
+    with _executor_lock:
+        if _remote_executor is None:
+            _remote_executor = ThreadPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'])
+        return _remote_executor
+
+def can_process(filename):
+    """Whether derivatives are generated for this file"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in PROCESSABLE_EXTENSIONS
+
+def derivative_name(name, variant, ext):
+    """Path or URL of a derivative next to its source, e.g. abc_thumb.webp"""
+    return f"{name.rsplit('.', 1)[0]}_{variant}.{ext}"
+
+def derivative_url(url, variant, ext='webp'):
+    """Template filter: derivative URL of a processable image, else the URL itself"""
+    if not url or not can_process(url):
+        return url
+    return derivative_name(url, variant, ext)
+
+def derivative_urls(url, variants):
+    """Map each variant to its URL in every output format"""
+    return {
+        variant: {ext: derivative_name(url, variant, ext) for ext in FORMATS}
+        for variant in variants
+    }
+
+def derivatives_exist(storage, key, variants):
+    """Whether every derivative of a stored image already exists"""
+    return all(
+        storage.exists(derivative_name(key, variant, ext))
+        for variant in variants for ext in FORMATS
+    )
+
+def _open_scaled(src_path, width, height):
+    """
+    Open an image already reduced close to the target size
+    Uses JPEG DCT scaling (draft) and integer reduce so large photos are
+    never fully decoded and resampled at full resolution.
+    """
+    from PIL import Image, ImageOps
+
+    img = Image.open(src_path)
+    if img.format == 'JPEG':
+        img.draft('RGB', (width, height))
+    img = ImageOps.exif_transpose(img)
+
+    factor = min(img.width // width, img.height // height)
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img
+
+def render_derivatives(src_path, variants):
+    """
+    Render derivatives of an image; runs inside a pool worker process
+    Args:
+        src_path: Source image path
+        variants: Variant names from VARIANTS
+    Returns:
+        List of written file paths
+    """
+    from PIL import Image, ImageOps
+
+    written = []
+    for variant in variants:
+        width, height, crop = VARIANTS[variant]
+        with _open_scaled(src_path, width, height) as img:
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+
+            if crop:
+                img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+            else:
+                img.thumbnail((width, height), Image.LANCZOS)
+
+            for ext, (fmt, options) in FORMATS.items():
+                out = img.convert('RGB') if fmt == 'JPEG' and img.mode != 'RGB' else img
+                dest_path = derivative_name(src_path, variant, ext)
+                tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+                out.save(tmp_path, fmt, **options)
+                os.replace(tmp_path, dest_path)
+                written.append(dest_path)
+    return written
+
+def _render_remote(storage, key, variants, executor):
+    """Download a remote image, render it in the pool and upload the results"""
+    src_path, _ = fetch_to_tempfile(storage, key, suffix='.' + key.rsplit('.', 1)[1])
+    try:
+        for path in executor.submit(render_derivatives, src_path, variants).result():
+            suffix = path[len(src_path.rsplit('.', 1)[0]):]
+            storage.save(key.rsplit('.', 1)[0] + suffix, path)
+    finally:
+        os.remove(src_path)
+
+def request_derivatives(key, variants, on_done=None):
+    """
+    Queue derivative generation without blocking the request
+    Args:
+        key: Storage key of the source image
+        variants: Variant names from VARIANTS
+        on_done: Optional callback(success) run when the job finishes
+    Returns:
+        True if derivatives are already available, False if queued
+    """
+    storage = get_storage()
+    if derivatives_exist(storage, key, variants):
+        return True
+
+    with _pending_lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+
+    def done(future):
+        with _pending_lock:
+            _pending.discard(key)
+        error = future.exception()
+        if error:
+            logger.error("Image derivative error for %s: %s", key, error)
+        if on_done:
+            try:
+                on_done(error is None)
+            except Exception:
+                logger.exception("Image derivative callback error")
+
+    try:
+        src_path = storage.local_path(key)
+        if src_path:
+            future = get_executor().submit(render_derivatives, src_path, list(variants))
+        else:
+            future = get_remote_executor().submit(_render_remote, storage, key, list(variants), get_executor())
+    except Exception:
+        with _pending_lock:
+            _pending.discard(key)
+        raise
+    future.add_done_callback(done)
+    return False
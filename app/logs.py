@@ -0,0 +1,148 @@
+"""
+Logging for ChatSphere
+Structured, non-blocking logging for the app's 'app.*' loggers.
+
+Records are put on a bounded queue and written by a background thread, so a
+slow stdout never holds up a request or a Socket.IO fanout; when the queue
+is full new records are dropped and counted instead of blocking. Output is
+one JSON object per line (LOG_FORMAT=json) or plain text.
+
+Structured fields go in `extra`; an 'event' field also selects a sampling
+rate from LOG_SAMPLE_RATES (e.g. "socket.send_message=0.01,socket.typing=0").
+Warnings and errors are never sampled out.
+
+    logger = logging.getLogger(__name__)
+    logger.info("Message sent", extra={'event': 'socket.send_message', 'message_id': 42})
+"""
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# Attributes every LogRecord has; anything else came from `extra`
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record with the extra fields at the top level"""
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Plain text with the extra fields appended as key=value"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        fields = ' '.join(f"{key}={value}" for key, value in vars(record).items()
+                          if key not in STANDARD_ATTRIBUTES and not key.startswith('_'))
+        if fields:
+            first, _, rest = text.partition('\n')
+            text = f"{first} [{fields}]" + (f"\n{rest}" if rest else '')
+        return text
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of each sampled event below WARNING"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None))
+        return rate is None or (rate > 0 and (rate >= 1 or random.random() < rate))
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks the caller
+    Formatting happens on the listener thread; a full queue drops the record.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._pid = os.getpid()
+        self.listener = None
+
+    def prepare(self, record):
+        # Merge the arguments now (they may be mutated later) but leave the
+        # formatting, including tracebacks, to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            # Forked worker: the listener thread did not survive the fork
+            self._pid = os.getpid()
+            if self.listener:
+                self.listener = QueueListener(self.queue, *self.listener.handlers, respect_handler_level=False)
+                self.listener.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def parse_sample_rates(value):
+    """'socket.send_message=0.01,socket.typing=0' -> {'socket.send_message': 0.01, ...}"""
+    rates = {}
+    for part in (value or '').split(','):
+        name, _, rate = part.partition('=')
+        if name.strip() and rate.strip():
+            try:
+                rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
+
+_lock = threading.Lock()
+_handler = None
+
+def configure_logging(app):
+    """Route the 'app' loggers through the background queue; safe to call again"""
+    global _handler
+
+    logger = logging.getLogger('app')
+    logger.setLevel(app.config['LOG_LEVEL'])
+    logger.propagate = False
+
+    with _lock:
+        if _handler is None:
+            _handler = NonBlockingQueueHandler(queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE']))
+            output = logging.StreamHandler(sys.stdout)
+            _handler.listener = QueueListener(_handler.queue, output, respect_handler_level=False)
+            _handler.listener.start()
+            atexit.register(_handler.listener.stop)
+            logger.addHandler(_handler)
+        output = _handler.listener.handlers[0]
+        output.setFormatter(JsonFormatter() if app.config['LOG_FORMAT'] == 'json' else TextFormatter())
+        for old in list(_handler.filters):
+            _handler.removeFilter(old)
+        _handler.addFilter(SamplingFilter(parse_sample_rates(app.config['LOG_SAMPLE_RATES'])))
+    return _handler
+
+def dropped_records():
+    """Records dropped because the queue was full"""
+    return _handler.dropped if _handler else 0
@@ -0,0 +1,227 @@
+"""
+Media Store for ChatSphere
+Content-addressed blob storage with reference counting
+"""
+from flask import current_app
+from app import db
+from app.models import MediaBlob, Message, Status, UploadSession
+from app.storage import get_storage
+from app.upload_utils import STREAM_BUFFER_SIZE, get_tmp_folder, get_part_path, new_upload_id, discard_upload
+from app.image_utils import FORMATS, VARIANTS, derivative_name
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+import hashlib
+import os
+
+def blob_key(sha256, ext):
+    """Sharded storage key for a blob, e.g. blobs/ab/cd/abcd...ef.png"""
+    return f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}"
+
+def blob_url(sha256, ext):
+    """Public URL of a blob"""
+    return get_storage().url(blob_key(sha256, ext))
+
+def blob_url_prefix():
+    """URL prefix shared by every blob"""
+    return get_storage().url('blobs/')
+
+def blob_digest_from_url(url):
+    """Extract the SHA-256 from a blob URL, or None for other URLs"""
+    key = get_storage().key_from_url(url)
+    if not key or not key.startswith('blobs/'):
+        return None
+    return key.rsplit('/', 1)[1].split('.', 1)[0]
+
+def _add_reference(sha256):
+    # Atomic increment so concurrent uploads of the same content don't lose counts
+    updated = MediaBlob.query.filter_by(sha256=sha256).update({
+        MediaBlob.ref_count: MediaBlob.ref_count + 1,
+        MediaBlob.last_referenced_at: datetime.utcnow()
+    })
+    db.session.commit()
+    return updated > 0
+
+def acquire(sha256):
+    """
+    Add a reference to existing content without re-uploading it
+    Args:
+        sha256: Hex digest of the content
+    Returns:
+        MediaBlob if the content is already stored, else None
+    """
+    sha256 = sha256.lower()
+    blob = MediaBlob.query.get(sha256)
+    if not blob or not get_storage().exists(blob_key(blob.sha256, blob.ext)):
+        return None
+    _add_reference(sha256)
+    return blob
+
+def store_file(src_path, ext, sha256):
+    """
+    Move a fully written file into the store and take a reference to it
+    Args:
+        src_path: Temporary file holding the content (consumed)
+        ext: File extension to serve the blob with
+        sha256: Hex digest of the content
+    Returns:
+        MediaBlob for the content
+    """
+    storage = get_storage()
+    blob = MediaBlob.query.get(sha256)
+    if blob and storage.exists(blob_key(blob.sha256, blob.ext)):
+        # Same content already stored; drop the duplicate bytes
+        os.remove(src_path)
+        _add_reference(sha256)
+        return blob
+
+    ext = blob.ext if blob else ext.lower()
+    size = os.path.getsize(src_path)
+    storage.save(blob_key(sha256, ext), src_path)
+
+    if blob:
+        # Row survived but the file was missing; the bytes are restored now
+        _add_reference(sha256)
+        return blob
+
+    return register_blob(sha256, ext, size)
+
+def register_blob(sha256, ext, size):
+    """
+    Record content that is already in storage and take a reference to it
+    Used directly when clients upload straight to storage.
+    """
+    blob = MediaBlob(sha256=sha256, ext=ext, size=size, ref_count=1)
+    db.session.add(blob)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request stored the same content first
+        db.session.rollback()
+        _add_reference(sha256)
+        blob = MediaBlob.query.get(sha256)
+    return blob
+
+def store_upload(file_storage, ext):
+    """
+    Stream an uploaded file into the store, hashing as it is written
+    Args:
+        file_storage: Werkzeug FileStorage from request.files
+        ext: File extension to serve the blob with
+    Returns:
+        MediaBlob for the content
+    """
+    os.makedirs(get_tmp_folder(), exist_ok=True)
+    tmp_path = os.path.join(get_tmp_folder(), f"{new_upload_id()}.blob")
+    hasher = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as out:
+            for buf in iter(lambda: file_storage.stream.read(STREAM_BUFFER_SIZE), b''):
+                hasher.update(buf)
+                out.write(buf)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return store_file(tmp_path, ext, hasher.hexdigest())
+
+def release(url):
+    """Drop one reference to a blob by URL; non-blob URLs are ignored"""
+    sha256 = blob_digest_from_url(url)
+    if not sha256:
+        return
+    MediaBlob.query.filter(MediaBlob.sha256 == sha256, MediaBlob.ref_count > 0).update({
+        MediaBlob.ref_count: MediaBlob.ref_count - 1
+    })
+
+def expire_uploads():
+    """
+    Delete unfinished upload sessions idle for longer than UPLOAD_SESSION_TTL
+    with their partial files, and any other file left in the tmp folder for
+    that long (partial files of lost sessions, interrupted .put and .blob
+    writes)
+    Returns:
+        Number of sessions deleted
+    """
+    idle_since = datetime.utcnow() - timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+    stale = db.session.query(UploadSession.id, UploadSession.updated_at).filter(
+        UploadSession.status != 'complete',
+        UploadSession.updated_at < idle_since
+    ).all()
+    expired = 0
+    for upload_id, updated_at in stale:
+        # Skipped if a chunk or /complete claimed the session since the query
+        deleted = UploadSession.query.filter(
+            UploadSession.id == upload_id,
+            UploadSession.status != 'complete',
+            UploadSession.updated_at == updated_at
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            discard_upload(upload_id)
+            expired += 1
+
+    folder = get_tmp_folder()
+    if os.path.isdir(folder):
+        live = {get_part_path(upload_id) for (upload_id,) in db.session.query(UploadSession.id).filter(
+            UploadSession.status != 'complete'
+        )}
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                if path not in live and os.path.isfile(path) and datetime.utcfromtimestamp(os.path.getmtime(path)) < idle_since:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+    return expired
+
+def collect_garbage(grace_period=timedelta(hours=24)):
+    """
+    Reconcile reference counts and delete unreferenced blobs
+    References are live messages, unexpired statuses and completed uploads.
+    Blobs referenced within the grace period are kept, since an upload is
+    sent as a message only after it completes. Stale pending uploads are
+    expired first (see expire_uploads).
+    Args:
+        grace_period: How long an unreferenced blob is kept
+    Returns:
+        Number of blobs deleted
+    """
+    expire_uploads()
+    storage = get_storage()
+    prefix = blob_url_prefix()
+    now = datetime.utcnow()
+    live_counts = {}
+
+    def count(urls):
+        for (url,) in urls:
+            sha256 = blob_digest_from_url(url)
+            if sha256:
+                live_counts[sha256] = live_counts.get(sha256, 0) + 1
+
+    count(db.session.query(Message.media_url).filter(
+        Message.media_url.like(prefix + '%'),
+        Message.is_deleted == False
+    ))
+    count(db.session.query(Status.media_url).filter(
+        Status.media_url.like(prefix + '%'),
+        Status.expires_at > now
+    ))
+    count(db.session.query(UploadSession.media_url).filter(
+        UploadSession.media_url.like(prefix + '%'),
+        UploadSession.updated_at > now - grace_period
+    ))
+
+    deleted = 0
+    for blob in MediaBlob.query.all():
+        blob.ref_count = live_counts.get(blob.sha256, 0)
+        if blob.ref_count == 0 and blob.last_referenced_at < now - grace_period:
+            key = blob_key(blob.sha256, blob.ext)
+            storage.delete(key)
+            # Rendered thumbnails and previews live next to the blob
+            for variant in VARIANTS:
+                for ext in FORMATS:
+                    storage.delete(derivative_name(key, variant, ext))
+            db.session.delete(blob)
+            deleted += 1
+    db.session.commit()
+    return deleted
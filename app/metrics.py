@@ -0,0 +1,298 @@
+"""
+Metrics for ChatSphere
+Records latency histograms, error counts and database query counts per Flask
+endpoint and per Socket.IO event, plus AI call latency per ai_utils function,
+and renders them in the Prometheus text format for /metrics.
+
+Recording is a few dictionary updates under one lock per observation; socket
+connection and room gauges are computed when /metrics is scraped, so the hot
+path never walks the room tables.
+"""
+from bisect import bisect_left
+import functools
+import inspect
+import threading
+import time
+
+# Latency buckets (seconds) shared by every histogram
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROOM_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# Name -> (type, help)
+FAMILIES = {
+    'chatsphere_http_request_duration_seconds': ('histogram', 'Flask request latency by endpoint'),
+    'chatsphere_http_requests_total': ('counter', 'Flask requests by endpoint, method and status'),
+    'chatsphere_http_request_errors_total': ('counter', 'Flask requests that raised or returned 5xx'),
+    'chatsphere_http_db_queries_total': ('counter', 'SQL statements run by Flask requests'),
+    'chatsphere_http_db_seconds_total': ('counter', 'Time spent in SQL statements by Flask requests'),
+    'chatsphere_socket_event_duration_seconds': ('histogram', 'Socket.IO handler latency by event'),
+    'chatsphere_socket_event_errors_total': ('counter', 'Socket.IO handlers that raised'),
+    'chatsphere_socket_db_queries_total': ('counter', 'SQL statements run by Socket.IO handlers'),
+    'chatsphere_socket_db_seconds_total': ('counter', 'Time spent in SQL statements by Socket.IO handlers'),
+    'chatsphere_ai_call_duration_seconds': ('histogram', 'AI helper latency by ai_utils function'),
+    'chatsphere_ai_call_errors_total': ('counter', 'AI helper calls that raised'),
+    'chatsphere_watchdog_stalls_total': ('counter', 'Times the event loop was blocked past the threshold, by code location'),
+    'chatsphere_watchdog_stall_seconds_total': ('counter', 'Time the event loop was blocked, by code location'),
+}
+
+class Registry:
+    """Thread-safe counters and histograms keyed by (name, labels)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect_left(BUCKETS, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, then +Inf, sum
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters), {key: list(value) for key, value in self._histograms.items()}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+registry = Registry()
+
+class _Scope(threading.local):
+    """Query counter of the request or socket event running on this thread"""
+    active = None
+    queries = 0
+    db_seconds = 0.0
+    started = 0.0
+
+_scope = _Scope()
+
+def _begin(kind):
+    _scope.active = kind
+    _scope.queries = 0
+    _scope.db_seconds = 0.0
+    _scope.started = time.perf_counter()
+
+def _end():
+    _scope.active = None
+    return time.perf_counter() - _scope.started, _scope.queries, _scope.db_seconds
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _scope.active:
+        conn.info['metrics_query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _scope.active:
+        _scope.queries += 1
+        _scope.db_seconds += time.perf_counter() - conn.info.pop('metrics_query_start', time.perf_counter())
+
+def timed_ai(func):
+    """Decorator recording the latency and errors of an AI helper"""
+    labels = (('function', func.__name__),)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                registry.inc('chatsphere_ai_call_errors_total', labels)
+                raise
+            finally:
+                registry.observe('chatsphere_ai_call_duration_seconds', labels, time.perf_counter() - started)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            registry.inc('chatsphere_ai_call_errors_total', labels)
+            raise
+        finally:
+            registry.observe('chatsphere_ai_call_duration_seconds', labels, time.perf_counter() - started)
+    return wrapper
+
+def _timed_event(event, handler):
+    labels = (('event', event),)
+
+    @functools.wraps(handler)
+    def wrapper(*args):
+        _begin('socket')
+        failed = False
+        try:
+            return handler(*args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed, queries, db_seconds = _end()
+            registry.observe('chatsphere_socket_event_duration_seconds', labels, elapsed)
+            if failed:
+                registry.inc('chatsphere_socket_event_errors_total', labels)
+            if queries:
+                registry.inc('chatsphere_socket_db_queries_total', labels, queries)
+                registry.inc('chatsphere_socket_db_seconds_total', labels, db_seconds)
+    wrapper.metrics_wrapped = True
+    return wrapper
+
+def instrument_socketio(socketio):
+    """Wrap every registered Socket.IO handler; call after the handlers are imported"""
+    for events in socketio.server.handlers.values():
+        for event, handler in list(events.items()):
+            if not getattr(handler, 'metrics_wrapped', False):
+                events[event] = _timed_event(event, handler)
+
+def init_app(app, socketio):
+    """Hook request timing, SQL counting and Socket.IO handler timing into the app"""
+    from flask import request, g
+    from sqlalchemy import event
+    from app import db
+
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    with app.app_context():
+        engine = db.engine
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_request_timer():
+        _begin('http')
+        g.metrics_status = 500
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request(exc):
+        # Socket.IO handlers run in a request context too; they are timed by _timed_event
+        if _scope.active != 'http':
+            return
+        elapsed, queries, db_seconds = _end()
+        endpoint = request.endpoint or 'unmatched'
+        status = 500 if exc is not None else g.get('metrics_status', 500)
+        registry.observe('chatsphere_http_request_duration_seconds', (('endpoint', endpoint),), elapsed)
+        registry.inc('chatsphere_http_requests_total',
+                     (('endpoint', endpoint), ('method', request.method), ('status', str(status))))
+        if status >= 500:
+            registry.inc('chatsphere_http_request_errors_total', (('endpoint', endpoint),))
+        if queries:
+            registry.inc('chatsphere_http_db_queries_total', (('endpoint', endpoint),), queries)
+            registry.inc('chatsphere_http_db_seconds_total', (('endpoint', endpoint),), db_seconds)
+
+    instrument_socketio(socketio)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+def _histogram_lines(name, labels, histogram, buckets):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, histogram):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(labels, [('le', _format(float(bound)))])} {cumulative}")
+    cumulative += histogram[len(buckets)]
+    lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {_format(histogram[-1])}")
+    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return lines
+
+def socket_gauges(socketio):
+    """Connected sockets and room counts and sizes from the Socket.IO manager"""
+    try:
+        rooms = dict(socketio.server.manager.rooms.get('/', {}))
+    except (AttributeError, RuntimeError):
+        return None
+    connected = len(rooms.get(None, {}))
+    kinds = {}
+    for name, members in rooms.items():
+        # Every sid also has a room of its own name
+        if name is None or name in members:
+            continue
+        kind = name.split('_', 1)[0] if name.startswith(('user_', 'group_')) else 'other'
+        kinds.setdefault(kind, []).append(len(members))
+    return connected, kinds
+
+def render(socketio=None):
+    """All metrics in the Prometheus text exposition format"""
+    from app.ai_jobs import scheduler
+    from app.ai_cache import ai_cache
+    from app.logs import dropped_records
+
+    counters, histograms = registry.snapshot()
+    lines = []
+    for name, (kind, help_text) in FAMILIES.items():
+        series = histograms if kind == 'histogram' else counters
+        keys = sorted(key for key in series if key[0] == name)
+        if not keys:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key in keys:
+            if kind == 'histogram':
+                lines.extend(_histogram_lines(name, key[1], series[key], BUCKETS))
+            else:
+                lines.append(f"{name}{_labels(key[1])} {_format(series[key])}")
+
+    gauges = socket_gauges(socketio) if socketio is not None and socketio.server else None
+    if gauges:
+        connected, kinds = gauges
+        lines += ['# HELP chatsphere_socket_connections Connected Socket.IO clients in this worker',
+                  '# TYPE chatsphere_socket_connections gauge',
+                  f"chatsphere_socket_connections {connected}",
+                  '# HELP chatsphere_socket_room_size Members per Socket.IO room by room kind',
+                  '# TYPE chatsphere_socket_room_size histogram']
+        for kind, sizes in sorted(kinds.items()):
+            histogram = [0] * (len(ROOM_SIZE_BUCKETS) + 1) + [float(sum(sizes))]
+            for size in sizes:
+                histogram[bisect_left(ROOM_SIZE_BUCKETS, size)] += 1
+            lines.extend(_histogram_lines('chatsphere_socket_room_size', [('kind', kind)], histogram, ROOM_SIZE_BUCKETS))
+
+    stats = scheduler.stats()
+    lines += ['# HELP chatsphere_ai_jobs_queued AI jobs waiting for a worker',
+              '# TYPE chatsphere_ai_jobs_queued gauge',
+              f"chatsphere_ai_jobs_queued {stats['queued']}",
+              '# HELP chatsphere_ai_jobs_total AI jobs by outcome',
+              '# TYPE chatsphere_ai_jobs_total counter']
+    for outcome in ('submitted', 'completed', 'failed', 'rejected', 'expired', 'cancelled', 'retries'):
+        lines.append(f"chatsphere_ai_jobs_total{_labels([('outcome', outcome)])} {stats[outcome]}")
+
+    cache = ai_cache.stats()
+    lines += ['# HELP chatsphere_ai_cache_lookups_total AI result cache lookups by result',
+              '# TYPE chatsphere_ai_cache_lookups_total counter']
+    for result in ('memory_hits', 'disk_hits', 'misses'):
+        lines.append(f"chatsphere_ai_cache_lookups_total{_labels([('result', result)])} {cache[result]}")
+    lines += ['# HELP chatsphere_log_records_dropped_total Log records dropped because the log queue was full',
+              '# TYPE chatsphere_log_records_dropped_total counter',
+              f"chatsphere_log_records_dropped_total {dropped_records()}"]
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,7 @@
 from datetime import datetime
 from app import db, login_manager
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from app.security import hash_password, verify_password
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -48,58 +48,75 @@ class User(UserMixin, db.Model):
                               lazy='dynamic')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
     
     def get_conversations(self):
         """Get all conversations (direct and group) for this user"""
-        from sqlalchemy import or_, and_
+        from sqlalchemy import or_, case, func
         
-        # Direct messages
-        direct_messages = Message.query.filter(
+        # Latest direct message per conversation partner, in one query
+        partner_column = case((Message.sender_id == self.id, Message.recipient_id), else_=Message.sender_id)
+        ranked = db.session.query(
+            Message.id.label('id'),
+            func.row_number().over(
+                partition_by=partner_column,
+                order_by=(Message.timestamp.desc(), Message.id.desc())
+            ).label('rank')
+        ).filter(
             or_(
                 Message.sender_id == self.id,
                 Message.recipient_id == self.id
             ),
             Message.group_id == None
-        ).order_by(Message.timestamp.desc()).all()
+        ).subquery()
+        last_messages = Message.query.filter(
+            Message.id.in_(db.session.query(ranked.c.id).filter(ranked.c.rank == 1))
+        ).all()
         
-        # Get unique conversation partners
-        conversation_partners = set()
-        for msg in direct_messages:
-            if msg.sender_id == self.id:
-                conversation_partners.add(msg.recipient_id)
-            else:
-                conversation_partners.add(msg.sender_id)
+        partner_ids = [msg.recipient_id if msg.sender_id == self.id else msg.sender_id for msg in last_messages]
+        partners = {user.id: user for user in User.query.filter(User.id.in_(partner_ids))} if partner_ids else {}
+        unread = dict(db.session.query(Message.sender_id, func.count(Message.id)).filter(
+            Message.sender_id.in_(partner_ids),
+            Message.recipient_id == self.id,
+            Message.is_read == False
+        ).group_by(Message.sender_id).all()) if partner_ids else {}
         
         conversations = []
-        for partner_id in conversation_partners:
-            partner = User.query.get(partner_id)
-            last_msg = Message.query.filter(
-                or_(
-                    and_(Message.sender_id == self.id, Message.recipient_id == partner_id),
-                    and_(Message.sender_id == partner_id, Message.recipient_id == self.id)
-                ),
-                Message.group_id == None
-            ).order_by(Message.timestamp.desc()).first()
-            
-            if last_msg:
-                conversations.append({
-                    'type': 'direct',
-                    'user': partner,
-                    'last_message': last_msg,
-                    'unread_count': Message.query.filter_by(
-                        sender_id=partner_id,
-                        recipient_id=self.id,
-                        is_read=False
-                    ).count()
-                })
+        for partner_id, last_msg in zip(partner_ids, last_messages):
+            conversations.append({
+                'type': 'direct',
+                'user': partners.get(partner_id),
+                'last_message': last_msg,
+                'unread_count': unread.get(partner_id, 0)
+            })
         
-        # Group messages
-        for group in self.groups:
-            last_msg = Message.query.filter_by(group_id=group.id).order_by(Message.timestamp.desc()).first()
+        # Group messages: latest message and unread count per group, one query each
+        groups = self.groups
+        group_ids = [group.id for group in groups]
+        group_last = {}
+        group_unread = {}
+        if group_ids:
+            ranked = db.session.query(
+                Message.id.label('id'),
+                func.row_number().over(
+                    partition_by=Message.group_id,
+                    order_by=(Message.timestamp.desc(), Message.id.desc())
+                ).label('rank')
+            ).filter(Message.group_id.in_(group_ids)).subquery()
+            group_last = {msg.group_id: msg for msg in Message.query.filter(
+                Message.id.in_(db.session.query(ranked.c.id).filter(ranked.c.rank == 1))
+            )}
+            group_unread = dict(db.session.query(Message.group_id, func.count(Message.id)).filter(
+                Message.group_id.in_(group_ids),
+                Message.sender_id != self.id,
+                Message.is_read == False
+            ).group_by(Message.group_id).all())
+        
+        for group in groups:
+            last_msg = group_last.get(group.id)
             conversations.append({
                 'type': 'group',
                 'group': group,
@@ -109,11 +126,7 @@ class User(UserMixin, db.Model):
                     'sender_id': None,
                     'message_type': 'text'
                 })(),
-                'unread_count': Message.query.filter(
-                    Message.group_id == group.id,
-                    Message.sender_id != self.id,
-                    Message.is_read == False
-                ).count() if last_msg else 0
+                'unread_count': group_unread.get(group.id, 0) if last_msg else 0
             })
         
         # Sort by last message time
@@ -191,3 +204,44 @@ class TypingStatus(db.Model):
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', foreign_keys=[user_id])
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(20), default='media')  # media, status
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, default=0)
+    sha256 = db.Column(db.String(64))
+    status = db.Column(db.String(20), default='pending')  # pending, complete
+    media_url = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MediaBlob(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)
+    ext = db.Column(db.String(10), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_referenced_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ConversationSummary(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_key = db.Column(db.String(64), unique=True, nullable=False)  # direct:<low id>:<high id> or group:<id>
+    summary = db.Column(db.Text, nullable=False, default='')
+    watermark_id = db.Column(db.Integer, default=0)  # Last message folded into the summary
+    message_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Transcript(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), unique=True, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, done, failed
+    text = db.Column(db.Text)
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    message = db.relationship('Message', backref=db.backref('transcript', uselist=False))
@@ -0,0 +1,274 @@
+"""
+Local Moderation for ChatSphere
+Decides clear cases with wordlists and spam heuristics in microseconds and
+escalates only ambiguous messages to the AI moderator, in batches
+"""
+from flask import current_app
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from collections import deque
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+ALLOW = 'allow'
+REVIEW = 'review'
+BLOCK = 'block'
+
+# Common letter substitutions undone before matching ("sh1t", "@ss")
+LEET = str.maketrans({'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's'})
+
+URL_RE = re.compile(r'(?:https?://|www\.)[^\s<>"]+|\b[a-z0-9-]+\.(?:com|net|org|io|ru|xyz|top|info|biz|ly|gl)\b[^\s<>"]*', re.I)
+SHORTENERS = {'bit.ly', 'tinyurl.com', 'goo.gl', 't.co', 'is.gd', 'ow.ly', 'cutt.ly', 'rb.gy', 'shorturl.at'}
+
+# Spam heuristics
+MAX_LINKS = 3
+MAX_REPEAT_RUN = 12
+MIN_TOKENS_FOR_REPETITION = 8
+MIN_UNIQUE_TOKEN_RATIO = 0.3
+
+class PatternMatcher:
+    """
+    Aho-Corasick automaton over a fixed set of terms
+    Finds every occurrence of every term in one pass over the text,
+    regardless of how many terms there are. Only whole-word matches count.
+    """
+
+    def __init__(self, terms):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for term in terms:
+            self._add(term)
+        self._build()
+
+    def _add(self, term):
+        node = 0
+        for char in term:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append(term)
+
+    def _build(self):
+        # Breadth-first, so each node's failure link is set before its children's;
+        # depth-1 nodes keep their failure link to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text):
+        """
+        Find whole-word occurrences of the terms
+        Args:
+            text: Normalized text to search
+        Returns:
+            List of (start, end, term) tuples
+        """
+        matches = []
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for term in out[node]:
+                start = i - len(term) + 1
+                end = i + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    matches.append((start, end, term))
+        return matches
+
+def normalize(text):
+    """Lowercase and undo letter substitutions, keeping offsets aligned with text"""
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        lowered = ''.join(c.lower() if len(c.lower()) == 1 else c for c in text)
+    return lowered.translate(LEET)
+
+def load_wordlist(path):
+    """Read one term per line, skipping blanks and # comments"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return [normalize(line.strip()) for line in f if line.strip() and not line.startswith('#')]
+    except OSError:
+        return []
+
+class ModerationEngine:
+    """Wordlist and heuristic checks for one set of wordlists"""
+
+    def __init__(self, folder):
+        self.block = PatternMatcher(load_wordlist(os.path.join(folder, 'block.txt')))
+        self.review = PatternMatcher(load_wordlist(os.path.join(folder, 'review.txt')))
+        self.spam = PatternMatcher(load_wordlist(os.path.join(folder, 'spam.txt')))
+
+    def check(self, text):
+        """
+        Classify a message locally
+        Args:
+            text: Message to check
+        Returns:
+            Tuple of (verdict, result) where verdict is ALLOW, BLOCK or REVIEW
+            and result has the moderate_content keys plus 'source'
+        """
+        normalized = normalize(text)
+
+        blocked = self.block.find(normalized)
+        if blocked:
+            filtered = list(text)
+            for start, end, _ in blocked:
+                filtered[start:end] = '*' * (end - start)
+            return BLOCK, _result(False, "Contains offensive language", ''.join(filtered))
+
+        spam_hits = len(self.spam.find(normalized))
+        links = URL_RE.findall(text)
+        if spam_hits >= 2 or len(links) > MAX_LINKS or (spam_hits and links):
+            return BLOCK, _result(False, "Looks like spam", text)
+
+        if spam_hits or self.review.find(normalized) or _suspicious(text, links):
+            return REVIEW, None
+        return ALLOW, _result(True, "", text)
+
+def _suspicious(text, links):
+    """Spam patterns that are worth a closer look but not enough to block"""
+    for link in links:
+        host = re.sub(r'^(?:https?://)?(?:www\.)?', '', link.lower()).split('/', 1)[0]
+        if host in SHORTENERS:
+            return True
+    if re.search(r'(.)\1{%d,}' % (MAX_REPEAT_RUN - 1), text):
+        return True
+    tokens = text.lower().split()
+    if len(tokens) >= MIN_TOKENS_FOR_REPETITION and len(set(tokens)) / len(tokens) < MIN_UNIQUE_TOKEN_RATIO:
+        return True
+    return False
+
+def _result(is_safe, reason, filtered_text, source='local'):
+    return {'is_safe': is_safe, 'reason': reason, 'filtered_text': filtered_text, 'source': source}
+
+_engine = None
+_engine_folder = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Moderation engine for the configured wordlists, built on first use"""
+    global _engine, _engine_folder
+    folder = current_app.config['MODERATION_WORDLISTS']
+    if _engine is None or _engine_folder != folder:
+        with _engine_lock:
+            if _engine is None or _engine_folder != folder:
+                _engine = ModerationEngine(folder)
+                _engine_folder = folder
+    return _engine
+
+class ModerationBatcher:
+    """
+    Collects ambiguous messages and judges them together in one AI call
+    A batch is sent when it is full or when its oldest message has waited
+    MODERATION_BATCH_WAIT seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def submit(self, text):
+        """Queue a message for AI moderation; returns a Future with its result"""
+        app = current_app._get_current_object()
+        future = Future()
+        with self._lock:
+            self._pending.append((text, future))
+            if len(self._pending) >= app.config['MODERATION_BATCH_SIZE']:
+                batch, self._pending = self._pending, []
+            else:
+                batch = None
+                if len(self._pending) == 1:
+                    timer = threading.Timer(app.config['MODERATION_BATCH_WAIT'], self._flush, args=(app,))
+                    timer.daemon = True
+                    timer.start()
+        if batch:
+            self._dispatch(app, batch)
+        return future
+
+    def _flush(self, app):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            self._dispatch(app, batch)
+
+    def _dispatch(self, app, batch):
+        from app.ai_jobs import submit_job
+
+        texts = [text for text, _ in batch]
+        with app.app_context():
+            try:
+                job = submit_job('moderate', _judge_batch, texts)
+            except Exception as e:
+                logger.warning("Moderation batch error: %s", e)
+                for text, future in batch:
+                    future.set_result(_result(True, "", text, 'fallback'))
+                return
+
+        def done(job):
+            results = job.result() if not job.exception() else [None] * len(batch)
+            if job.exception():
+                logger.warning("Moderation batch error: %s", job.exception())
+            for (text, future), result in zip(batch, results):
+                future.set_result(result or _result(True, "", text, 'fallback'))
+
+        job.add_done_callback(done)
+
+def _judge_batch(texts):
+    """AI job: moderate a batch of texts, caching each verdict"""
+    from app.ai_utils import moderate_content, moderate_content_batch
+
+    results = moderate_content_batch(texts)
+    for text, result in zip(texts, results):
+        if result is not None:
+            moderate_content.store_result(result, text)
+            result['source'] = 'ai'
+    return results
+
+batcher = ModerationBatcher()
+
+def moderate_message(text):
+    """
+    Moderate a message, deciding clear cases locally
+    Ambiguous messages are escalated to the AI moderator in batches; if the
+    AI cannot answer in time the message is allowed, as before.
+    Args:
+        text: Message to moderate
+    Returns:
+        Dict with 'is_safe', 'reason', 'filtered_text' and 'source'
+        (local, ai, cache or fallback)
+    """
+    from app.ai_jobs import FEATURES
+    from app.ai_utils import moderate_content
+
+    verdict, result = get_engine().check(text)
+    if verdict != REVIEW:
+        return result
+
+    found, value = moderate_content.cached_result(text)
+    if found:
+        value['source'] = 'cache'
+        return value
+
+    future = batcher.submit(text)
+    try:
+        return future.result(timeout=current_app.config['MODERATION_BATCH_WAIT'] + FEATURES['moderate'][2])
+    except FutureTimeoutError:
+        return _result(True, "", text, 'fallback')
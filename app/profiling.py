@@ -0,0 +1,311 @@
+"""
+Profiling for ChatSphere
+On-demand profiles of single requests, Socket.IO events or a time window of
+the whole worker, saved as flamegraph-compatible collapsed stacks.
+
+Profiling is off unless PROFILING_TOKEN is set; without it no hooks are
+installed. With it, a request is profiled when it carries the token in an
+X-Profile header or a ?profile= query parameter:
+
+    curl -H 'X-Profile: <token>' -H 'X-Profile-Mode: cprofile' .../
+
+The next requests to an endpoint or the next Socket.IO events of a name can
+be armed from /profiling/arm, and /profiling/window samples every thread of
+the worker for a number of seconds. Profiles are written to PROFILE_DIR as
+<id>.folded (one "frame;frame;frame count" line per stack, for flamegraph.pl
+or speedscope) and, for cProfile, <id>.prof for pstats and snakeviz.
+
+Two modes:
+    sample:   a background thread samples the stack every PROFILE_INTERVAL
+              seconds; counts are samples, overhead is low
+    cprofile: deterministic profile of the request's thread; counts are
+              microseconds of self time, overhead is high
+"""
+from concurrent.futures import Future
+import cProfile
+import functools
+import hmac
+import os
+import pstats
+import re
+import sys
+import sysconfig
+import threading
+import time
+import uuid
+
+MODES = ('sample', 'cprofile')
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STDLIB = sysconfig.get_paths()['stdlib']
+
+# Deepest stack kept per sample; deeper frames nearest the root are dropped
+MAX_DEPTH = 128
+
+def frame_label(filename, lineno, name):
+    """'function (path:line)' with the path shortened to the project or package"""
+    if filename == '~':
+        return name.replace(';', ',')
+    if filename.startswith(PROJECT_ROOT):
+        filename = filename[len(PROJECT_ROOT) + 1:]
+    elif 'site-packages' in filename:
+        filename = filename.split('site-packages', 1)[1].lstrip(os.sep)
+    elif filename.startswith(STDLIB):
+        filename = filename[len(STDLIB) + 1:]
+    return f"{name} ({filename}:{lineno})".replace(';', ',')
+
+def collapse(frame):
+    """The stack of a frame, root first, as a collapsed-stack key"""
+    labels = []
+    while frame is not None and len(labels) < MAX_DEPTH:
+        code = frame.f_code
+        labels.append(frame_label(code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+class Sampler(threading.Thread):
+    """
+    Samples the stacks of one thread, or of every other thread, at an interval
+    Args:
+        interval: Seconds between samples
+        thread_id: Only sample this thread; None samples all of them with the
+                   thread name as the root frame
+    """
+
+    def __init__(self, interval, thread_id=None):
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frame = frames.get(self.thread_id)
+                if frame is not None:
+                    key = collapse(frame)
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                name = names.get(thread_id, str(thread_id))
+                if name.startswith('profiling-'):
+                    continue
+                key = name.replace(';', ',') + ';' + collapse(frame)
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.counts
+
+def pstats_stacks(stats, scale=1e6):
+    """
+    Collapsed stacks from a cProfile run
+    cProfile keeps caller/callee edges rather than stacks, so each function's
+    self time is split across its callers in proportion to the time spent
+    through each edge.
+    Returns:
+        Dict of collapsed stack -> microseconds of self time
+    """
+    entries = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    counts = {}
+
+    def walk(func, path, funcs, share):
+        _, _, self_time, total_time, _ = entries[func]
+        path = path + (frame_label(*func),)
+        weight = int(round(self_time * share * scale))
+        if weight:
+            key = ';'.join(path)
+            counts[key] = counts.get(key, 0) + weight
+        if len(path) >= MAX_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, ()):
+            callee_total = entries[callee][3]
+            # Skip recursion and branches under a microsecond
+            if callee in funcs or callee_total <= 0 or edge_time * share * scale < 1:
+                continue
+            walk(callee, path, funcs | {callee}, share * edge_time / callee_total)
+
+    for func, entry in entries.items():
+        if not entry[4]:
+            walk(func, (), frozenset([func]), 1.0)
+    return counts
+
+# Only one deterministic profiler per process at a time
+_cprofile_lock = threading.Lock()
+
+class Capture:
+    """
+    Profile of the code run on the calling thread between start() and stop()
+    Falls back to sampling when another cProfile capture is running.
+    """
+
+    def __init__(self, label, mode, interval):
+        self.label = label
+        self.mode = mode
+        self.interval = interval
+        self._profiler = None
+        self._sampler = None
+
+    def start(self):
+        if self.mode == 'cprofile' and _cprofile_lock.acquire(blocking=False):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self.mode = 'sample'
+            self._sampler = Sampler(self.interval, threading.get_ident())
+            self._sampler.start()
+        return self
+
+    def stop(self, directory):
+        """Stop and write the profile; returns its id"""
+        if self._profiler is not None:
+            self._profiler.disable()
+            _cprofile_lock.release()
+            stats = pstats.Stats(self._profiler)
+            return save(directory, self.label, pstats_stacks(stats), stats)
+        return save(directory, self.label, self._sampler.stop())
+
+def save(directory, label, counts, stats=None):
+    """Write collapsed stacks (and pstats) to directory; returns the profile id"""
+    os.makedirs(directory, exist_ok=True)
+    profile_id = '{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                   re.sub(r'[^A-Za-z0-9_.-]+', '_', label)[:60], uuid.uuid4().hex[:6])
+    with open(os.path.join(directory, profile_id + '.folded'), 'w') as f:
+        for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {count}\n")
+    if stats is not None:
+        stats.dump_stats(os.path.join(directory, profile_id + '.prof'))
+    return profile_id
+
+class Profiler:
+    """Armed targets and the running window of one worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Endpoint or socket event name -> [captures left, mode]
+        self.armed = {}
+        self.window = None
+
+    def arm(self, target, count=1, mode='sample'):
+        """Profile the next count requests to an endpoint or socket events of a name"""
+        with self._lock:
+            self.armed[target] = [count, mode]
+
+    def disarm(self, target=None):
+        with self._lock:
+            if target is None:
+                self.armed.clear()
+            else:
+                self.armed.pop(target, None)
+
+    def take(self, target):
+        """The mode to profile target with if it is armed, using up one capture"""
+        with self._lock:
+            entry = self.armed.get(target)
+            if entry is None:
+                return None
+            entry[0] -= 1
+            if entry[0] <= 0:
+                del self.armed[target]
+            return entry[1]
+
+    def start_window(self, seconds, interval, directory):
+        """
+        Sample every thread of this worker for a number of seconds
+        Returns:
+            Future of the profile id, or None when a window is already running
+        """
+        with self._lock:
+            if self.window is not None and not self.window.done():
+                return None
+            self.window = future = Future()
+
+        def run():
+            sampler = Sampler(interval)
+            sampler.start()
+            time.sleep(seconds)
+            try:
+                future.set_result(save(directory, f"window-{seconds:g}s", sampler.stop()))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name='profiling-window', daemon=True).start()
+        return future
+
+    def status(self):
+        with self._lock:
+            return {
+                'armed': {target: {'remaining': count, 'mode': mode} for target, (count, mode) in self.armed.items()},
+                'window_running': self.window is not None and not self.window.done()
+            }
+
+profiler = Profiler()
+
+def valid_token(app, supplied):
+    token = app.config['PROFILING_TOKEN']
+    return bool(token) and bool(supplied) and hmac.compare_digest(supplied.encode(), token.encode())
+
+def _profiled_event(app, event, handler):
+    @functools.wraps(handler)
+    def wrapper(*args):
+        mode = profiler.take(event) if profiler.armed else None
+        if mode is None:
+            return handler(*args)
+        capture = Capture(f"socket-{event}", mode, app.config['PROFILE_INTERVAL']).start()
+        try:
+            return handler(*args)
+        finally:
+            capture.stop(app.config['PROFILE_DIR'])
+    wrapper.profiling_wrapped = True
+    return wrapper
+
+def init_app(app, socketio):
+    """Install the profiling triggers when PROFILING_TOKEN is set"""
+    from flask import request, g
+
+    if not app.config['PROFILING_TOKEN']:
+        return
+
+    @app.before_request
+    def start_profile():
+        if request.blueprint == 'profiling':
+            return
+        supplied = request.headers.get('X-Profile') or request.args.get('profile')
+        if supplied:
+            if not valid_token(app, supplied):
+                return
+            mode = request.headers.get('X-Profile-Mode') or request.args.get('profile_mode') or 'sample'
+        else:
+            mode = profiler.take(request.endpoint) if profiler.armed else None
+            if mode is None:
+                return
+        label = f"http-{request.endpoint or 'unmatched'}"
+        g.profile_capture = Capture(label, mode if mode in MODES else 'sample', app.config['PROFILE_INTERVAL']).start()
+
+    @app.after_request
+    def finish_profile(response):
+        capture = g.pop('profile_capture', None)
+        if capture is not None:
+            response.headers['X-Profile-Id'] = capture.stop(app.config['PROFILE_DIR'])
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # Requests that raised skip after_request
+        capture = g.pop('profile_capture', None)
+        if capture is not None:
+            capture.stop(app.config['PROFILE_DIR'])
+
+    for events in socketio.server.handlers.values():
+        for name, handler in list(events.items()):
+            if not getattr(handler, 'profiling_wrapped', False):
+                events[name] = _profiled_event(app, name, handler)
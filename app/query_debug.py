@@ -0,0 +1,190 @@
+"""
+Query Debugging for ChatSphere
+Detects N+1 query patterns and enforces per-endpoint query budgets.
+
+In debug and test mode (or with QUERY_DEBUG=true) every SQL statement run by
+a Flask request or Socket.IO event is grouped by its shape, the statement
+with parameters and IN lists collapsed. A shape repeated QUERY_DEBUG_THRESHOLD
+times is reported with the stack of the repeat, which points at the loop.
+
+Views and socket handlers can declare how many queries they may run with
+@budget(n); going over is reported too, and tests turn it into a failure:
+
+    with query_budget(5):
+        client.get('/status/')
+
+    assert_query_budget(client, 'GET', '/chat/messages/user/2')
+"""
+from contextlib import contextmanager
+import functools
+import logging
+import os
+import re
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_PARAMS = re.compile(r"%\(\w+\)s|\$\d+")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+class QueryBudgetExceeded(AssertionError):
+    """A block of code ran more SQL statements than its budget allows"""
+
+class _Tracker(threading.local):
+    """Statements of the request or socket event running on this thread"""
+    label = None
+    budget = None
+    threshold = 5
+    total = 0
+    shapes = None
+    recorders = ()
+
+_tracker = _Tracker()
+
+def budget(max_queries):
+    """
+    Declare the most SQL statements a view or socket handler may run
+    Args:
+        max_queries: Statement budget, checked in debug and test mode
+    """
+    def decorator(func):
+        func.query_budget = max_queries
+        return func
+    return decorator
+
+def statement_shape(statement):
+    """The statement with parameters and IN lists collapsed, so loop iterations match"""
+    shape = _PARAMS.sub('?', statement)
+    shape = _IN_LIST.sub('(?...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+def app_stack():
+    """Frames of the current stack inside the app package (code and templates)"""
+    frames = [frame for frame in traceback.extract_stack()[:-2]
+              if frame.filename.startswith(APP_ROOT) and not frame.filename.endswith('query_debug.py')]
+    return ''.join(traceback.format_list(frames[-6:]))
+
+def _on_execute(conn, cursor, statement, parameters, context, executemany):
+    for recorder in _tracker.recorders:
+        recorder.append(statement)
+    if _tracker.label is None:
+        return
+    _tracker.total += 1
+    shape = statement_shape(statement)
+    entry = _tracker.shapes.get(shape)
+    if entry is None:
+        _tracker.shapes[shape] = [1, None]
+    else:
+        entry[0] += 1
+        if entry[0] == _tracker.threshold:
+            entry[1] = app_stack()
+
+def _start(label, max_queries, threshold):
+    _tracker.label = label
+    _tracker.budget = max_queries
+    _tracker.threshold = threshold
+    _tracker.total = 0
+    _tracker.shapes = {}
+
+def _finish():
+    label, max_queries, threshold = _tracker.label, _tracker.budget, _tracker.threshold
+    total, shapes = _tracker.total, _tracker.shapes
+    _tracker.label = None
+    _tracker.shapes = None
+
+    for shape, (count, stack) in shapes.items():
+        if count >= threshold:
+            logger.warning("N+1 query: %sx in %s: %s\n%s", count, label, shape[:300], stack or '',
+                           extra={'event': 'query_debug.n_plus_one'})
+    if max_queries is not None and total > max_queries:
+        logger.warning("Query budget exceeded: %s ran %s statements (budget %s)", label, total, max_queries,
+                       extra={'event': 'query_debug.budget'})
+
+def _enabled(app):
+    mode = app.config['QUERY_DEBUG']
+    return mode == 'true' or (mode == '' and (app.debug or app.testing))
+
+def _tracked_event(app, event, handler):
+    @functools.wraps(handler)
+    def wrapper(*args):
+        if not _enabled(app):
+            return handler(*args)
+        _start(f"socket event '{event}'", getattr(handler, 'query_budget', None), app.config['QUERY_DEBUG_THRESHOLD'])
+        try:
+            return handler(*args)
+        finally:
+            _finish()
+    wrapper.query_debug_wrapped = True
+    return wrapper
+
+def init_app(app, socketio):
+    """Listen to SQL statements and track them per request and socket event"""
+    from flask import request
+    from sqlalchemy import event
+    from app import db
+
+    with app.app_context():
+        engine = db.engine
+    if not event.contains(engine, 'before_cursor_execute', _on_execute):
+        event.listen(engine, 'before_cursor_execute', _on_execute)
+
+    @app.before_request
+    def start_query_tracking():
+        if _enabled(app):
+            view = app.view_functions.get(request.endpoint)
+            _start(f"endpoint '{request.endpoint or request.path}'", getattr(view, 'query_budget', None),
+                   app.config['QUERY_DEBUG_THRESHOLD'])
+
+    @app.teardown_request
+    def finish_query_tracking(exc):
+        # Socket events also run in a request context; their wrapper finishes them
+        if _tracker.label is not None and _tracker.label.startswith('endpoint'):
+            _finish()
+
+    for events in socketio.server.handlers.values():
+        for name, handler in list(events.items()):
+            if not getattr(handler, 'query_debug_wrapped', False):
+                events[name] = _tracked_event(app, name, handler)
+
+@contextmanager
+def query_budget(max_queries):
+    """
+    Fail if the block runs more than max_queries SQL statements on this thread
+    Yields:
+        List of the statements run so far
+    Raises:
+        QueryBudgetExceeded: With the statements grouped by shape
+    """
+    statements = []
+    _tracker.recorders = _tracker.recorders + (statements,)
+    try:
+        yield statements
+    finally:
+        _tracker.recorders = tuple(r for r in _tracker.recorders if r is not statements)
+    if len(statements) > max_queries:
+        counts = {}
+        for statement in statements:
+            shape = statement_shape(statement)
+            counts[shape] = counts.get(shape, 0) + 1
+        details = '\n'.join(f"  {count}x {shape[:200]}" for shape, count in
+                            sorted(counts.items(), key=lambda item: -item[1]))
+        raise QueryBudgetExceeded(f"{len(statements)} statements, budget {max_queries}:\n{details}")
+
+def assert_query_budget(client, method, path, **kwargs):
+    """
+    Request path with a Flask test client and fail if the endpoint goes over
+    the budget declared with @budget
+    Returns:
+        The response
+    """
+    app = client.application
+    endpoint, _ = app.url_map.bind('localhost').match(path.split('?', 1)[0], method=method)
+    max_queries = getattr(app.view_functions[endpoint], 'query_budget', None)
+    if max_queries is None:
+        raise AssertionError(f"{endpoint} has no declared query budget")
+    with query_budget(max_queries):
+        return client.open(path, method=method, **kwargs)
@@ -4,19 +4,58 @@ Handles all AI feature endpoints
 """
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
-from app import db
-from app.models import Message, User, Group
+from app import db, socketio
+from app.models import Message, User, Group, ConversationSummary, Transcript
 from app.ai_utils import (
     generate_smart_replies, translate_message, enhance_message,
-    transcribe_audio, moderate_content, analyze_sentiment,
-    summarize_conversation, smart_search, get_ai_response,
-    autocomplete_text
+    fold_summary, smart_search, get_ai_response,
+    stream_ai_response
 )
+from app.ai_clients import clients
+from app.ai_cache import ai_cache
+from app.ai_jobs import scheduler, run_job, submit_job, wait, QueueFull, DeadlineExceeded, AIUnavailable
+from app.moderation import moderate_message
+from app.sentiment import analyze_many
+from app.smart_replies import conversation, recent_history, cached_replies, store_replies, pending
+from app.transcripts import queue_transcription, AUDIO_TYPES
+from app.autocomplete import get_model, refine_completions, SUGGESTIONS as AUTOCOMPLETE_SUGGESTIONS
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
-import os
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('ai', __name__, url_prefix='/ai')
 
+@bp.errorhandler(QueueFull)
+@bp.errorhandler(AIUnavailable)
+def queue_full(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status_code
+
+@bp.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return jsonify({'error': str(e)}), 504
+
+def chat_ref(data):
+    """
+    Conversation a request refers to
+    Returns:
+        Tuple of (chat_type, integer chat_id), or None if chat_type is not
+        'user' or 'group' or chat_id is not a positive integer
+    """
+    chat_type = data.get('chat_type', 'user')
+    chat_id = data.get('chat_id')
+    if chat_type not in ('user', 'group') or isinstance(chat_id, bool):
+        return None
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return None
+    return (chat_type, chat_id) if chat_id > 0 else None
+
 # AI Bot User ID (will be created in setup)
 AI_BOT_ID = None
 
@@ -37,7 +76,12 @@ def get_ai_bot():
         )
         ai_bot.set_password('impossible_password_12345')
         db.session.add(ai_bot)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Created by a concurrent request
+            db.session.rollback()
+            ai_bot = User.query.filter_by(username='chatsphere_ai').first()
     
     AI_BOT_ID = ai_bot.id
     return ai_bot
@@ -67,12 +111,22 @@ def ai_chat():
         'is_ai': msg.sender_id == ai_bot.id
     } for msg in reversed(history)]
     
+    if data.get('stream'):
+        # Tokens are pushed over Socket.IO; the request returns immediately
+        stream_id = uuid.uuid4().hex
+        submit_job(
+            'chat', _stream_ai_reply, current_user.id, ai_bot.id,
+            user_message, history_data, stream_id, user_id=current_user.id
+        )
+        return jsonify({'stream_id': stream_id}), 202
+    
     # Get AI response
-    ai_response = get_ai_response(user_message, history_data)
+    bot_id = ai_bot.id
+    ai_response = run_job('chat', get_ai_response, user_message, history_data)
     
     # Save AI response as message
     ai_message = Message(
-        sender_id=ai_bot.id,
+        sender_id=bot_id,
         recipient_id=current_user.id,
         content=ai_response,
         message_type='text',
@@ -87,35 +141,79 @@ def ai_chat():
         'timestamp': ai_message.timestamp.isoformat()
     })
 
+def _stream_ai_reply(user_id, bot_id, user_message, history_data, stream_id):
+    """
+    Forward a streamed AI reply to the user's room, then save it once
+    Runs as an AI job; emits ai_chunk per token delta, then ai_done (or ai_error).
+    """
+    room = f'user_{user_id}'
+    parts = []
+    try:
+        for delta in stream_ai_response(user_message, history_data):
+            socketio.emit('ai_chunk', {
+                'stream_id': stream_id,
+                'index': len(parts),
+                'delta': delta
+            }, room=room)
+            parts.append(delta)
+    except Exception as e:
+        logger.exception("AI stream error")
+        socketio.emit('ai_error', {
+            'stream_id': stream_id,
+            'error': str(e),
+            'partial': ''.join(parts)
+        }, room=room)
+        return
+    
+    ai_message = Message(
+        sender_id=bot_id,
+        recipient_id=user_id,
+        content=''.join(parts),
+        message_type='text',
+        timestamp=datetime.utcnow()
+    )
+    db.session.add(ai_message)
+    db.session.commit()
+    
+    socketio.emit('ai_done', {
+        'stream_id': stream_id,
+        'response': ai_message.content,
+        'message_id': ai_message.id,
+        'timestamp': ai_message.timestamp.isoformat()
+    }, room=room)
+
 @bp.route('/smart-replies', methods=['POST'])
 @login_required
 def smart_replies():
-    """Generate smart reply suggestions"""
+    """
+    Generate smart reply suggestions
+    Suggestions precomputed when the last message arrived are served from
+    the cache (or awaited if still being computed).
+    """
     data = request.get_json()
-    chat_type = data.get('chat_type', 'user')
-    chat_id = data.get('chat_id')
+    ref = chat_ref(data)
     
-    if not chat_id:
-        return jsonify({'error': 'chat_id required'}), 400
+    if ref is None:
+        return jsonify({'error': 'Valid chat_type and chat_id required'}), 400
+    chat_type, chat_id = ref
     
-    # Get recent messages
-    if chat_type == 'user':
-        messages = Message.query.filter(
-            db.or_(
-                db.and_(Message.sender_id == current_user.id, Message.recipient_id == chat_id),
-                db.and_(Message.sender_id == chat_id, Message.recipient_id == current_user.id)
-            )
-        ).order_by(Message.timestamp.desc()).limit(10).all()
-    else:
-        messages = Message.query.filter_by(group_id=chat_id).order_by(Message.timestamp.desc()).limit(10).all()
+    conversation_key, conversation_filter = conversation(chat_type, current_user.id, chat_id)
+    head_id, message_history = recent_history(conversation_filter)
+    
+    found, replies = cached_replies(conversation_key, head_id)
+    if found:
+        return jsonify({'replies': replies, 'head_id': head_id, 'cached': True})
     
-    message_history = [{
-        'sender': User.query.get(msg.sender_id).username,
-        'content': msg.content
-    } for msg in reversed(messages) if msg.message_type == 'text']
+    future = pending(conversation_key, head_id)
+    if future is not None:
+        db.session.close()
+        replies = wait(future)
+        if replies is not None:
+            return jsonify({'replies': replies, 'head_id': head_id, 'cached': True})
     
-    replies = generate_smart_replies(message_history)
-    return jsonify({'replies': replies})
+    replies = run_job('smart_replies', generate_smart_replies, message_history)
+    store_replies(conversation_key, head_id, replies)
+    return jsonify({'replies': replies, 'head_id': head_id, 'cached': False})
 
 @bp.route('/translate', methods=['POST'])
 @login_required
@@ -128,7 +226,7 @@ def translate():
     if not text:
         return jsonify({'error': 'Text required'}), 400
     
-    translated = translate_message(text, language)
+    translated = run_job('translate', translate_message, text, language)
     return jsonify({'translated': translated})
 
 @bp.route('/enhance', methods=['POST'])
@@ -142,13 +240,17 @@ def enhance():
     if not text:
         return jsonify({'error': 'Text required'}), 400
     
-    enhanced = enhance_message(text, tone)
+    enhanced = run_job('enhance', enhance_message, text, tone)
     return jsonify({'enhanced': enhanced})
 
 @bp.route('/transcribe', methods=['POST'])
 @login_required
 def transcribe():
-    """Transcribe audio message"""
+    """
+    Transcribe audio message
+    Voice notes are transcribed in the background when sent, so this is
+    usually a single transcript lookup; otherwise it waits for the job.
+    """
     data = request.get_json()
     message_id = data.get('message_id')
     
@@ -156,7 +258,7 @@ def transcribe():
         return jsonify({'error': 'message_id required'}), 400
     
     message = Message.query.get(message_id)
-    if not message or message.message_type != 'voice':
+    if not message or message.message_type not in AUDIO_TYPES or not message.media_url:
         return jsonify({'error': 'Invalid voice message'}), 400
     
     # Check if user has access to this message
@@ -164,12 +266,19 @@ def transcribe():
         if not message.group_id or current_user not in Group.query.get(message.group_id).members:
             return jsonify({'error': 'Access denied'}), 403
     
-    audio_path = os.path.join(current_app.root_path, message.media_url)
-    if not os.path.exists(audio_path):
-        return jsonify({'error': 'Audio file not found'}), 404
-    
-    transcription = transcribe_audio(audio_path)
-    return jsonify({'transcription': transcription})
+    transcript = message.transcript
+    if transcript and transcript.status == 'done':
+        return jsonify({'transcription': transcript.text, 'cached': True})
+    
+    future = queue_transcription(message, user_id=current_user.id)
+    if future is None:
+        raise QueueFull("AI service is busy, please retry shortly", 503)
+    db.session.close()
+    result = wait(future)
+    if result['status'] != 'done':
+        status_code = 404 if result['error'] == 'Audio file not found' else 502
+        return jsonify({'error': result['error']}), status_code
+    return jsonify({'transcription': result['text'], 'cached': False})
 
 @bp.route('/moderate', methods=['POST'])
 @login_required
@@ -181,7 +290,9 @@ def moderate():
     if not text:
         return jsonify({'error': 'Text required'}), 400
     
-    result = moderate_content(text)
+    # Clear cases are decided locally; ambiguous ones wait for a batched AI verdict
+    db.session.close()
+    result = moderate_message(text)
     return jsonify(result)
 
 @bp.route('/sentiment', methods=['POST'])
@@ -194,45 +305,110 @@ def sentiment():
     if not text:
         return jsonify({'error': 'Text required'}), 400
     
-    result = analyze_sentiment(text)
+    result = analyze_many([text])[0]
     return jsonify(result)
 
+@bp.route('/sentiment/batch', methods=['POST'])
+@login_required
+def sentiment_batch():
+    """Analyze the sentiment of many messages (e.g. a conversation page) at once"""
+    data = request.get_json()
+    texts = data.get('texts')
+    
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        return jsonify({'error': 'texts must be a list of strings'}), 400
+    if len(texts) > current_app.config['SENTIMENT_BATCH_MAX']:
+        return jsonify({'error': f"At most {current_app.config['SENTIMENT_BATCH_MAX']} texts per request"}), 400
+    
+    return jsonify({'results': analyze_many(texts)})
+
 @bp.route('/summarize', methods=['POST'])
 @login_required
 def summarize():
-    """Summarize conversation"""
+    """
+    Summarize conversation
+    Summaries are stored per conversation with a watermark (last message
+    folded in), so each request only sends the messages that came after it.
+    """
     data = request.get_json()
-    chat_type = data.get('chat_type', 'user')
-    chat_id = data.get('chat_id')
+    ref = chat_ref(data)
     max_length = data.get('max_length', 200)
     
-    if not chat_id:
-        return jsonify({'error': 'chat_id required'}), 400
+    if ref is None:
+        return jsonify({'error': 'Valid chat_type and chat_id required'}), 400
+    chat_type, chat_id = ref
     
-    # Get all messages from conversation
     if chat_type == 'user':
-        messages = Message.query.filter(
-            db.or_(
-                db.and_(Message.sender_id == current_user.id, Message.recipient_id == chat_id),
-                db.and_(Message.sender_id == chat_id, Message.recipient_id == current_user.id)
-            )
-        ).order_by(Message.timestamp.asc()).all()
+        low, high = sorted((current_user.id, chat_id))
+        conversation_key = f"direct:{low}:{high}"
+        conversation_filter = db.or_(
+            db.and_(Message.sender_id == current_user.id, Message.recipient_id == chat_id),
+            db.and_(Message.sender_id == chat_id, Message.recipient_id == current_user.id)
+        )
     else:
         group = Group.query.get(chat_id)
         if not group or current_user not in group.members:
             return jsonify({'error': 'Access denied'}), 403
-        messages = Message.query.filter_by(group_id=chat_id).order_by(Message.timestamp.asc()).all()
-    
-    if not messages:
+        conversation_key = f"group:{group.id}"
+        conversation_filter = Message.group_id == group.id
+    
+    record = ConversationSummary.query.filter_by(conversation_key=conversation_key).first()
+    watermark_id = record.watermark_id if record else 0
+    previous_summary = record.summary if record else ''
+    
+    # Only messages after the watermark, with sender names joined in one query
+    rows = db.session.query(Message.id, Message.content, User.username).join(
+        User, User.id == Message.sender_id
+    ).filter(
+        conversation_filter,
+        Message.id > watermark_id,
+        Message.message_type == 'text',
+        Message.is_deleted == False
+    ).order_by(Message.id.asc()).all()
+    
+    if not rows:
+        if record:
+            return jsonify({'summary': previous_summary, 'watermark_id': watermark_id, 'new_messages': 0})
         return jsonify({'summary': 'No messages to summarize'}), 200
     
-    message_data = [{
-        'sender': User.query.get(msg.sender_id).username,
-        'content': msg.content
-    } for msg in messages if msg.message_type == 'text']
+    message_data = [{'sender': username, 'content': content} for _, content, username in rows]
+    new_watermark_id = rows[-1].id
+    
+    summary = run_job('summarize', fold_summary, previous_summary, message_data, max_length)
+    if summary.startswith('Error:'):
+        return jsonify({'summary': summary})
     
-    summary = summarize_conversation(message_data, max_length)
-    return jsonify({'summary': summary})
+    _save_summary(conversation_key, summary, watermark_id, new_watermark_id, len(rows))
+    return jsonify({'summary': summary, 'watermark_id': new_watermark_id, 'new_messages': len(rows)})
+
+def _save_summary(conversation_key, summary, old_watermark_id, new_watermark_id, new_messages):
+    """Store a folded summary unless another request already moved the watermark past it"""
+    now = datetime.utcnow()
+    if old_watermark_id == 0 and not ConversationSummary.query.filter_by(conversation_key=conversation_key).count():
+        db.session.add(ConversationSummary(
+            conversation_key=conversation_key,
+            summary=summary,
+            watermark_id=new_watermark_id,
+            message_count=new_messages,
+            updated_at=now
+        ))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent request stored the first summary
+            db.session.rollback()
+        return
+    
+    ConversationSummary.query.filter(
+        ConversationSummary.conversation_key == conversation_key,
+        ConversationSummary.watermark_id == old_watermark_id
+    ).update({
+        ConversationSummary.summary: summary,
+        ConversationSummary.watermark_id: new_watermark_id,
+        ConversationSummary.message_count: ConversationSummary.message_count + new_messages,
+        ConversationSummary.updated_at: now
+    })
+    db.session.commit()
 
 @bp.route('/search', methods=['POST'])
 @login_required
@@ -240,59 +416,78 @@ def search():
     """Semantic search through messages"""
     data = request.get_json()
     query = data.get('query', '').strip()
-    chat_type = data.get('chat_type', 'user')
-    chat_id = data.get('chat_id')
+    ref = chat_ref(data)
     
-    if not query or not chat_id:
+    if not query or ref is None:
         return jsonify({'error': 'Query and chat_id required'}), 400
-    
-    # Get all messages from conversation
-    if chat_type == 'user':
-        messages = Message.query.filter(
-            db.or_(
-                db.and_(Message.sender_id == current_user.id, Message.recipient_id == chat_id),
-                db.and_(Message.sender_id == chat_id, Message.recipient_id == current_user.id)
-            )
-        ).order_by(Message.timestamp.asc()).all()
-    else:
-        messages = Message.query.filter_by(group_id=chat_id).order_by(Message.timestamp.asc()).all()
+    chat_type, chat_id = ref
+    
+    # Text messages and transcribed voice notes, with sender names joined in
+    _, conversation_filter = conversation(chat_type, current_user.id, chat_id)
+    rows = db.session.query(Message.id, Message.content, Message.message_type, Message.timestamp,
+                            User.username, Transcript.text).join(
+        User, User.id == Message.sender_id
+    ).outerjoin(
+        Transcript, db.and_(Transcript.message_id == Message.id, Transcript.status == 'done')
+    ).filter(
+        conversation_filter,
+        db.or_(Message.message_type == 'text', Transcript.text.isnot(None))
+    ).order_by(Message.timestamp.asc()).all()
     
     message_data = [{
-        'id': msg.id,
-        'sender': User.query.get(msg.sender_id).username,
-        'content': msg.content,
-        'timestamp': msg.timestamp.isoformat()
-    } for msg in messages if msg.message_type == 'text']
+        'id': msg_id,
+        'sender': username,
+        'content': content if message_type == 'text' else f"[{message_type} message] {transcript}",
+        'timestamp': timestamp.isoformat()
+    } for msg_id, content, message_type, timestamp, username, transcript in rows]
     
-    results = smart_search(query, message_data)
+    results = run_job('search', smart_search, query, message_data)
     return jsonify({'results': results})
 
 @bp.route('/autocomplete', methods=['POST'])
 @login_required
 def autocomplete():
-    """Get text completion suggestions"""
+    """
+    Get text completion suggestions
+    Answers at once from the user's local completion model. When it has
+    fewer than three suggestions the AI is asked in the background and its
+    completions are pushed as an 'autocomplete' event with the same request_id.
+    """
     data = request.get_json()
-    partial_text = data.get('text', '').strip()
+    text = data.get('text', '').lstrip()
     chat_type = data.get('chat_type', 'user')
     chat_id = data.get('chat_id')
     
-    if not partial_text or len(partial_text) < 3:
+    if len(text.strip()) < 3:
         return jsonify({'completions': []})
     
-    # Get recent context
-    context = ""
-    if chat_id:
-        if chat_type == 'user':
-            messages = Message.query.filter(
-                db.or_(
-                    db.and_(Message.sender_id == current_user.id, Message.recipient_id == chat_id),
-                    db.and_(Message.sender_id == chat_id, Message.recipient_id == current_user.id)
-                )
-            ).order_by(Message.timestamp.desc()).limit(3).all()
-        else:
-            messages = Message.query.filter_by(group_id=chat_id).order_by(Message.timestamp.desc()).limit(3).all()
-        
-        context = " ".join([msg.content for msg in reversed(messages) if msg.message_type == 'text'])
-    
-    completions = autocomplete_text(partial_text, context)
-    return jsonify({'completions': completions})
+    model = get_model(current_user.id)
+    completions = model.complete(text)
+    response = {'completions': completions, 'source': 'local', 'refining': False}
+    if len(completions) >= AUTOCOMPLETE_SUGGESTIONS or not current_app.config['AUTOCOMPLETE_AI']:
+        return jsonify(response)
+    
+    refined = model.refinement(text)
+    if refined is not None:
+        response['completions'] = list(dict.fromkeys(completions + refined))[:AUTOCOMPLETE_SUGGESTIONS]
+        response['source'] = 'cache'
+        return jsonify(response)
+    
+    request_id = data.get('request_id') or str(uuid.uuid4())
+    try:
+        submit_job('autocomplete', refine_completions, current_user.id, text, chat_type, chat_id,
+                   request_id, user_id=current_user.id)
+    except QueueFull:
+        return jsonify(response)
+    response.update(refining=True, request_id=request_id)
+    return jsonify(response)
+
+@bp.route('/stats', methods=['GET'])
+@login_required
+def stats():
+    """AI client, result cache and job queue metrics for this worker"""
+    return jsonify({
+        'client': clients.metrics.snapshot(),
+        'cache': ai_cache.stats(),
+        'jobs': scheduler.stats()
+    })
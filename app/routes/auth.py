@@ -2,26 +2,50 @@ from flask import Blueprint, render_template, redirect, url_for, request, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from app import db
 from app.models import User
+from app.security import (
+    HashingBusy, RateLimited, needs_rehash, check_login_allowed, record_login_failure,
+    record_login_success, check_register_allowed
+)
+from sqlalchemy import or_
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+@bp.errorhandler(RateLimited)
+def rate_limited(e):
+    flash(f'{e}. Please try again in {e.retry_after} seconds.', 'error')
+    return render_template(f'auth/{request.endpoint.rsplit(".", 1)[-1]}.html'), 429, {'Retry-After': str(e.retry_after)}
+
+@bp.errorhandler(HashingBusy)
+def hashing_busy(e):
+    flash('The server is busy. Please try again in a moment.', 'error')
+    return render_template(f'auth/{request.endpoint.rsplit(".", 1)[-1]}.html'), 503, {'Retry-After': str(e.retry_after)}
+
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('main.index'))
     
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
+        username = request.form.get('username') or ''
+        password = request.form.get('password') or ''
         
+        check_login_allowed(request.remote_addr, username)
         user = User.query.filter_by(username=username).first()
         
         if user and user.check_password(password):
+            record_login_success(request.remote_addr, username)
+            # Upgrade hashes made with older parameters; logging in does not wait for a busy pool
+            if needs_rehash(user.password_hash):
+                try:
+                    user.set_password(password)
+                except HashingBusy:
+                    pass
             login_user(user, remember=True)
             user.is_online = True
             db.session.commit()
             return redirect(url_for('main.index'))
         else:
+            record_login_failure(request.remote_addr, username)
             flash('Invalid username or password', 'error')
     
     return render_template('auth/login.html')
@@ -43,14 +67,22 @@ def register():
             flash('Passwords do not match', 'error')
             return render_template('auth/register.html')
         
-        if User.query.filter_by(username=username).first():
+        # One query for both uniqueness checks
+        taken = db.session.query(User.username, User.email).filter(
+            or_(User.username == username, User.email == email)
+        ).all()
+        
+        if any(row.username == username for row in taken):
             flash('Username already exists', 'error')
             return render_template('auth/register.html')
         
-        if User.query.filter_by(email=email).first():
+        if taken:
             flash('Email already exists', 'error')
             return render_template('auth/register.html')
         
+        # Only sign-ups that get as far as hashing a password count
+        check_register_allowed(request.remote_addr)
+        
         # Create new user
         user = User(username=username, email=email, phone=phone)
         user.set_password(password)
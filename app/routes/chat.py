@@ -2,14 +2,31 @@ from flask import Blueprint, render_template, request, jsonify
 from flask_login import login_required, current_user
 from app import db
 from app.models import Message, User, Group, MessageReaction
+from app import media_store
+from app.query_debug import budget
+from app.storage import profile_pic_url
 from datetime import datetime
 from sqlalchemy import or_, and_
 
 bp = Blueprint('chat', __name__, url_prefix='/chat')
 
+def is_member(group):
+    """Whether the current user belongs to the group, without loading every member"""
+    return group.members.filter(User.id == current_user.id).first() is not None
+
 @bp.route('/user/<int:user_id>')
 @login_required
+@budget(8)
 def user_chat(user_id):
+    # Mark messages as read first, in one statement; committing after loading
+    # would expire every loaded object and reload each one in the template
+    Message.query.filter_by(
+        sender_id=user_id,
+        recipient_id=current_user.id,
+        is_read=False
+    ).update({'is_read': True, 'read_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    
     user = User.query.get_or_404(user_id)
     
     # Get messages between current user and selected user
@@ -22,31 +39,19 @@ def user_chat(user_id):
         Message.is_deleted == False
     ).order_by(Message.timestamp.asc()).all()
     
-    # Mark messages as read
-    unread_messages = Message.query.filter_by(
-        sender_id=user_id,
-        recipient_id=current_user.id,
-        is_read=False
-    ).all()
-    
-    for msg in unread_messages:
-        msg.is_read = True
-        msg.read_at = datetime.utcnow()
-    
-    db.session.commit()
-    
     return render_template('chat/chat.html', chat_user=user, messages=messages, chat_type='user')
 
 @bp.route('/group/<int:group_id>')
 @login_required
+@budget(6)
 def group_chat(group_id):
     group = Group.query.get_or_404(group_id)
     
     # Check if user is member
-    if current_user not in group.members.all():
+    if not is_member(group):
         return "Not authorized", 403
     
-    messages = Message.query.filter_by(
+    messages = Message.query.options(db.joinedload(Message.sender)).filter_by(
         group_id=group_id,
         is_deleted=False
     ).order_by(Message.timestamp.asc()).all()
@@ -55,6 +60,7 @@ def group_chat(group_id):
 
 @bp.route('/messages/user/<int:user_id>')
 @login_required
+@budget(4)
 def get_user_messages(user_id):
     messages = Message.query.filter(
         or_(
@@ -79,13 +85,14 @@ def get_user_messages(user_id):
 
 @bp.route('/messages/group/<int:group_id>')
 @login_required
+@budget(4)
 def get_group_messages(group_id):
     group = Group.query.get_or_404(group_id)
     
-    if current_user not in group.members.all():
+    if not is_member(group):
         return jsonify({'error': 'Not authorized'}), 403
     
-    messages = Message.query.filter_by(
+    messages = Message.query.options(db.joinedload(Message.sender)).filter_by(
         group_id=group_id,
         is_deleted=False
     ).order_by(Message.timestamp.asc()).all()
@@ -138,6 +145,7 @@ def delete_message(message_id):
         return jsonify({'error': 'Not authorized'}), 403
     
     message.is_deleted = True
+    media_store.release(message.media_url)
     db.session.commit()
     
     return jsonify({'success': True})
@@ -148,7 +156,7 @@ def get_available_users(group_id):
     group = Group.query.get_or_404(group_id)
     
     # Check if user is member
-    if current_user not in group.members.all():
+    if not is_member(group):
         return jsonify({'error': 'Not authorized'}), 403
     
     # Get all users except current members
@@ -159,7 +167,8 @@ def get_available_users(group_id):
         'id': user.id,
         'username': user.username,
         'about': user.about,
-        'profile_pic': user.profile_pic
+        'profile_pic': user.profile_pic,
+        'profile_pic_url': profile_pic_url(user.profile_pic)
     } for user in available_users])
 
 @bp.route('/group/<int:group_id>/add-member', methods=['POST'])
@@ -168,7 +177,7 @@ def add_member_to_group(group_id):
     group = Group.query.get_or_404(group_id)
     
     # Check if user is group owner or member
-    if current_user not in group.members.all():
+    if not is_member(group):
         return jsonify({'error': 'Not authorized'}), 403
     
     data = request.get_json()
@@ -3,11 +3,13 @@ from flask_login import login_required, current_user
 from app.models import User
 from datetime import datetime
 from app import db
+from app.query_debug import budget
 
 bp = Blueprint('main', __name__)
 
 @bp.route('/')
 @login_required
+@budget(10)
 def index():
     # Update last seen
     current_user.last_seen = datetime.utcnow()
@@ -1,16 +1,59 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, send_file, abort
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import get_input_stream
+from app import db, socketio
+from app.models import User, UploadSession
+from app.upload_utils import (
+    STREAM_BUFFER_SIZE, UploadError, new_upload_id, create_part_file, claim_upload, release_upload,
+    write_chunk, finalize_upload, discard_upload, get_tmp_folder
+)
+from app import media_store
+from app.image_utils import can_process, derivative_name, derivative_urls, request_derivatives
+from app.storage import get_storage
+from datetime import datetime, timedelta
+import hashlib
 import os
-from PIL import Image
 
 bp = Blueprint('media', __name__, url_prefix='/media')
 
+# Image sizes rendered for chat and status media
+MEDIA_VARIANTS = ['thumb', 'preview']
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'avi', 'mov', 'mp3', 'wav', 'webm', 'ogg', 'pdf', 'doc', 'docx', 'txt'}
 
+STATUS_MEDIA_TYPES = {
+    'image': {'jpg', 'jpeg', 'png', 'gif', 'webp'},
+    'video': {'mp4', 'mov', 'avi', 'webm'},
+    'audio': {'mp3', 'wav', 'ogg', 'm4a', 'aac', 'flac'}
+}
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def get_extension(filename):
+    """Lowercase file extension used to serve a stored blob"""
+    return filename.rsplit('.', 1)[1].lower()[:10] if '.' in filename else 'bin'
+
+def get_file_type(filename):
+    """Determine chat media type from a file extension"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    if ext in {'png', 'jpg', 'jpeg', 'gif'}:
+        return 'image'
+    elif ext in {'mp4', 'avi', 'mov'}:
+        return 'video'
+    elif ext in {'mp3', 'wav', 'webm', 'ogg'}:
+        return 'audio'
+    return 'document'
+
+def get_status_media_type(filename, default='text'):
+    """Determine status media type from a file extension"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    for media_type, extensions in STATUS_MEDIA_TYPES.items():
+        if ext in extensions:
+            return media_type
+    return default
+
 @bp.route('/upload', methods=['POST'])
 @login_required
 def upload():
@@ -24,35 +67,28 @@ def upload():
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        # Add timestamp to filename to make it unique
-        timestamp = str(int(datetime.now().timestamp()))
-        filename = f"{timestamp}_{filename}"
-        
-        upload_folder = os.path.join(current_app.root_path, current_app.config['UPLOAD_FOLDER'], 'media')
-        filepath = os.path.join(upload_folder, filename)
-        
-        file.save(filepath)
-        
-        # Determine file type
-        ext = filename.rsplit('.', 1)[1].lower()
-        if ext in {'png', 'jpg', 'jpeg', 'gif'}:
-            file_type = 'image'
-        elif ext in {'mp4', 'avi', 'mov'}:
-            file_type = 'video'
-        elif ext in {'mp3', 'wav', 'webm', 'ogg'}:
-            file_type = 'audio'
-        else:
-            file_type = 'document'
-        
-        return jsonify({
-            'success': True,
-            'filename': filename,
-            'url': f'/static/uploads/media/{filename}',
-            'type': file_type
-        })
+        blob = media_store.store_upload(file, get_extension(filename))
+        return jsonify(_blob_response(blob, filename))
     
     return jsonify({'error': 'File type not allowed'}), 400
 
+@bp.route('/claim', methods=['POST'])
+@login_required
+def claim():
+    """Reference already stored content by hash instead of uploading it again"""
+    data = request.get_json() or {}
+    sha256 = (data.get('sha256') or '').lower()
+    filename = secure_filename(data.get('filename', ''))
+    
+    if len(sha256) != 64 or not filename:
+        return jsonify({'error': 'sha256 and filename required'}), 400
+    
+    blob = media_store.acquire(sha256)
+    if not blob:
+        return jsonify({'error': 'Content not stored'}), 404
+    
+    return jsonify(_blob_response(blob, filename))
+
 @bp.route('/upload-profile', methods=['POST'])
 @login_required
 def upload_profile():
@@ -68,30 +104,428 @@ def upload_profile():
         filename = secure_filename(file.filename)
         # Use user id in filename
         ext = filename.rsplit('.', 1)[1].lower()
-        filename = f"profile_{current_user.id}.{ext}"
-        
-        upload_folder = os.path.join(current_app.root_path, current_app.config['UPLOAD_FOLDER'], 'profiles')
-        filepath = os.path.join(upload_folder, filename)
+        filename = f"profile_{current_user.id}_{int(datetime.now().timestamp())}.{ext}"
         
-        # Save and resize image
-        file.save(filepath)
+        storage = get_storage()
+        key = f"profiles/{filename}"
+        storage.save_stream(key, file.stream)
         
-        # Resize image to 200x200
-        with Image.open(filepath) as img:
-            img = img.resize((200, 200), Image.LANCZOS)
-            img.save(filepath)
-        
-        # Update user profile
+        # Show the original until the avatar is rendered off-request
         current_user.profile_pic = filename
-        from app import db
         db.session.commit()
         
-        return jsonify({
+        response = {
             'success': True,
             'filename': filename,
-            'url': f'/static/uploads/profiles/{filename}'
-        })
+            'url': storage.url(key),
+            'pending': False
+        }
+        
+        if can_process(filename):
+            app = current_app._get_current_object()
+            user_id = current_user.id
+            avatar = derivative_name(filename, 'avatar', 'webp')
+            
+            def on_done(success):
+                if success:
+                    _use_profile_avatar(app, user_id, filename, avatar)
+            
+            if request_derivatives(key, ['avatar'], on_done):
+                _use_profile_avatar(app, user_id, filename, avatar)
+                response['filename'] = avatar
+                response['url'] = storage.url(f"profiles/{avatar}")
+            else:
+                response['pending'] = True
+                response['avatar_url'] = storage.url(f"profiles/{avatar}")
+        
+        return jsonify(response)
     
     return jsonify({'error': 'File type not allowed'}), 400
 
-from datetime import datetime
+def _use_profile_avatar(app, user_id, original, avatar):
+    """Switch a user's profile picture to its rendered avatar"""
+    with app.app_context():
+        user = User.query.get(user_id)
+        if not user or user.profile_pic not in (original, avatar):
+            # A newer upload replaced this one while it was rendering
+            return
+        
+        user.profile_pic = avatar
+        db.session.commit()
+        
+        # Remove files from earlier profile pictures
+        storage = get_storage()
+        stem = f"profiles/{original.rsplit('.', 1)[0]}"
+        for key in storage.list(f"profiles/profile_{user_id}_"):
+            if not key.startswith(stem):
+                storage.delete(key)
+        url = storage.url(f"profiles/{avatar}")
+    
+    socketio.emit('profile_ready', {
+        'user_id': user_id,
+        'filename': avatar,
+        'url': url
+    }, room=f'user_{user_id}')
+
+def _blob_response(blob, filename):
+    url = media_store.blob_url(blob.sha256, blob.ext)
+    response = {
+        'success': True,
+        'filename': f"{blob.sha256}.{blob.ext}",
+        'url': url,
+        'type': get_file_type(filename),
+        'sha256': blob.sha256
+    }
+    if can_process(response['filename']):
+        response['derivatives'] = derivative_urls(url, MEDIA_VARIANTS)
+        response['derivatives_ready'] = _request_blob_derivatives(blob, current_user.id)
+    return response
+
+def _request_blob_derivatives(blob, user_id):
+    """Queue thumbnails for a stored image; the uploader is notified when ready"""
+    url = media_store.blob_url(blob.sha256, blob.ext)
+    
+    def on_done(success):
+        if success:
+            socketio.emit('media_ready', {
+                'url': url,
+                'derivatives': derivative_urls(url, MEDIA_VARIANTS)
+            }, room=f'user_{user_id}')
+    
+    return request_derivatives(media_store.blob_key(blob.sha256, blob.ext), MEDIA_VARIANTS, on_done)
+
+def _upload_response(session):
+    return {
+        'upload_id': session.id,
+        'offset': session.received,
+        'size': session.total_size,
+        'status': session.status
+    }
+
+def _completed_response(session, blob=None):
+    if session.kind == 'status':
+        file_type = get_status_media_type(session.filename)
+    else:
+        file_type = get_file_type(session.filename)
+    response = {
+        'success': True,
+        'upload_id': session.id,
+        'filename': session.media_url.rsplit('/', 1)[1],
+        'url': session.media_url,
+        'type': file_type,
+        'sha256': session.sha256
+    }
+    if blob and can_process(response['filename']):
+        response['derivatives'] = derivative_urls(session.media_url, MEDIA_VARIANTS)
+        response['derivatives_ready'] = _request_blob_derivatives(blob, session.user_id)
+    return response
+
+def _get_upload_session(upload_id):
+    session = UploadSession.query.get(upload_id)
+    if not session or session.user_id != current_user.id:
+        return None
+    return session
+
+@bp.route('/uploads', methods=['POST'])
+@login_required
+def init_upload():
+    """Start a resumable chunked upload"""
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename', ''))
+    kind = data.get('kind', 'media')
+    
+    try:
+        total_size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size'}), 400
+    
+    if not filename:
+        return jsonify({'error': 'Filename required'}), 400
+    
+    if kind not in ('media', 'status'):
+        return jsonify({'error': 'Invalid upload kind'}), 400
+    
+    if kind == 'media' and not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    
+    if total_size <= 0 or total_size > current_app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'error': 'Invalid upload size'}), 413
+    
+    # Idle sessions past UPLOAD_SESSION_TTL are left to gc_media.py
+    active_since = datetime.utcnow() - timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+    pending = UploadSession.query.filter(
+        UploadSession.user_id == current_user.id,
+        UploadSession.status != 'complete',
+        UploadSession.updated_at > active_since
+    ).count()
+    if pending >= current_app.config['MAX_PENDING_UPLOADS']:
+        return jsonify({'error': 'Too many uploads in progress'}), 429
+    
+    session = UploadSession(
+        id=new_upload_id(),
+        user_id=current_user.id,
+        kind=kind,
+        filename=filename,
+        total_size=total_size,
+        sha256=(data.get('sha256') or '').lower() or None
+    )
+    
+    # Content already stored: no bytes need to be sent
+    blob = media_store.acquire(session.sha256) if session.sha256 else None
+    if blob:
+        session.received = session.total_size
+        session.status = 'complete'
+        session.media_url = media_store.blob_url(blob.sha256, blob.ext)
+        db.session.add(session)
+        db.session.commit()
+        return jsonify(_completed_response(session, blob)), 200
+    
+    create_part_file(session.id)
+    db.session.add(session)
+    db.session.commit()
+    
+    response = _upload_response(session)
+    response['chunk_size'] = current_app.config['UPLOAD_CHUNK_SIZE']
+    return jsonify(response), 201
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Get the last acknowledged offset so a client can resume"""
+    session = _get_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    response = _upload_response(session)
+    if session.media_url:
+        response['url'] = session.media_url
+    return jsonify(response)
+
+@bp.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+@login_required
+def upload_chunk(upload_id):
+    """Write one chunk of a resumable upload at the given offset"""
+    session = _get_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', -1)))
+    except ValueError:
+        return jsonify({'error': 'Invalid offset'}), 400
+    
+    # Only the request whose conditional UPDATE claims the upload at this
+    # offset writes to the file, whichever worker it runs in
+    claimed_at = claim_upload(session, 'writing', offset)
+    if claimed_at is None:
+        if session.status in ('complete', 'finalizing'):
+            return jsonify({'error': 'Upload already finalized'}), 409
+        if session.status == 'writing':
+            return jsonify({'error': 'Another chunk of this upload is in progress'}), 409
+        return jsonify({'error': 'Offset mismatch', 'offset': session.received}), 409
+    
+    try:
+        received = write_chunk(session, offset, request.stream)
+    except UploadError as e:
+        release_upload(session, claimed_at)
+        response = {'error': e.message}
+        if e.offset is not None:
+            response['offset'] = e.offset
+        return jsonify(response), e.status_code
+    except BaseException:
+        release_upload(session, claimed_at)
+        raise
+    
+    if not release_upload(session, claimed_at, received=received):
+        return jsonify({'error': 'Chunk took too long', 'offset': session.received}), 409
+    return jsonify(_upload_response(session))
+
+@bp.route('/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    """Finalize a resumable upload once every byte has been received"""
+    session = _get_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    if session.status == 'complete':
+        return jsonify(_completed_response(session))
+    
+    if session.received != session.total_size:
+        return jsonify({'error': 'Upload incomplete', 'offset': session.received}), 409
+    
+    # Concurrent calls get the finished upload or a 409, never a missing file
+    claimed_at = claim_upload(session, 'finalizing', session.total_size)
+    if claimed_at is None:
+        if session.status == 'complete':
+            return jsonify(_completed_response(session))
+        return jsonify({'error': 'Upload is being written or finalized', 'offset': session.received}), 409
+    
+    try:
+        part_path, digest = finalize_upload(session)
+        
+        if session.sha256 and session.sha256 != digest:
+            os.remove(part_path)
+            db.session.delete(session)
+            db.session.commit()
+            return jsonify({'error': 'Checksum mismatch'}), 422
+        
+        blob = media_store.store_file(part_path, get_extension(session.filename), digest)
+    except BaseException:
+        db.session.rollback()
+        release_upload(session, claimed_at)
+        raise
+    
+    session.sha256 = digest
+    session.status = 'complete'
+    session.media_url = media_store.blob_url(blob.sha256, blob.ext)
+    session.updated_at = datetime.utcnow()
+    db.session.commit()
+    
+    return jsonify(_completed_response(session, blob))
+
+@bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    """Abort a pending upload and discard received bytes"""
+    session = _get_upload_session(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    if session.status == 'complete':
+        return jsonify({'success': True})
+    
+    # Never delete an upload another request is writing or finalizing
+    deleted = UploadSession.query.filter(
+        UploadSession.id == session.id,
+        UploadSession.status == 'pending'
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if not deleted:
+        return jsonify({'error': 'Upload is being written or finalized'}), 409
+    discard_upload(upload_id)
+    
+    return jsonify({'success': True})
+
+@bp.route('/presign', methods=['POST'])
+@login_required
+def presign_upload():
+    """Issue a URL so the client can upload media straight to storage"""
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename', ''))
+    sha256 = (data.get('sha256') or '').lower()
+    content_type = data.get('content_type')
+    
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size'}), 400
+    
+    if len(sha256) != 64 or not filename:
+        return jsonify({'error': 'sha256 and filename required'}), 400
+    
+    if not allowed_file(filename):
+        return jsonify({'error': 'File type not allowed'}), 400
+    
+    if size <= 0 or size > current_app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'error': 'Invalid upload size'}), 413
+    
+    # Content already stored: nothing to upload
+    blob = media_store.acquire(sha256)
+    if blob:
+        response = _blob_response(blob, filename)
+        response['upload'] = None
+        return jsonify(response)
+    
+    key = media_store.blob_key(sha256, get_extension(filename))
+    upload = get_storage().presigned_upload(
+        key, current_app.config['PRESIGNED_URL_EXPIRES'],
+        content_type=content_type, sha256=sha256, size=size
+    )
+    return jsonify({'success': True, 'sha256': sha256, 'upload': upload})
+
+@bp.route('/presign/complete', methods=['POST'])
+@login_required
+def presign_complete():
+    """Record media the client uploaded straight to storage"""
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename', ''))
+    sha256 = (data.get('sha256') or '').lower()
+    
+    try:
+        declared_size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size'}), 400
+    
+    if len(sha256) != 64 or not filename or not allowed_file(filename) or declared_size <= 0:
+        return jsonify({'error': 'sha256, filename and size required'}), 400
+    
+    blob = media_store.acquire(sha256)
+    if not blob:
+        ext = get_extension(filename)
+        storage = get_storage()
+        key = media_store.blob_key(sha256, ext)
+        size = storage.size(key)
+        if size is None:
+            return jsonify({'error': 'Upload not found in storage'}), 404
+        if size != declared_size or size > current_app.config['MAX_UPLOAD_SIZE']:
+            # Not the upload that was presigned; nothing references it yet
+            storage.delete(key)
+            return jsonify({'error': 'Stored object does not match the declared size'}), 413
+        blob = media_store.register_blob(sha256, ext, size)
+    
+    return jsonify(_blob_response(blob, filename))
+
+@bp.route('/presign/download', methods=['POST'])
+@login_required
+def presign_download():
+    """Issue a time-limited download URL for stored media"""
+    data = request.get_json() or {}
+    storage = get_storage()
+    key = storage.key_from_url(data.get('url'))
+    
+    if not key or not storage.exists(key):
+        return jsonify({'error': 'Media not found'}), 404
+    
+    expires_in = current_app.config['PRESIGNED_URL_EXPIRES']
+    return jsonify({'url': storage.presigned_download(key, expires_in), 'expires_in': expires_in})
+
+@bp.route('/storage/<token>', methods=['GET', 'PUT'])
+def storage_object(token):
+    """Serve presigned URLs issued by the local storage backend"""
+    storage = get_storage()
+    if storage.name != 'local':
+        abort(404)
+    
+    max_age = current_app.config['PRESIGNED_URL_EXPIRES']
+    
+    if request.method == 'GET':
+        claims = storage.verify_token(token, 'get', max_age)
+        if not claims or not storage.exists(claims['key']):
+            abort(404)
+        return send_file(storage.local_path(claims['key']))
+    
+    claims = storage.verify_token(token, 'put', max_age)
+    if not claims:
+        return jsonify({'error': 'Invalid or expired upload URL'}), 403
+    
+    # Same checks the S3 presigned POST policy applies: declared size and
+    # checksum. The body may exceed MAX_CONTENT_LENGTH, so read the raw input stream.
+    stream = get_input_stream(request.environ, max_content_length=current_app.config['MAX_UPLOAD_SIZE'])
+    os.makedirs(get_tmp_folder(), exist_ok=True)
+    tmp_path = os.path.join(get_tmp_folder(), f"{new_upload_id()}.put")
+    hasher = hashlib.sha256()
+    size = 0
+    with open(tmp_path, 'wb') as out:
+        for buf in iter(lambda: stream.read(STREAM_BUFFER_SIZE), b''):
+            hasher.update(buf)
+            out.write(buf)
+            size += len(buf)
+    
+    if (claims.get('size') and size != claims['size']) or \
+            (claims.get('sha256') and hasher.hexdigest() != claims['sha256']):
+        os.remove(tmp_path)
+        return jsonify({'error': 'Body does not match the presigned upload'}), 400
+    
+    storage.save(claims['key'], tmp_path)
+    return '', 200
@@ -0,0 +1,21 @@
+from flask import Blueprint, Response, request, current_app, abort
+from app import socketio
+from app import metrics
+import hmac
+
+bp = Blueprint('metrics', __name__)
+
+@bp.route('/metrics')
+def prometheus():
+    """Request, socket, AI and job metrics of this worker in Prometheus format"""
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    
+    # Bearer token (or ?token=) when METRICS_TOKEN is set
+    token = current_app.config['METRICS_TOKEN']
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip() or request.args.get('token', '')
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            abort(401)
+    
+    return Response(metrics.render(socketio), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,77 @@
+from flask import Blueprint, request, jsonify, current_app, abort, send_from_directory
+from app.profiling import profiler, valid_token, MODES
+import os
+import re
+
+bp = Blueprint('profiling', __name__, url_prefix='/profiling')
+
+PROFILE_NAME = re.compile(r'^[A-Za-z0-9_.-]+\.(?:folded|prof)$')
+
+@bp.before_request
+def require_token():
+    """Bearer token (or ?token=) matching PROFILING_TOKEN; 404 when profiling is off"""
+    if not current_app.config['PROFILING_TOKEN']:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip() or request.args.get('token', '')
+    if not valid_token(current_app, supplied):
+        abort(401)
+
+@bp.route('/')
+def index():
+    """Saved profiles of this worker's PROFILE_DIR, newest first, and the armed targets"""
+    directory = current_app.config['PROFILE_DIR']
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    profiles = []
+    for name in names:
+        if PROFILE_NAME.match(name):
+            info = os.stat(os.path.join(directory, name))
+            profiles.append({'name': name, 'size': info.st_size, 'created': info.st_mtime})
+    profiles.sort(key=lambda p: -p['created'])
+    return jsonify({'profiles': profiles, **profiler.status()})
+
+@bp.route('/<name>')
+def download(name):
+    """A saved profile: .folded collapsed stacks or .prof pstats"""
+    if not PROFILE_NAME.match(name):
+        abort(404)
+    return send_from_directory(os.path.abspath(current_app.config['PROFILE_DIR']), name,
+                               mimetype='text/plain' if name.endswith('.folded') else 'application/octet-stream')
+
+@bp.route('/arm', methods=['POST'])
+def arm():
+    """
+    Profile the next requests to an endpoint (e.g. main.index) or the next
+    Socket.IO events of a name (e.g. send_message) in this worker
+    """
+    data = request.get_json(silent=True) or {}
+    target = data.get('target')
+    mode = data.get('mode', 'sample')
+    count = data.get('count', 1)
+    if not target or mode not in MODES or not isinstance(count, int) or not 1 <= count <= 100:
+        return jsonify({'error': 'target, mode (sample or cprofile) and count (1-100) required'}), 400
+    profiler.arm(target, count, mode)
+    return jsonify({'success': True, **profiler.status()})
+
+@bp.route('/arm', methods=['DELETE'])
+def disarm():
+    """Stop profiling one armed target, or all of them"""
+    profiler.disarm((request.get_json(silent=True) or {}).get('target'))
+    return jsonify({'success': True, **profiler.status()})
+
+@bp.route('/window', methods=['POST'])
+def window():
+    """Sample every thread of this worker for a number of seconds"""
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 10))
+    except (TypeError, ValueError):
+        seconds = 0
+    if not 0 < seconds <= current_app.config['PROFILE_WINDOW_MAX']:
+        return jsonify({'error': f"seconds must be between 0 and {current_app.config['PROFILE_WINDOW_MAX']}"}), 400
+
+    future = profiler.start_window(seconds, current_app.config['PROFILE_INTERVAL'], current_app.config['PROFILE_DIR'])
+    if future is None:
+        return jsonify({'error': 'A profiling window is already running'}), 409
+    if data.get('wait'):
+        return jsonify({'success': True, 'id': future.result(timeout=seconds + 30)})
+    return jsonify({'success': True, 'seconds': seconds}), 202
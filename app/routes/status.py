@@ -1,13 +1,26 @@
 from flask import Blueprint, render_template, request, jsonify
 from flask_login import login_required, current_user
 from app import db
-from app.models import Status, StatusView
+from app.models import Status, StatusView, UploadSession
+from app import media_store
+from app.query_debug import budget
+from app.storage import get_storage, profile_pic_url
 from datetime import datetime, timedelta
 
 bp = Blueprint('status', __name__, url_prefix='/status')
 
+def viewed_ids(status_ids):
+    """IDs among status_ids the current user has viewed"""
+    if not status_ids:
+        return set()
+    return {row.status_id for row in db.session.query(StatusView.status_id).filter(
+        StatusView.status_id.in_(status_ids),
+        StatusView.user_id == current_user.id
+    )}
+
 @bp.route('/')
 @login_required
+@budget(5)
 def index():
     # Get all active statuses (not expired)
     now = datetime.utcnow()
@@ -18,12 +31,15 @@ def index():
         Status.expires_at > now
     ).order_by(Status.created_at.desc()).all()
     
-    # Get other users' statuses
-    other_statuses = Status.query.filter(
+    # Get other users' statuses, with their authors in the same query
+    other_statuses = Status.query.options(db.joinedload(Status.author)).filter(
         Status.user_id != current_user.id,
         Status.expires_at > now
     ).order_by(Status.created_at.desc()).all()
     
+    # Statuses the current user has already seen, in one query
+    seen = viewed_ids([status.id for status in other_statuses])
+    
     # Group by user
     status_users = {}
     for status in other_statuses:
@@ -35,13 +51,7 @@ def index():
             }
         status_users[status.user_id]['statuses'].append(status)
         
-        # Check if current user has seen this status
-        view = StatusView.query.filter_by(
-            status_id=status.id,
-            user_id=current_user.id
-        ).first()
-        
-        if not view:
+        if status.id not in seen:
             status_users[status.user_id]['unseen_count'] += 1
     
     return render_template('status/index.html', 
@@ -52,8 +62,8 @@ def index():
 @login_required
 def create():
     from werkzeug.utils import secure_filename
-    import os
-    from flask import current_app
+    from app.routes.media import MEDIA_VARIANTS, get_extension, get_status_media_type
+    from app.image_utils import can_process, request_derivatives
     
     content = request.form.get('content', '')
     media_type = request.form.get('media_type', 'text')
@@ -61,30 +71,28 @@ def create():
     media_url = None
     
     # Handle file upload
-    if 'media_file' in request.files:
-        file = request.files['media_file']
-        if file and file.filename:
-            # Determine media type from file
-            filename = secure_filename(file.filename)
-            file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-            
-            if file_ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
-                media_type = 'image'
-            elif file_ext in ['mp4', 'mov', 'avi', 'webm']:
-                media_type = 'video'
-            elif file_ext in ['mp3', 'wav', 'ogg', 'm4a', 'aac', 'flac']:
-                media_type = 'audio'
-            
-            # Create unique filename
-            unique_filename = f"status_{current_user.id}_{datetime.utcnow().timestamp()}_{filename}"
-            
-            # Save file
-            upload_folder = os.path.join(current_app.root_path, current_app.config['UPLOAD_FOLDER'], 'status')
-            os.makedirs(upload_folder, exist_ok=True)
-            file_path = os.path.join(upload_folder, unique_filename)
-            file.save(file_path)
-            
-            media_url = f"/static/uploads/status/{unique_filename}"
+    file = request.files.get('media_file')
+    if file and file.filename:
+        # Determine media type from file
+        filename = secure_filename(file.filename)
+        media_type = get_status_media_type(filename, media_type)
+        
+        # Store by content so re-shared media is kept once
+        blob = media_store.store_upload(file, get_extension(filename))
+        media_url = media_store.blob_url(blob.sha256, blob.ext)
+        if can_process(media_url):
+            request_derivatives(media_store.blob_key(blob.sha256, blob.ext), MEDIA_VARIANTS)
+    elif request.form.get('upload_id'):
+        # Media sent earlier through the resumable upload protocol
+        upload = UploadSession.query.get(request.form.get('upload_id'))
+        if not upload or upload.user_id != current_user.id or upload.kind != 'status':
+            return jsonify({'error': 'Upload not found'}), 404
+        if upload.status != 'complete':
+            return jsonify({'error': 'Upload incomplete'}), 409
+        media_url = upload.media_url
+        media_type = get_status_media_type(upload.filename, media_type)
+        if can_process(media_url):
+            request_derivatives(get_storage().key_from_url(media_url), MEDIA_VARIANTS)
     
     # Create status that expires in 24 hours
     expires_at = datetime.utcnow() + timedelta(hours=24)
@@ -132,6 +140,7 @@ def delete(status_id):
     if status.user_id != current_user.id:
         return jsonify({'error': 'Not authorized'}), 403
     
+    media_store.release(status.media_url)
     db.session.delete(status)
     db.session.commit()
     
@@ -139,8 +148,12 @@ def delete(status_id):
 
 @bp.route('/user/<int:user_id>', methods=['GET'])
 @login_required
+@budget(5)
 def get_user_statuses(user_id):
     """Get all active statuses for a specific user"""
+    from app.routes.media import MEDIA_VARIANTS
+    from app.image_utils import can_process, derivative_urls
+    
     now = datetime.utcnow()
     
     statuses = Status.query.filter(
@@ -148,24 +161,28 @@ def get_user_statuses(user_id):
         Status.expires_at > now
     ).order_by(Status.created_at.asc()).all()
     
+    # Views by the current user and view counts for all statuses at once
+    status_ids = [status.id for status in statuses]
+    seen = viewed_ids(status_ids)
+    view_counts = dict(db.session.query(StatusView.status_id, db.func.count(StatusView.id)).filter(
+        StatusView.status_id.in_(status_ids)
+    ).group_by(StatusView.status_id).all()) if status_ids else {}
+    
     status_data = []
     for status in statuses:
-        # Check if current user has viewed this status
-        view = StatusView.query.filter_by(
-            status_id=status.id,
-            user_id=current_user.id
-        ).first()
-        
         status_data.append({
             'id': status.id,
             'content': status.content,
             'media_type': status.media_type,
             'media_url': status.media_url,
+            # Thumbnail and preview URLs; the client falls back to media_url until they exist
+            'derivatives': derivative_urls(status.media_url, MEDIA_VARIANTS)
+                if status.media_type == 'image' and status.media_url and can_process(status.media_url) else None,
             'background_color': status.background_color,
             'created_at': status.created_at.strftime('%Y-%m-%d %H:%M:%S'),
             'expires_at': status.expires_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'viewed': view is not None,
-            'view_count': StatusView.query.filter_by(status_id=status.id).count()
+            'viewed': status.id in seen,
+            'view_count': view_counts.get(status.id, 0)
         })
     
     # Get user info
@@ -177,7 +194,8 @@ def get_user_statuses(user_id):
         'user': {
             'id': user.id,
             'username': user.username,
-            'profile_pic': user.profile_pic
+            'profile_pic': user.profile_pic,
+            'profile_pic_url': profile_pic_url(user.profile_pic)
         },
         'statuses': status_data
     })
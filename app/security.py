@@ -0,0 +1,199 @@
+"""
+Password Security for ChatSphere
+Runs the password KDF on a bounded process pool and rate limits login and
+registration attempts, so a burst of logins or a credential-stuffing run
+cannot take the CPU away from chat traffic.
+
+Limits are checked before any hashing: every login counts against the
+client IP, failed logins count against the account from that IP, and
+against a much higher ceiling for the account from all IPs, so one client
+cannot lock another user out. Hashes made with
+older parameters are upgraded to PASSWORD_HASH_METHOD on the next login.
+Limits are kept per worker process.
+"""
+from flask import current_app, has_app_context
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+import math
+import threading
+import time
+
+# Used outside an app context (scripts)
+DEFAULTS = {
+    'PASSWORD_HASH_METHOD': 'scrypt:32768:8:1',
+    'PASSWORD_HASH_WORKERS': 0,
+    'PASSWORD_HASH_QUEUE': 32,
+    'PASSWORD_HASH_TIMEOUT': 10.0
+}
+
+# Rate limiter keys kept before idle, fully refilled buckets are dropped
+MAX_BUCKETS = 100000
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool has no room or does not answer in time"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RateLimited(Exception):
+    """Raised when a client or account is over its attempt limit"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _config(name):
+    return current_app.config[name] if has_app_context() else DEFAULTS[name]
+
+_executor = None
+_slots = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+    Return the hashing process pool and its job slots, creating them on first use
+    Returns:
+        Tuple of (executor, semaphore of running plus queued jobs), or
+        (None, None) when PASSWORD_HASH_WORKERS is 0
+    """
+    global _executor, _slots
+    workers = _config('PASSWORD_HASH_WORKERS')
+    if workers <= 0:
+        return None, None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+            _slots = threading.BoundedSemaphore(workers + _config('PASSWORD_HASH_QUEUE'))
+        return _executor, _slots
+
+def _run(fn, *args):
+    executor, slots = get_executor()
+    if executor is None:
+        return fn(*args)
+    if not slots.acquire(blocking=False):
+        raise HashingBusy("Too many sign-ins in progress")
+    try:
+        future = executor.submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    # The slot is held until the hash finishes, even if the caller gave up
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=_config('PASSWORD_HASH_TIMEOUT'))
+    except FutureTimeoutError:
+        raise HashingBusy("Sign-in timed out", retry_after=5)
+
+def normalize_method(method):
+    """Method with Werkzeug's defaults filled in, as it appears in stored hashes"""
+    name, *params = method.split(':')
+    if name == 'scrypt' and not params:
+        params = ['32768', '8', '1']
+    elif name == 'pbkdf2':
+        params = (params + ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)][len(params):])[:2]
+    return ':'.join([name] + params)
+
+def hash_password(password):
+    """Hash a password with PASSWORD_HASH_METHOD on the hashing pool"""
+    return _run(generate_password_hash, password, normalize_method(_config('PASSWORD_HASH_METHOD')))
+
+def verify_password(pwhash, password):
+    """Check a password against a stored hash on the hashing pool"""
+    return _run(check_password_hash, pwhash, password)
+
+def needs_rehash(pwhash):
+    """Whether a stored hash was made with other parameters than PASSWORD_HASH_METHOD"""
+    return pwhash.split('$', 1)[0] != normalize_method(_config('PASSWORD_HASH_METHOD'))
+
+class RateLimiter:
+    """Token buckets per key: up to `limit` attempts, refilled over `window` seconds"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Key -> [tokens, last update, limit, window]
+        self._buckets = {}
+
+    def _bucket(self, key, limit, window, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune(now)
+            bucket = self._buckets[key] = [float(limit), now, limit, window]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / window)
+            bucket[1] = now
+        return bucket
+
+    def _prune(self, now):
+        full = [key for key, (tokens, last, limit, window) in self._buckets.items()
+                if tokens + (now - last) * limit / window >= limit]
+        for key in full:
+            del self._buckets[key]
+
+    def retry_after(self, key, limit, window):
+        """Seconds until key has an attempt left (0 if it has one now)"""
+        if limit <= 0:
+            return 0
+        with self._lock:
+            tokens = self._bucket(key, limit, window, time.monotonic())[0]
+        return 0 if tokens >= 1 else math.ceil((1 - tokens) * window / limit)
+
+    def hit(self, key, limit, window):
+        """Use one attempt; returns seconds to wait instead if none is left"""
+        if limit <= 0:
+            return 0
+        with self._lock:
+            bucket = self._bucket(key, limit, window, time.monotonic())
+            if bucket[0] < 1:
+                return math.ceil((1 - bucket[0]) * window / limit)
+            bucket[0] -= 1
+            return 0
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+limiter = RateLimiter()
+
+def _account_limits(ip, username):
+    """(key, limit, window) of the failed-login buckets of an account"""
+    config = current_app.config
+    account = username.lower()
+    return [(('login-account', account, ip), config['LOGIN_ACCOUNT_LIMIT'], config['LOGIN_ACCOUNT_WINDOW']),
+            (('login-account', account), config['LOGIN_ACCOUNT_CEILING'], config['LOGIN_ACCOUNT_CEILING_WINDOW'])]
+
+def check_login_allowed(ip, username):
+    """
+    Count a login attempt against the client IP, and refuse it if the IP, the
+    account from this IP or the account overall is over its limit
+    Raises:
+        RateLimited: With the seconds to wait
+    """
+    config = current_app.config
+    wait = limiter.hit(('login-ip', ip), config['LOGIN_IP_LIMIT'], config['LOGIN_IP_WINDOW'])
+    for key, limit, window in _account_limits(ip, username):
+        wait = wait or limiter.retry_after(key, limit, window)
+    if wait:
+        raise RateLimited("Too many login attempts", wait)
+
+def record_login_failure(ip, username):
+    for key, limit, window in _account_limits(ip, username):
+        limiter.hit(key, limit, window)
+
+def record_login_success(ip, username):
+    # The overall ceiling is left to refill, so a valid login from one IP
+    # does not clear failures a stuffing run made from others
+    limiter.reset(('login-account', username.lower(), ip))
+
+def check_register_allowed(ip):
+    """
+    Count a registration attempt against the client IP; called once the
+    form is valid, just before the new password is hashed
+    Raises:
+        RateLimited: With the seconds to wait
+    """
+    config = current_app.config
+    wait = limiter.hit(('register-ip', ip), config['REGISTER_IP_LIMIT'], config['REGISTER_IP_WINDOW'])
+    if wait:
+        raise RateLimited("Too many sign-ups", wait)
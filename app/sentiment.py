@@ -0,0 +1,212 @@
+"""
+Sentiment Analysis for ChatSphere
+Lexicon and rule based scorer with AI fallback for low-confidence messages
+"""
+from flask import current_app
+import logging
+import math
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Words that flip the valence of the next few words ("not good")
+NEGATIONS = {
+    'not', 'no', 'never', 'none', 'nobody', 'nothing', 'neither', 'nor', 'without',
+    'cannot', 'cant', "can't", 'dont', "don't", 'doesnt', "doesn't", 'didnt', "didn't",
+    'isnt', "isn't", 'arent', "aren't", 'wasnt', "wasn't", 'wont', "won't", 'wouldnt',
+    "wouldn't", 'shouldnt', "shouldn't", 'aint', "ain't", 'hardly'
+}
+NEGATION_SCOPE = 3
+NEGATION_FACTOR = -0.74
+
+# Degree modifiers added to (or taken from) the next word's valence
+BOOSTERS = {
+    'very': 0.293, 'really': 0.293, 'so': 0.293, 'extremely': 0.293, 'super': 0.293,
+    'totally': 0.293, 'absolutely': 0.293, 'incredibly': 0.293, 'truly': 0.293,
+    'too': 0.2, 'most': 0.293, 'such': 0.2,
+    'slightly': -0.293, 'somewhat': -0.293, 'kinda': -0.293, 'sorta': -0.293,
+    'barely': -0.293, 'little': -0.2, 'almost': -0.2
+}
+CAPS_BOOST = 0.733
+EXCLAMATION_BOOST = 0.292
+MAX_EXCLAMATIONS = 4
+# Normalizes the summed valence into a compound score in [-1, 1]
+NORMALIZATION_ALPHA = 15
+NEUTRAL_BAND = 0.05
+
+TOKEN_RE = re.compile(r":-?[()dp/]|<3|[a-z0-9']+|[^\w\s]", re.I)
+
+class SentimentScorer:
+    """
+    Scores text against a valence lexicon
+    Handles negation, degree modifiers, emphasis (CAPS, "!") and contrast
+    ("but"), and reports a confidence so callers can escalate unclear cases.
+    """
+
+    def __init__(self, lexicon_path):
+        self.lexicon = {}
+        with open(lexicon_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                term, _, valence = line.rpartition(' ')
+                self.lexicon[term.lower()] = float(valence)
+
+    def _valences(self, tokens, shouting):
+        """(index, valence) pairs for lexicon tokens after modifiers"""
+        valences = []
+        for i, token in enumerate(tokens):
+            word = token.lower()
+            valence = self.lexicon.get(word)
+            if valence is None or word in BOOSTERS:
+                continue
+
+            sign = 1 if valence > 0 else -1
+            if token.isupper() and len(token) > 1 and not shouting:
+                valence += sign * CAPS_BOOST
+
+            for distance in (1, 2):
+                if i >= distance:
+                    modifier = tokens[i - distance]
+                    boost = BOOSTERS.get(modifier.lower())
+                    if boost:
+                        if modifier.isupper() and not shouting:
+                            boost += math.copysign(CAPS_BOOST, boost)
+                        valence += sign * boost * (1 if distance == 1 else 0.95)
+
+            window = tokens[max(0, i - NEGATION_SCOPE):i]
+            if any(w.lower() in NEGATIONS or w.lower().endswith("n't") for w in window):
+                valence *= NEGATION_FACTOR
+
+            valences.append((i, valence))
+        return valences
+
+    def score(self, text):
+        """
+        Score one text
+        Returns:
+            Dict with 'sentiment', 'confidence', 'emoji' and compound 'score'
+        """
+        tokens = TOKEN_RE.findall(text)
+        words = [t for t in tokens if t.isalpha()]
+        shouting = bool(words) and all(w.isupper() for w in words if len(w) > 1)
+        valences = self._valences(tokens, shouting)
+
+        lowered = [t.lower() for t in tokens]
+        if 'but' in lowered:
+            # The clause after "but" carries the speaker's actual view
+            pivot = lowered.index('but')
+            valences = [(i, v * (0.5 if i < pivot else 1.5)) for i, v in valences]
+
+        total = sum(v for _, v in valences)
+        if total:
+            exclamations = min(text.count('!'), MAX_EXCLAMATIONS)
+            total += math.copysign(exclamations * EXCLAMATION_BOOST, total)
+        compound = total / math.sqrt(total * total + NORMALIZATION_ALPHA)
+
+        if compound >= NEUTRAL_BAND:
+            sentiment = 'positive'
+        elif compound <= -NEUTRAL_BAND:
+            sentiment = 'negative'
+        else:
+            sentiment = 'neutral'
+
+        positive = sum(v for _, v in valences if v > 0)
+        negative = -sum(v for _, v in valences if v < 0)
+        if not valences:
+            # No opinion words: short chit-chat is reliably neutral, long text may not be
+            confidence = 0.7 if len(words) <= 12 else 0.45
+        elif sentiment == 'neutral':
+            confidence = 0.4
+        else:
+            mixed = min(positive, negative) / max(positive, negative)
+            confidence = (0.5 + 0.5 * abs(compound)) * (1 - 0.5 * mixed)
+
+        return {
+            'sentiment': sentiment,
+            'confidence': round(confidence, 3),
+            'emoji': _emoji(compound),
+            'score': round(compound, 4)
+        }
+
+    def score_many(self, texts):
+        """Score a batch, computing each distinct text once"""
+        scored = {}
+        results = []
+        for text in texts:
+            key = text.strip()
+            if key not in scored:
+                scored[key] = self.score(key)
+            results.append(dict(scored[key]))
+        return results
+
+def _emoji(compound):
+    if compound >= 0.6:
+        return '😄'
+    if compound >= NEUTRAL_BAND:
+        return '🙂'
+    if compound <= -0.6:
+        return '😠'
+    if compound <= -NEUTRAL_BAND:
+        return '🙁'
+    return '😐'
+
+_scorer = None
+_scorer_path = None
+_scorer_lock = threading.Lock()
+
+def get_scorer():
+    """Scorer for the configured lexicon, loaded on first use"""
+    global _scorer, _scorer_path
+    path = current_app.config['SENTIMENT_LEXICON']
+    if _scorer is None or _scorer_path != path:
+        with _scorer_lock:
+            if _scorer is None or _scorer_path != path:
+                _scorer = SentimentScorer(path)
+                _scorer_path = path
+    return _scorer
+
+def analyze_many(texts):
+    """
+    Sentiment for a batch of messages
+    Scored locally; messages below SENTIMENT_CONFIDENCE_THRESHOLD are sent
+    to the AI together in one call (cached verdicts are reused). If the AI
+    is unavailable the local result is kept.
+    Args:
+        texts: List of message texts
+    Returns:
+        List of dicts with 'sentiment', 'confidence', 'emoji' and 'source'
+    """
+    from app.ai_jobs import run_job, QueueFull, DeadlineExceeded, AIUnavailable
+    from app.ai_utils import analyze_sentiment, analyze_sentiment_batch
+
+    threshold = current_app.config['SENTIMENT_CONFIDENCE_THRESHOLD']
+    results = get_scorer().score_many(texts)
+    uncertain = {}
+    for i, (text, result) in enumerate(zip(texts, results)):
+        result['source'] = 'local'
+        if result['confidence'] >= threshold or not text.strip():
+            continue
+        found, value = analyze_sentiment.cached_result(text)
+        if found:
+            value['source'] = 'cache'
+            results[i] = value
+        else:
+            uncertain.setdefault(text.strip(), []).append(i)
+
+    if uncertain:
+        pending = list(uncertain)
+        try:
+            verdicts = run_job('sentiment', analyze_sentiment_batch, pending)
+        except (QueueFull, DeadlineExceeded, AIUnavailable) as e:
+            logger.warning("Sentiment fallback skipped: %s", e)
+            verdicts = [None] * len(pending)
+        for text, verdict in zip(pending, verdicts):
+            if verdict is None:
+                continue
+            analyze_sentiment.store_result(verdict, text)
+            for i in uncertain[text]:
+                results[i] = dict(verdict, source='ai')
+    return results
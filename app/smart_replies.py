@@ -0,0 +1,169 @@
+"""
+Speculative Smart Replies for ChatSphere
+Computes reply suggestions in the background when a message arrives for an
+online user, cached under the conversation's newest (head) message id
+"""
+from flask import current_app
+from app import db
+from app.models import Message, User, group_members
+from app.ai_cache import ai_cache, make_key
+import threading
+
+HISTORY_MESSAGES = 10
+
+# Conversation key -> Future of the precompute job for its current head; at
+# most one job per conversation is queued, retargeted as new messages arrive
+_pending = {}
+_pending_lock = threading.Lock()
+
+def conversation(chat_type, user_id, chat_id):
+    """
+    Key and message filter for a conversation as seen by user_id
+    Returns:
+        Tuple of (conversation_key, SQLAlchemy filter on Message)
+    """
+    chat_id = int(chat_id)
+    if chat_type == 'user':
+        low, high = sorted((user_id, chat_id))
+        return f"direct:{low}:{high}", db.or_(
+            db.and_(Message.sender_id == user_id, Message.recipient_id == chat_id),
+            db.and_(Message.sender_id == chat_id, Message.recipient_id == user_id)
+        )
+    return f"group:{chat_id}", Message.group_id == chat_id
+
+def recent_history(conversation_filter, limit=HISTORY_MESSAGES):
+    """
+    Last messages of a conversation with sender names, in one query
+    Returns:
+        Tuple of (head message id or None, list of text message dicts oldest first)
+    """
+    rows = db.session.query(Message.id, Message.content, Message.message_type, User.username).join(
+        User, User.id == Message.sender_id
+    ).filter(conversation_filter).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    head_id = rows[0].id if rows else None
+    history = [{'sender': username, 'content': content}
+               for _, content, message_type, username in reversed(rows) if message_type == 'text']
+    return head_id, history
+
+def _key(conversation_key, head_id):
+    from app.ai_utils import DEFAULT_MODEL
+    return make_key('smart_replies', conversation_key, {'head_id': head_id}, DEFAULT_MODEL)
+
+def cached_replies(conversation_key, head_id):
+    """Suggestions computed for this head message, as (found, replies)"""
+    if head_id is None or not ai_cache.configure(current_app.config):
+        return False, None
+    return ai_cache.get(_key(conversation_key, head_id), 'smart_replies')
+
+def store_replies(conversation_key, head_id, replies):
+    """Cache suggestions for a head message; fallback suggestions are not stored"""
+    from app.ai_utils import SMART_REPLY_FALLBACK
+
+    if head_id is not None and replies != SMART_REPLY_FALLBACK and ai_cache.configure(current_app.config):
+        ai_cache.set(_key(conversation_key, head_id), replies)
+
+def pending(conversation_key, head_id):
+    """Future of a precompute job still running for this head message, or None"""
+    with _pending_lock:
+        future = _pending.get(conversation_key)
+        if future is not None and future.head_id == head_id and not future.done():
+            return future
+    return None
+
+def _recipient_online(message):
+    if message.group_id:
+        return db.session.query(User.id).join(
+            group_members, group_members.c.user_id == User.id
+        ).filter(
+            group_members.c.group_id == message.group_id,
+            User.id != message.sender_id,
+            User.is_online == True
+        ).first() is not None
+    recipient = User.query.get(message.recipient_id) if message.recipient_id else None
+    return bool(recipient and recipient.is_online)
+
+def precompute(message):
+    """
+    Queue smart replies for a just-sent message if someone online will read it
+    The new message becomes the conversation's head, so suggestions cached
+    for earlier heads are no longer served. A job still queued for an
+    earlier head is retargeted at the new one instead of queueing another.
+    Runs as a background job, not counted against the sender; skipped
+    silently when the AI queue is busy.
+    Args:
+        message: Saved Message
+    """
+    from app.ai_jobs import submit_job, QueueFull
+
+    config = current_app.config
+    if not config['SMART_REPLIES_PRECOMPUTE'] or message.message_type != 'text':
+        return
+    if not ai_cache.configure(config) or not _recipient_online(message):
+        return
+
+    if message.group_id:
+        chat_type, chat_id = 'group', message.group_id
+        room = f'group_{message.group_id}'
+        payload_chat_id = message.group_id
+    else:
+        chat_type, chat_id = 'user', message.recipient_id
+        room = f'user_{message.recipient_id}'
+        payload_chat_id = message.sender_id
+    conversation_key, _ = conversation(chat_type, message.sender_id, chat_id)
+    target = [chat_type, message.sender_id, chat_id, message.id, room, payload_chat_id]
+
+    with _pending_lock:
+        future = _pending.get(conversation_key)
+        if future is not None and not future.running() and not future.done():
+            # The job reads its target under this lock once it starts running
+            future.target[:] = target
+            future.head_id = message.id
+            return
+
+    try:
+        future = submit_job('smart_replies', _precompute_job, target)
+    except QueueFull:
+        return
+    future.target = target
+    future.head_id = message.id
+    with _pending_lock:
+        _pending[conversation_key] = future
+    future.add_done_callback(lambda f: _forget(conversation_key, f))
+
+def _forget(conversation_key, future):
+    with _pending_lock:
+        if _pending.get(conversation_key) is future:
+            del _pending[conversation_key]
+
+def _precompute_job(target):
+    """
+    AI job: compute, cache and push suggestions for a head message
+    Args:
+        target: [chat_type, sender_id, chat_id, head_id, room, payload_chat_id],
+            updated in place while the job is queued
+    """
+    from app import socketio
+    from app.ai_utils import generate_smart_replies
+
+    with _pending_lock:
+        chat_type, sender_id, chat_id, head_id, room, payload_chat_id = target
+    conversation_key, conversation_filter = conversation(chat_type, sender_id, chat_id)
+    current_head, history = recent_history(conversation_filter)
+    db.session.close()
+    if current_head != head_id:
+        # A newer message arrived while queued; its own job will cover it
+        return None
+
+    found, replies = cached_replies(conversation_key, head_id)
+    if not found:
+        replies = generate_smart_replies(history)
+        store_replies(conversation_key, head_id, replies)
+
+    socketio.emit('smart_replies', {
+        'chat_type': chat_type,
+        'chat_id': payload_chat_id,
+        'head_id': head_id,
+        'sender_id': sender_id,
+        'replies': replies
+    }, room=room)
+    return replies
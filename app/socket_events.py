@@ -2,8 +2,14 @@ from flask_socketio import emit, join_room, leave_room
 from flask_login import current_user
 from app import socketio, db
 from app.models import Message
+from app.storage import profile_pic_url
+from app.autocomplete import learn_message
+from app.smart_replies import precompute as precompute_smart_replies
+from app.transcripts import on_message_created as queue_transcript
 from datetime import datetime
-import traceback
+import logging
+
+logger = logging.getLogger(__name__)
 
 @socketio.on('connect')
 def handle_connect():
@@ -35,8 +41,6 @@ def handle_leave_chat(data):
 @socketio.on('send_message')
 def handle_send_message(data):
     try:
-        print(f"Received send_message event from user {current_user.id}: {data}")
-        
         recipient_id = data.get('recipient_id')
         group_id = data.get('group_id')
         content = data.get('content')
@@ -44,7 +48,7 @@ def handle_send_message(data):
         media_url = data.get('media_url')
         
         if not content and not media_url:
-            print("Error: No content or media_url provided")
+            logger.info("Message rejected: no content", extra={'event': 'socket.send_message', 'sender_id': current_user.id})
             emit('error', {'message': 'No content provided'})
             return
         
@@ -62,7 +66,9 @@ def handle_send_message(data):
         db.session.add(message)
         db.session.commit()
         
-        print(f"Message saved to database with ID: {message.id}")
+        if message_type == 'text' and content:
+            learn_message(current_user.id, content)
+        queue_transcript(message)
         
         # Prepare message data
         message_data = {
@@ -82,24 +88,24 @@ def handle_send_message(data):
         # Emit to appropriate room
         if group_id:
             room = f'group_{group_id}'
-            print(f"Emitting to group room: {room}")
             emit('new_message', message_data, room=room, include_self=True)
         else:
             # Send to recipient
             room = f'user_{recipient_id}'
-            print(f"Emitting to recipient room: {room}")
             emit('new_message', message_data, room=room)
             
             # Send to sender (for multi-device support)
             room_sender = f'user_{current_user.id}'
-            print(f"Emitting to sender room: {room_sender}")
             emit('new_message', message_data, room=room_sender)
         
-        print("Message sent successfully!")
+        logger.debug("Message sent", extra={'event': 'socket.send_message', 'message_id': message.id,
+                                            'sender_id': current_user.id, 'room': room,
+                                            'message_type': message_type})
+        
+        precompute_smart_replies(message)
         
     except Exception as e:
-        print(f"Error in handle_send_message: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error in handle_send_message", extra={'event': 'socket.send_message'})
         emit('error', {'message': str(e)})
 
 @socketio.on('typing')
@@ -149,6 +155,7 @@ def handle_start_call(data):
         'caller_id': current_user.id,
         'caller_name': current_user.username,
         'caller_pic': current_user.profile_pic,
+        'caller_pic_url': profile_pic_url(current_user.profile_pic),
         'call_type': call_type,
         'room_id': data.get('room_id')
     }
@@ -168,6 +175,7 @@ def handle_call_initiate(data):
         'caller_id': current_user.id,
         'caller_name': current_user.username,
         'caller_pic': current_user.profile_pic,
+        'caller_pic_url': profile_pic_url(current_user.profile_pic),
         'call_type': call_type,
         'room_id': room_id,
         'offer': offer
@@ -319,5 +327,4 @@ def handle_log_call(data):
         emit('call_logged', {'message_id': message.id})
         
     except Exception as e:
-        print(f"Error logging call: {str(e)}")
-        print(traceback.format_exc())
+        logger.exception("Error logging call", extra={'event': 'socket.log_call'})
@@ -0,0 +1,280 @@
+"""
+Storage Backends for ChatSphere
+Local filesystem and S3-compatible drivers for uploaded files
+"""
+from flask import current_app, url_for
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import importlib.util
+import os
+import shutil
+import tempfile
+import threading
+
+class StorageError(Exception):
+    """Raised when a storage operation fails"""
+
+class LocalStorage:
+    """
+    Stores files under the upload folder and serves them as static files
+    Presigned URLs are signed tokens handled by the media.storage_object route.
+    """
+    name = 'local'
+
+    def __init__(self, root, url_prefix, secret_key):
+        self.root = root
+        self.url_prefix = url_prefix.rstrip('/')
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='chatsphere-storage')
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, *key.split('/')))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise StorageError(f"Invalid storage key: {key}")
+        return path
+
+    def local_path(self, key):
+        """Filesystem path of a key; None for remote backends"""
+        return self._path(key)
+
+    def save(self, key, src_path):
+        """Store a local file under key (the source file is consumed)"""
+        dest_path = self._path(key)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(src_path, dest_path)
+
+    def save_stream(self, key, stream, buffer_size=64 * 1024):
+        """Store a file-like object under key"""
+        dest_path = self._path(key)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as out:
+            shutil.copyfileobj(stream, out, buffer_size)
+        os.replace(tmp_path, dest_path)
+
+    def open(self, key):
+        """Open a stored file for binary reading"""
+        return open(self._path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def size(self, key):
+        """Size in bytes, or None if the key does not exist"""
+        try:
+            return os.path.getsize(self._path(key))
+        except OSError:
+            return None
+
+    def delete(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def list(self, prefix):
+        """Keys starting with prefix (within a single folder)"""
+        folder, _, name_prefix = prefix.rpartition('/')
+        try:
+            names = os.listdir(self._path(folder))
+        except OSError:
+            return []
+        return [f"{folder}/{name}" for name in names if name.startswith(name_prefix)]
+
+    def url(self, key):
+        """Stable public URL stored in the database"""
+        return f"{self.url_prefix}/{key}"
+
+    def key_from_url(self, url):
+        """Reverse of url(); None for URLs outside this storage"""
+        if url and url.startswith(self.url_prefix + '/'):
+            return url[len(self.url_prefix) + 1:]
+        return None
+
+    def presigned_upload(self, key, expires_in, content_type=None, sha256=None, size=None):
+        """
+        Create a URL the client can PUT the file body to directly
+        Returns:
+            Dict with 'url', 'method', 'fields' (form fields for a POST,
+            empty here) and 'headers' for the client
+        """
+        token = self.serializer.dumps({'key': key, 'op': 'put', 'sha256': sha256, 'size': size})
+        headers = {'Content-Type': content_type} if content_type else {}
+        return {
+            'url': url_for('media.storage_object', token=token, _external=True),
+            'method': 'PUT',
+            'fields': {},
+            'headers': headers,
+            'expires_in': expires_in
+        }
+
+    def presigned_download(self, key, expires_in):
+        """Create a time-limited download URL"""
+        token = self.serializer.dumps({'key': key, 'op': 'get'})
+        return url_for('media.storage_object', token=token, _external=True)
+
+    def verify_token(self, token, op, max_age):
+        """Decode a presigned token; returns its claims or None"""
+        try:
+            claims = self.serializer.loads(token, max_age=max_age)
+        except (BadSignature, SignatureExpired):
+            return None
+        if claims.get('op') != op:
+            return None
+        return claims
+
+class S3Storage:
+    """
+    Stores files in an S3-compatible bucket (AWS S3, MinIO, moto server)
+    Set S3_ENDPOINT_URL to point at a local stand-in for development and tests.
+    """
+    name = 's3'
+
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, public_url=None):
+        if importlib.util.find_spec('boto3') is None:
+            raise StorageError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)")
+
+        self.bucket = bucket
+        self._client_settings = dict(
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None
+        )
+        self._client = None
+        self._client_lock = threading.Lock()
+        if public_url:
+            self.url_prefix = public_url.rstrip('/')
+        elif endpoint_url:
+            self.url_prefix = f"{endpoint_url.rstrip('/')}/{bucket}"
+        else:
+            self.url_prefix = f"https://{bucket}.s3.amazonaws.com"
+
+    @property
+    def client(self):
+        """boto3 client, built on first use so importing boto3 stays out of startup"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+                    self._client = boto3.client('s3', config=Config(signature_version='s3v4'), **self._client_settings)
+        return self._client
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def local_path(self, key):
+        return None
+
+    def save(self, key, src_path):
+        self.client.upload_file(src_path, self.bucket, key)
+        os.remove(src_path)
+
+    def save_stream(self, key, stream, buffer_size=64 * 1024):
+        self.client.upload_fileobj(stream, self.bucket, key)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def size(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, prefix):
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+        return keys
+
+    def url(self, key):
+        return f"{self.url_prefix}/{key}"
+
+    def key_from_url(self, url):
+        if url and url.startswith(self.url_prefix + '/'):
+            return url[len(self.url_prefix) + 1:]
+        return None
+
+    def presigned_upload(self, key, expires_in, content_type=None, sha256=None, size=None):
+        """
+        Presigned POST: unlike a presigned PUT URL, its policy binds the body
+        size (content-length-range) as well as the checksum
+        """
+        fields = {}
+        conditions = []
+        if size:
+            conditions.append(['content-length-range', size, size])
+        if content_type:
+            fields['Content-Type'] = content_type
+            conditions.append({'Content-Type': content_type})
+        if sha256:
+            # S3 rejects the upload if the body does not match the declared hash
+            import base64
+            checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+            fields['x-amz-checksum-sha256'] = checksum
+            conditions.append({'x-amz-checksum-sha256': checksum})
+        post = self.client.generate_presigned_post(
+            self.bucket, key, Fields=fields, Conditions=conditions, ExpiresIn=expires_in
+        )
+        return {'url': post['url'], 'method': 'POST', 'fields': post['fields'], 'headers': {},
+                'expires_in': expires_in}
+
+    def presigned_download(self, key, expires_in):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=expires_in
+        )
+
+def create_storage(app):
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalStorage(
+            os.path.join(app.root_path, app.config['UPLOAD_FOLDER']),
+            '/static/uploads',
+            app.config['SECRET_KEY']
+        )
+    if backend == 's3':
+        return S3Storage(
+            app.config['S3_BUCKET'],
+            endpoint_url=app.config['S3_ENDPOINT_URL'],
+            region=app.config['S3_REGION'],
+            access_key=app.config['S3_ACCESS_KEY_ID'],
+            secret_key=app.config['S3_SECRET_ACCESS_KEY'],
+            public_url=app.config['S3_PUBLIC_URL']
+        )
+    raise StorageError(f"Unknown STORAGE_BACKEND: {backend}")
+
+def get_storage():
+    """Storage backend of the current app"""
+    return current_app.extensions['storage']
+
+def fetch_to_tempfile(storage, key, suffix=''):
+    """
+    Get a local file for a stored key, downloading it if the backend is remote
+    Returns:
+        Tuple of (path, is_temporary)
+    """
+    path = storage.local_path(key)
+    if path:
+        return path, False
+    fd, tmp_path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, 'wb') as out, storage.open(key) as src:
+        shutil.copyfileobj(src, out)
+    return tmp_path, True
+
+def profile_pic_url(profile_pic):
+    """Template filter: URL of a profile picture
+    Uploaded pictures live in storage; bundled defaults are static files."""
+    if profile_pic and profile_pic.startswith('profile_'):
+        return get_storage().url(f"profiles/{profile_pic}")
+    return url_for('static', filename=f"uploads/profiles/{profile_pic}")
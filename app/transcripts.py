@@ -0,0 +1,133 @@
+"""
+Voice Message Transcripts for ChatSphere
+Transcribes voice and audio messages in the background when they are sent
+and keeps the result in the transcript table, one row per message
+"""
+from flask import current_app
+from app import db
+from app.models import Message, Transcript
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
+import threading
+
+AUDIO_TYPES = ('voice', 'audio')
+TRANSCRIPTION_ERROR = 'Transcription error:'
+
+# Message id -> Future of the transcription job running for it
+_pending = {}
+_pending_lock = threading.Lock()
+
+def message_rooms(message):
+    """Socket rooms of everyone in a message's conversation"""
+    if message.group_id:
+        return [f'group_{message.group_id}']
+    return [f'user_{message.sender_id}', f'user_{message.recipient_id}']
+
+def queue_transcription(message, user_id=None):
+    """
+    Queue a transcription job for a voice or audio message
+    Returns:
+        Future of the job (shared with any job already running), or None if
+        the message has no audio or the AI queue is full
+    """
+    from app.ai_jobs import submit_job, QueueFull
+
+    if message.message_type not in AUDIO_TYPES or not message.media_url:
+        return None
+
+    with _pending_lock:
+        future = _pending.get(message.id)
+    if future is not None:
+        return future
+
+    # Submitted outside the lock: the scheduler may complete futures, and so
+    # run _forget, while holding its own lock
+    try:
+        future = submit_job('transcribe', transcribe_message, message.id, user_id=user_id)
+    except QueueFull:
+        return None
+    with _pending_lock:
+        existing = _pending.setdefault(message.id, future)
+    if existing is not future:
+        future.cancel()
+        return existing
+    future.add_done_callback(lambda f: _forget(message.id, f))
+    return future
+
+def _forget(message_id, future):
+    with _pending_lock:
+        if _pending.get(message_id) is future:
+            del _pending[message_id]
+
+def on_message_created(message):
+    """
+    Hook for new messages: start transcribing voice notes right away, as a
+    background job not counted against the sender
+    """
+    if current_app.config['TRANSCRIBE_ON_SEND']:
+        queue_transcription(message)
+
+def _reusable_text(message):
+    """Transcript of another message with the same audio file, if any"""
+    row = db.session.query(Transcript.text).join(Message, Message.id == Transcript.message_id).filter(
+        Message.media_url == message.media_url,
+        Transcript.status == 'done'
+    ).first()
+    return row.text if row else None
+
+def transcribe_message(message_id):
+    """
+    AI job: transcribe a message's audio and store the transcript
+    Uploads with the same content share one stored file, so an existing
+    transcript for the same file is copied instead of calling Whisper.
+    Emits 'transcript_ready' to the conversation when done.
+    Returns:
+        Dict with 'status' and 'text' (or 'error')
+    """
+    from app import socketio
+    from app.ai_utils import transcribe_audio
+    from app.storage import get_storage
+
+    message = Message.query.get(message_id)
+    if message is None:
+        return {'status': 'failed', 'error': 'Message not found'}
+
+    transcript = message.transcript
+    if transcript is None:
+        transcript = Transcript(message_id=message.id)
+        db.session.add(transcript)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created it first
+            db.session.rollback()
+            transcript = Transcript.query.filter_by(message_id=message.id).first()
+    if transcript.status == 'done':
+        return {'status': 'done', 'text': transcript.text}
+
+    text = _reusable_text(message)
+    if text is None:
+        storage = get_storage()
+        key = storage.key_from_url(message.media_url)
+        if key is None or not storage.exists(key):
+            text = f"{TRANSCRIPTION_ERROR} Audio file not found"
+        else:
+            # Release the database connection during the upload
+            db.session.commit()
+            text = transcribe_audio(key)
+
+    if text.startswith(TRANSCRIPTION_ERROR):
+        transcript.status = 'failed'
+        transcript.error = text[len(TRANSCRIPTION_ERROR):].strip()[:255]
+    else:
+        transcript.status = 'done'
+        transcript.text = text
+        transcript.error = None
+    transcript.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    result = {'status': transcript.status, 'text': transcript.text} if transcript.status == 'done' \
+        else {'status': 'failed', 'error': transcript.error}
+    for room in message_rooms(message):
+        socketio.emit('transcript_ready', dict(result, message_id=message.id), room=room)
+    return result
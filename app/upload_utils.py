@@ -0,0 +1,193 @@
+"""
+Upload Utilities for ChatSphere
+Handles resumable chunked uploads for media and status files
+"""
+from flask import current_app
+from app import db
+from app.models import UploadSession
+from datetime import datetime, timedelta
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+# Size of each read from the request stream while writing a chunk
+STREAM_BUFFER_SIZE = 64 * 1024
+
+# States of an upload held by one request; a 'writing' claim older than
+# WRITE_CLAIM_TIMEOUT is taken to belong to a worker that died mid-chunk
+CLAIMED_STATES = ('writing', 'finalizing')
+WRITE_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+# Running SHA-256 state per upload: {upload_id: (hasher, hashed_offset, last write)}
+# Only valid within this process; finalize falls back to rehashing from disk.
+# Entries idle for longer than UPLOAD_SESSION_TTL are dropped.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+class UploadError(Exception):
+    """Raised when a chunk cannot be accepted"""
+    def __init__(self, message, status_code=400, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.offset = offset
+
+def new_upload_id():
+    """Generate a new upload session id"""
+    return uuid.uuid4().hex
+
+def get_tmp_folder():
+    """Folder holding partial uploads"""
+    return os.path.join(current_app.root_path, current_app.config['UPLOAD_FOLDER'], 'tmp')
+
+def get_part_path(upload_id):
+    """Path of the partial file for an upload session"""
+    return os.path.join(get_tmp_folder(), f"{upload_id}.part")
+
+def create_part_file(upload_id):
+    """Create the empty partial file for a new upload session"""
+    os.makedirs(get_tmp_folder(), exist_ok=True)
+    open(get_part_path(upload_id), 'wb').close()
+    now = time.monotonic()
+    idle_since = now - current_app.config['UPLOAD_SESSION_TTL']
+    with _hashers_lock:
+        for stale in [key for key, (_, _, touched) in _hashers.items() if touched < idle_since]:
+            del _hashers[stale]
+        _hashers[upload_id] = (hashlib.sha256(), 0, now)
+
+def claim_upload(session, status, offset=None):
+    """
+    Take a pending upload for one request with a conditional UPDATE, so no
+    other request in any worker writes or finalizes it at the same time
+    Args:
+        session: UploadSession to claim; reloaded afterwards either way
+        status: 'writing' for a chunk, 'finalizing' to complete it
+        offset: Offset the upload must be at (chunks only)
+    Returns:
+        Claim time to pass to release_upload, or None if the upload was
+        not pending (or not at offset)
+    """
+    now = datetime.utcnow()
+    claimable = UploadSession.status == 'pending'
+    if status == 'writing':
+        claimable = db.or_(claimable, db.and_(
+            UploadSession.status == 'writing',
+            UploadSession.updated_at < now - WRITE_CLAIM_TIMEOUT
+        ))
+    query = UploadSession.query.filter(UploadSession.id == session.id, claimable)
+    if offset is not None:
+        query = query.filter(UploadSession.received == offset)
+    claimed = query.update({UploadSession.status: status, UploadSession.updated_at: now},
+                           synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(session)
+    return now if claimed else None
+
+def release_upload(session, claimed_at, status='pending', **values):
+    """
+    Give up a claim, storing the upload's new state
+    Returns:
+        False if the claim had expired and another request took the upload
+    """
+    values.update(status=status, updated_at=datetime.utcnow())
+    released = UploadSession.query.filter(
+        UploadSession.id == session.id,
+        UploadSession.status.in_(CLAIMED_STATES),
+        UploadSession.updated_at == claimed_at
+    ).update({getattr(UploadSession, name): value for name, value in values.items()},
+             synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(session)
+    return released == 1
+
+def write_chunk(session, offset, stream):
+    """
+    Append a chunk from a request stream to the partial file
+    Call with the upload claimed (claim_upload), so no other chunk is
+    written to the same file at the same time.
+    Args:
+        session: UploadSession being written
+        offset: Byte offset the client claims this chunk starts at
+        stream: File-like request body
+    Returns:
+        New acknowledged offset
+    """
+    if offset != session.received:
+        raise UploadError('Offset mismatch', 409, offset=session.received)
+
+    part_path = get_part_path(session.id)
+    if not os.path.exists(part_path):
+        raise UploadError('Upload session has no data file', 410)
+
+    with _hashers_lock:
+        hasher, hashed_offset, _ = _hashers.get(session.id, (None, None, None))
+    if hashed_offset != offset:
+        hasher = None
+
+    written = 0
+    try:
+        with open(part_path, 'r+b') as part:
+            # Drop any bytes past the acknowledged offset from an interrupted chunk
+            part.truncate(offset)
+            part.seek(offset)
+            while True:
+                buf = stream.read(STREAM_BUFFER_SIZE)
+                if not buf:
+                    break
+                if offset + written + len(buf) > session.total_size:
+                    part.truncate(offset)
+                    raise UploadError('Chunk exceeds declared upload size', 413, offset=offset)
+                part.write(buf)
+                if hasher is not None:
+                    hasher.update(buf)
+                written += len(buf)
+    except BaseException:
+        # The running hash now covers bytes that were never acknowledged
+        with _hashers_lock:
+            _hashers.pop(session.id, None)
+        raise
+
+    new_offset = offset + written
+    with _hashers_lock:
+        if hasher is not None:
+            _hashers[session.id] = (hasher, new_offset, time.monotonic())
+        else:
+            _hashers.pop(session.id, None)
+    return new_offset
+
+def file_sha256(path):
+    """Hash a file from disk in constant memory"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(STREAM_BUFFER_SIZE), b''):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+def finalize_upload(session):
+    """
+    Close out a fully received upload
+    Args:
+        session: UploadSession with all bytes received
+    Returns:
+        Tuple of (path of the complete partial file, SHA-256 hex digest)
+    """
+    part_path = get_part_path(session.id)
+    with _hashers_lock:
+        hasher, hashed_offset, _ = _hashers.pop(session.id, (None, None, None))
+
+    if hasher is not None and hashed_offset == session.total_size:
+        digest = hasher.hexdigest()
+    else:
+        digest = file_sha256(part_path)
+
+    return part_path, digest
+
+def discard_upload(upload_id):
+    """Remove the partial file and hash state of an upload session"""
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+    part_path = get_part_path(upload_id)
+    if os.path.exists(part_path):
+        os.remove(part_path)
@@ -0,0 +1,159 @@
+"""
+Blocking-Call Watchdog for ChatSphere
+Detects when the eventlet or gevent hub is blocked by synchronous code.
+
+Under a cooperative worker every socket of the process shares one OS thread,
+so a synchronous Groq call, Pillow resize or slow commit stalls all of them.
+A heartbeat task on the hub records a timestamp every WATCHDOG_INTERVAL
+seconds; a native OS thread, which keeps running while the hub is blocked,
+notices when the heartbeat is WATCHDOG_THRESHOLD seconds late and captures
+the stack the hub thread is executing - the blocking call.
+
+Each stall is logged with its stack and counted per code location (the
+innermost app frame) in chatsphere_watchdog_stalls_total and
+chatsphere_watchdog_stall_seconds_total on /metrics.
+
+In threading mode there is no hub to block, so the watchdog stays off. A
+heartbeat can also be late on a busy hub without one blocking call; keep
+the threshold well above a normal handler's run time.
+"""
+import logging
+import os
+import sys
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+COOPERATIVE_MODES = ('eventlet', 'gevent', 'gevent_uwsgi')
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(APP_ROOT)
+
+# Frames of the blocking stack included in the log record
+STACK_LIMIT = 20
+
+def native_primitives(async_mode):
+    """
+    start_new_thread, get_ident and sleep as they were before monkey patching
+    Returns:
+        Tuple of the three functions
+    """
+    if async_mode == 'eventlet':
+        from eventlet import patcher
+        thread, clock = patcher.original('_thread'), patcher.original('time')
+        return thread.start_new_thread, thread.get_ident, clock.sleep
+    from gevent import monkey
+    start_new_thread, get_ident = monkey.get_original('_thread', ['start_new_thread', 'get_ident'])
+    return start_new_thread, get_ident, monkey.get_original('time', 'sleep')
+
+def blocking_location(frame):
+    """'path:line in function' of the innermost app frame, else of the innermost frame"""
+    innermost = frame
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(APP_ROOT) and not frame.f_code.co_filename.endswith('watchdog.py'):
+            break
+        frame = frame.f_back
+    frame = frame or innermost
+    filename = frame.f_code.co_filename
+    if filename.startswith(PROJECT_ROOT):
+        filename = filename[len(PROJECT_ROOT) + 1:]
+    return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+class Watchdog:
+    """
+    Heartbeat on the hub plus a native monitor thread
+    Args:
+        socketio: The Flask-SocketIO instance, for cooperative tasks and sleep
+        threshold: Seconds of heartbeat delay reported as a stall
+        interval: Seconds between heartbeats
+    """
+
+    def __init__(self, socketio, threshold, interval):
+        self.socketio = socketio
+        self.threshold = threshold
+        self.interval = interval
+        self.start_native, self.native_ident, self.native_sleep = native_primitives(socketio.async_mode)
+        self.hub_thread = None
+        self.last_beat = time.monotonic()
+        self.generation = 0
+        # Location -> [stalls, seconds blocked]
+        self.stalls = {}
+
+    def start(self):
+        """Start the heartbeat and monitor; after a fork, call again to replace them"""
+        self.generation += 1
+        self.last_beat = time.monotonic()
+        self.socketio.start_background_task(self._heartbeat, self.generation)
+        self.start_native(self._monitor, (self.generation,))
+
+    def _heartbeat(self, generation):
+        self.hub_thread = self.native_ident()
+        while generation == self.generation:
+            self.last_beat = time.monotonic()
+            self.socketio.sleep(self.interval)
+
+    def _monitor(self, generation):
+        stall = None
+        while generation == self.generation:
+            self.native_sleep(self.interval)
+            beat = self.last_beat
+            if stall is None:
+                lag = time.monotonic() - beat
+                if lag > self.threshold and self.hub_thread is not None:
+                    stall = (beat, self._report(lag))
+            elif beat != stall[0]:
+                # The heartbeat is back: it was due one interval after the last beat
+                self._record(stall[1], max(beat - stall[0] - self.interval, self.threshold))
+                stall = None
+
+    def _report(self, lag):
+        frame = sys._current_frames().get(self.hub_thread)
+        if frame is None:
+            return 'unknown'
+        location = blocking_location(frame)
+        stack = ''.join(traceback.format_stack(frame)[-STACK_LIMIT:])
+        logger.warning("Event loop blocked for %.0f ms at %s\n%s", lag * 1000, location, stack,
+                       extra={'event': 'watchdog.stall', 'location': location})
+        return location
+
+    def _record(self, location, seconds):
+        from app.metrics import registry
+
+        entry = self.stalls.setdefault(location, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        labels = (('location', location),)
+        registry.inc('chatsphere_watchdog_stalls_total', labels)
+        registry.inc('chatsphere_watchdog_stall_seconds_total', labels, seconds)
+
+    def report(self):
+        """Stall counts and blocked seconds per location, worst first"""
+        return sorted(({'location': location, 'stalls': count, 'seconds': round(seconds, 3)}
+                       for location, (count, seconds) in self.stalls.items()),
+                      key=lambda entry: -entry['seconds'])
+
+watchdog = None
+
+def init_app(app, socketio):
+    """Start the watchdog under eventlet or gevent unless WATCHDOG=false"""
+    global watchdog
+
+    mode = app.config['WATCHDOG']
+    if mode == 'false' or watchdog is not None:
+        return
+    if socketio.async_mode not in COOPERATIVE_MODES:
+        if mode == 'true':
+            logger.info("Watchdog disabled: Socket.IO runs in %s mode, not on a cooperative hub", socketio.async_mode)
+        return
+
+    watchdog = Watchdog(socketio, app.config['WATCHDOG_THRESHOLD'], app.config['WATCHDOG_INTERVAL'])
+    watchdog.start()
+
+def restart_after_fork():
+    """
+    Start the watchdog again in a server worker forked from a preloaded master,
+    which does not inherit its threads (see post_fork in gunicorn.conf.py)
+    """
+    if watchdog is not None:
+        watchdog.start()
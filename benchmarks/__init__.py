@@ -0,0 +1,4 @@
+"""
+Benchmarks for ChatSphere
+Load generators and local stand-ins for external services
+"""
@@ -0,0 +1,270 @@
+"""
+AI Endpoint Benchmark for ChatSphere
+Drives each /ai/* route concurrently against a real HTTP server and reports
+latency percentiles, throughput, errors and AI worker saturation.
+
+By default everything runs in this process: a fake Groq server
+(benchmarks.fake_groq_server), the app on a temporary SQLite database and
+the load generator, so no API key or network access is needed.
+
+Usage:
+    python -m benchmarks.bench_ai --requests 200 --concurrency 32
+    python -m benchmarks.bench_ai --routes chat,translate --latency 1.0 --rate-limit-rate 0.05
+    python -m benchmarks.bench_ai --groq-url https://api.groq.com --json results.json
+"""
+from benchmarks.fake_groq_server import FakeGroqServer, add_arguments, settings_from_args
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import make_server, WSGIRequestHandler
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Route name -> (path, payload builder taking (request number, chat partner id, voice message id))
+ROUTES = {
+    'chat': ('/ai/chat', lambda i, peer, voice: {'message': f"What should I cook tonight? (request {i})"}),
+    'smart_replies': ('/ai/smart-replies', lambda i, peer, voice: {'chat_id': peer}),
+    'translate': ('/ai/translate', lambda i, peer, voice: {'text': f"See you at the station at {i} o'clock", 'language': 'Spanish'}),
+    'enhance': ('/ai/enhance', lambda i, peer, voice: {'text': f"hey can u send the report {i} asap", 'tone': 'professional'}),
+    # Contains a review-list word, so it is escalated past the local checks
+    'moderate': ('/ai/moderate', lambda i, peer, voice: {'text': f"I will shoot the photos for batch {i} tomorrow"}),
+    # No opinion words and more than 12 words, so local confidence is low
+    'sentiment': ('/ai/sentiment', lambda i, peer, voice: {'text': f"The meeting moved to room {i} on the third floor next to the kitchen on the left side"}),
+    'summarize': ('/ai/summarize', lambda i, peer, voice: {'chat_id': peer}),
+    'search': ('/ai/search', lambda i, peer, voice: {'query': 'dinner plans for friday', 'chat_id': peer}),
+    'autocomplete': ('/ai/autocomplete', lambda i, peer, voice: {'text': f"zq{i} maybe we", 'chat_id': peer}),
+    'transcribe': ('/ai/transcribe', lambda i, peer, voice: {'message_id': voice}),
+}
+
+TOPICS = ["dinner plans for friday", "the quarterly report", "the flight on monday", "a birthday gift",
+          "the broken printer", "weekend hiking", "the new project timeline", "a movie tonight"]
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def create_bench_app(groq_url, workdir, users):
+    """App on a throwaway database, seeded with users, conversations and voice notes"""
+    os.environ.setdefault('GROQ_API_KEY', 'bench-key')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ['AI_CACHE_PATH'] = os.path.join(workdir, 'ai_cache.db')
+    os.environ['GROQ_BASE_URL'] = groq_url
+
+    from app import create_app, db
+    from app.models import User, Message
+    from app.storage import get_storage
+
+    app = create_app()
+    accounts = []
+    with app.app_context():
+        storage = get_storage()
+        audio_path = os.path.join(workdir, 'voice.ogg')
+        with open(audio_path, 'wb') as f:
+            f.write(os.urandom(48 * 1024))
+        storage.save('media/bench_voice.ogg', audio_path)
+        voice_url = storage.url('media/bench_voice.ogg')
+
+        people = []
+        for n in range(users * 2):
+            user = User(username=f"bench{n}", email=f"bench{n}@example.com", phone=f"555{n:07d}")
+            user.set_password('bench-password')
+            db.session.add(user)
+            people.append(user)
+        db.session.flush()
+
+        for n in range(users):
+            me, peer = people[2 * n], people[2 * n + 1]
+            for m in range(200):
+                sender, recipient = (me, peer) if m % 2 == 0 else (peer, me)
+                db.session.add(Message(sender_id=sender.id, recipient_id=recipient.id, message_type='text',
+                                       content=f"Message {m} about {TOPICS[m % len(TOPICS)]}, what do you think?"))
+            voice = Message(sender_id=peer.id, recipient_id=me.id, message_type='voice', media_url=voice_url, content='')
+            db.session.add(voice)
+            db.session.flush()
+            accounts.append((me.username, peer.id, voice.id))
+        db.session.commit()
+    return app, accounts
+
+class Sampler:
+    """Samples the AI scheduler in the background to measure saturation"""
+
+    def __init__(self, interval=0.05):
+        from app.ai_jobs import scheduler
+        self.scheduler = scheduler
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            stats = self.scheduler.stats()
+            running = sum(f['running'] for f in stats['features'].values())
+            self.samples.append((stats['queued'], running, stats['workers'] or 1))
+            self._stop.wait(self.interval)
+
+    def summary(self):
+        if not self.samples:
+            return {'max_queued': 0, 'avg_busy_workers_pct': 0.0, 'max_busy_workers_pct': 0.0}
+        busy = [running / workers * 100 for _, running, workers in self.samples]
+        return {
+            'max_queued': max(queued for queued, _, _ in self.samples),
+            'avg_busy_workers_pct': round(statistics.mean(busy), 1),
+            'max_busy_workers_pct': round(max(busy), 1)
+        }
+
+def run_route(base_url, clients, name, requests_count, concurrency):
+    """Send requests_count requests to one route with the given concurrency"""
+    from app.ai_jobs import scheduler
+
+    path, payload = ROUTES[name]
+    counter = itertools.count()
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    rejected_before = scheduler.stats()['rejected']
+
+    def one(_):
+        i = next(counter)
+        client, peer, voice = clients[i % len(clients)]
+        start = time.perf_counter()
+        try:
+            status = client.post(base_url + path, json=payload(i, peer, voice)).status_code
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    with Sampler() as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(requests_count)))
+        duration = time.perf_counter() - started
+
+    result = {
+        'route': name,
+        'requests': requests_count,
+        'ok': len(latencies),
+        'statuses': {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        'throughput_rps': round(requests_count / duration, 1),
+        'p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+        'p90_ms': round(percentile(latencies, 90), 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+        'max_ms': round(max(latencies), 1) if latencies else None,
+        'scheduler_rejected': scheduler.stats()['rejected'] - rejected_before
+    }
+    result.update(sampler.summary())
+    return result
+
+def print_table(results):
+    columns = ['route', 'ok', 'requests', 'throughput_rps', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms',
+               'max_queued', 'avg_busy_workers_pct', 'max_busy_workers_pct']
+    headers = ['route', 'ok', 'sent', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+               'max queue', 'avg busy %', 'max busy %']
+    rows = [[str(r[c]) if r[c] is not None else '-' for c in columns] for r in results]
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+    print('  '.join(h.ljust(w) for h, w in zip(headers, widths)))
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(value.ljust(w) for value, w in zip(row, widths)))
+    for r in results:
+        failures = {k: v for k, v in r['statuses'].items() if k != '200'}
+        if failures:
+            print(f"  {r['route']}: non-200 responses {failures}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /ai/* routes')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma separated routes (default all)')
+    parser.add_argument('--requests', type=int, default=100, help='requests per route (default 100)')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent requests (default 16)')
+    parser.add_argument('--users', type=int, default=8, help='accounts the requests are spread over (default 8)')
+    parser.add_argument('--groq-url', help='use this Groq API instead of starting the fake server')
+    parser.add_argument('--json', help='also write the results to this file')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.routes.split(',') if name.strip()]
+    unknown = [name for name in names if name not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)} (choose from {', '.join(ROUTES)})")
+
+    import httpx
+
+    fake = None
+    if args.groq_url:
+        groq_url = args.groq_url
+    else:
+        fake = FakeGroqServer('127.0.0.1', 0, settings_from_args(args)).start()
+        groq_url = fake.url
+
+    workdir = tempfile.mkdtemp(prefix='chatsphere-bench-')
+    app, accounts = create_bench_app(groq_url, workdir, args.users)
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    clients = []
+    for username, peer, voice in accounts:
+        client = httpx.Client(timeout=180, limits=limits)
+        client.post(base_url + '/auth/login', data={'username': username, 'password': 'bench-password'})
+        clients.append((client, peer, voice))
+
+    print(f"ChatSphere AI benchmark: {args.requests} requests/route, concurrency {args.concurrency}, "
+          f"{len(accounts)} users, AI workers {app.config['AI_WORKERS']}")
+    print(f"Groq API: {groq_url}" + (" (fake)" if fake else ""))
+    print("-" * 50)
+
+    results = []
+    for name in names:
+        if fake:
+            fake.stats.reset()
+        result = run_route(base_url, clients, name, args.requests, args.concurrency)
+        if fake:
+            upstream = fake.stats.snapshot()
+            result['upstream_requests'] = upstream['requests']
+            result['upstream_max_in_flight'] = upstream['max_in_flight']
+        results.append(result)
+        print(f"  {name}: p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+              f"{result['throughput_rps']} req/s", file=sys.stderr)
+
+    print()
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"\n✓ Results written to {args.json}")
+
+    for client, _, _ in clients:
+        client.close()
+    server.shutdown()
+    if fake:
+        fake.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+HTTP Endpoint Benchmark for ChatSphere
+Times the page and history routes against the database configured by
+DATABASE_URL (fill it with benchmarks.generate_data first) and counts the SQL
+queries each request runs.
+
+Requests go through the Flask test client in this process, so the numbers
+cover routing, queries and template rendering without network noise. Save a
+run with --json and pass it to --compare on a later commit to see the change.
+
+Usage:
+    DATABASE_URL=sqlite:///bench.db python -m benchmarks.bench_http
+    python -m benchmarks.bench_http --iterations 50 --json before.json
+    python -m benchmarks.bench_http --json after.json --compare before.json
+"""
+from benchmarks.bench_ai import percentile
+from datetime import datetime
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Case name -> (endpoint, URL builder taking the targets picked by pick_targets)
+CASES = {
+    'main.index': ('/', lambda t: '/'),
+    'chat.user_chat': ('/chat/user/<id>', lambda t: f"/chat/user/{t['partner_id']}"),
+    'chat.get_user_messages': ('/chat/messages/user/<id>', lambda t: f"/chat/messages/user/{t['partner_id']}"),
+    'chat.group_chat': ('/chat/group/<id>', lambda t: f"/chat/group/{t['group_id']}"),
+    'chat.get_group_messages': ('/chat/messages/group/<id>', lambda t: f"/chat/messages/group/{t['group_id']}"),
+    'status.index': ('/status/', lambda t: '/status/'),
+    'status.get_user_statuses': ('/status/user/<id>', lambda t: f"/status/user/{t['status_user_id']}"),
+}
+
+class QueryCounter:
+    """Counts SQL statements sent through the engine"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def pick_targets(username=None):
+    """Choose the benchmark user and the chats, group and statuses to load
+
+    Defaults to the user who sent the most direct messages, their busiest
+    direct chat and their busiest group, so the slow paths are exercised.
+    """
+    from app import db
+    from app.models import User, Message, Status, group_members
+    from sqlalchemy import func
+
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise SystemExit(f"User '{username}' not found")
+    else:
+        top = db.session.query(Message.sender_id, func.count(Message.id).label('sent')).filter(
+            Message.group_id == None
+        ).group_by(Message.sender_id).order_by(db.desc('sent')).first()
+        if not top:
+            raise SystemExit("No messages found, run python -m benchmarks.generate_data first")
+        user = User.query.get(top.sender_id)
+
+    partner = db.session.query(Message.recipient_id, func.count(Message.id).label('sent')).filter(
+        Message.sender_id == user.id, Message.group_id == None
+    ).group_by(Message.recipient_id).order_by(db.desc('sent')).first()
+    group = db.session.query(Message.group_id, func.count(Message.id).label('sent')).join(
+        group_members, group_members.c.group_id == Message.group_id
+    ).filter(group_members.c.user_id == user.id).group_by(Message.group_id).order_by(db.desc('sent')).first()
+    status_user = db.session.query(Status.user_id).filter(
+        Status.expires_at > datetime.utcnow(), Status.user_id != user.id
+    ).first()
+
+    return {
+        'user_id': user.id,
+        'username': user.username,
+        'partner_id': partner.recipient_id if partner else None,
+        'group_id': group.group_id if group else None,
+        'status_user_id': status_user.user_id if status_user else None
+    }
+
+def dataset_counts():
+    from app import db
+    from app.models import User, Message, Group, Status, StatusView, MessageReaction
+    return {model.__tablename__: db.session.query(db.func.count(model.id)).scalar()
+            for model in (User, Message, Group, Status, StatusView, MessageReaction)}
+
+def run_case(client, counter, url, warmup, iterations):
+    """Request url warmup + iterations times and collect timings"""
+    latencies, queries, sizes, statuses = [], [], [], {}
+    for i in range(warmup + iterations):
+        counter.count = 0
+        start = time.perf_counter()
+        response = client.get(url)
+        elapsed = (time.perf_counter() - start) * 1000
+        if i < warmup:
+            continue
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        latencies.append(elapsed)
+        queries.append(counter.count)
+        sizes.append(len(response.data))
+    return {
+        'url': url,
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p90_ms': round(percentile(latencies, 90), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'mean_ms': round(statistics.mean(latencies), 2),
+        'queries': max(queries),
+        'response_kb': round(statistics.mean(sizes) / 1024, 1)
+    }
+
+def print_table(results, baseline=None):
+    headers = ['case', 'p50 ms', 'p90 ms', 'p99 ms', 'queries', 'KB']
+    if baseline:
+        headers += ['Δ p50', 'Δ queries']
+    rows = []
+    for name, r in results.items():
+        row = [name, str(r['p50_ms']), str(r['p90_ms']), str(r['p99_ms']), str(r['queries']), str(r['response_kb'])]
+        if baseline:
+            before = baseline.get(name)
+            if before:
+                change = (r['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+                row += [f"{change:+.1f}%", f"{r['queries'] - before['queries']:+d}"]
+            else:
+                row += ['-', '-']
+        rows.append(row)
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+    print('  '.join(h.ljust(w) for h, w in zip(headers, widths)))
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(value.ljust(w) for value, w in zip(row, widths)))
+    for name, r in results.items():
+        failures = {k: v for k, v in r['statuses'].items() if k != '200'}
+        if failures:
+            print(f"  {name}: non-200 responses {failures}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the page and chat history routes')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma separated cases (default all)')
+    parser.add_argument('--iterations', type=int, default=20, help='timed requests per case (default 20)')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed requests per case (default 2)')
+    parser.add_argument('--user', help='username to benchmark as (default the most active user)')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.cases.split(',') if name.strip()]
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)} (choose from {', '.join(CASES)})")
+
+    from app import create_app, db
+
+    app = create_app()
+    with app.app_context():
+        targets = pick_targets(args.user)
+        counts = dataset_counts()
+        counter = QueryCounter(db.engine)
+
+    print(f"ChatSphere HTTP benchmark: {args.iterations} requests/case as {targets['username']}")
+    print(f"Database: {app.config['SQLALCHEMY_DATABASE_URI']}")
+    print("Dataset: " + ', '.join(f"{count} {table}" for table, count in counts.items()))
+    print("-" * 50)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(targets['user_id'])
+        session['_fresh'] = True
+
+    results = {}
+    for name in names:
+        _, url_for_targets = CASES[name]
+        url = url_for_targets(targets)
+        if 'None' in url:
+            print(f"  {name}: skipped, the dataset has nothing for it", file=sys.stderr)
+            continue
+        results[name] = run_case(client, counter, url, args.warmup, args.iterations)
+        print(f"  {name}: p50 {results[name]['p50_ms']} ms, {results[name]['queries']} queries", file=sys.stderr)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        baseline = previous['results']
+        print(f"\nCompared with {args.compare} (commit {previous.get('commit') or 'unknown'})")
+
+    print()
+    print_table(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(),
+                       'settings': vars(args), 'targets': targets, 'dataset': counts,
+                       'results': results}, f, indent=2)
+        print(f"\n✓ Results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
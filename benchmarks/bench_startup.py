@@ -0,0 +1,236 @@
+"""
+Startup Benchmark for ChatSphere
+Times cold starts the way a serverless function or a fresh worker sees them:
+each run is a new Python process that imports the app, calls create_app and
+serves its first request, with and without FAST_START.
+
+Separate runs under `python -X importtime` record how long each module takes
+to import, so a new eager import of a heavy package shows up by name. Save a
+run with --json and pass it to --compare on a later commit to see the change.
+
+Usage:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 20 --json before.json
+    python -m benchmarks.bench_startup --json after.json --compare before.json
+
+Without DATABASE_URL and UPLOAD_FOLDER the runs use a temporary SQLite
+database and upload folder.
+"""
+from benchmarks.bench_ai import percentile
+from benchmarks.bench_http import git_commit
+from datetime import datetime
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {
+    'default': {'FAST_START': 'false'},
+    'fast': {'FAST_START': 'true'},
+}
+
+# Runs in the child process; prints the phase timings as JSON on the last line
+CHILD = """
+import time
+started = time.perf_counter()
+import json
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get('/auth/login')
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000, 'status': response.status_code}))
+"""
+
+PHASES = ('process_ms', 'import_ms', 'create_app_ms', 'first_request_ms')
+
+def child_env(mode):
+    env = dict(os.environ, **MODES[mode])
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+    return env
+
+def run_once(mode, importtime=False):
+    """
+    Start a fresh interpreter and time its startup phases
+    Returns:
+        Tuple of (phase timings, -X importtime report or None)
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD]
+    started = time.perf_counter()
+    result = subprocess.run(command, env=child_env(mode), capture_output=True, text=True)
+    elapsed = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{mode} run failed:\n{result.stderr[-2000:]}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process_ms'] = elapsed
+    return timings, result.stderr if importtime else None
+
+def parse_importtime(report):
+    """
+    Modules imported once the interpreter is up, from a -X importtime report
+    Returns:
+        List of (module, self ms, cumulative ms, parent module or None)
+    """
+    nodes = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        head, cumulative_us, name = line.split('|')
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        nodes.append([name.strip(), int(head.split(':', 1)[1]) / 1000, int(cumulative_us) / 1000, None, depth])
+
+    # Children are listed before their parent, one indent level deeper
+    pending = {}
+    for node in nodes:
+        for child in pending.pop(node[4] + 1, []):
+            child[3] = node[0]
+        pending.setdefault(node[4], []).append(node)
+
+    # Skip what the interpreter imported before the child script's `import app`
+    first = 0
+    for index, node in enumerate(nodes):
+        if node[0] == 'app' and node[4] == 0:
+            break
+        if node[4] == 0:
+            first = index + 1
+    return [tuple(node[:4]) for node in nodes[first:]]
+
+def summarize_modules(reports, top):
+    """
+    Median import times: the slowest packages (cumulative time of their
+    outermost imports, including what they import) and every app module
+    """
+    packages_runs, modules_runs = [], []
+    for report in reports:
+        nodes = parse_importtime(report)
+        packages, modules = {}, {}
+        package_of = {name: name.split('.')[0] for name, _, _, _ in nodes}
+        for name, self_ms, cumulative_ms, parent in nodes:
+            modules[name] = (self_ms, cumulative_ms)
+            if parent is None or package_of.get(parent) != package_of[name]:
+                packages[package_of[name]] = packages.get(package_of[name], 0) + cumulative_ms
+        packages_runs.append(packages)
+        modules_runs.append(modules)
+
+    def median(runs, name, index=None):
+        values = [run[name] if index is None else run[name][index] for run in runs if name in run]
+        return round(statistics.median(values), 2)
+
+    package_names = set().union(*packages_runs) - {'app'}
+    slowest = sorted(package_names, key=lambda name: -median(packages_runs, name))[:top]
+    app_modules = [name for name in set().union(*modules_runs) if name == 'app' or name.startswith('app.')]
+    return {
+        'packages': {name: {'cumulative_ms': median(packages_runs, name)} for name in slowest},
+        'app': {name: {'self_ms': median(modules_runs, name, 0), 'cumulative_ms': median(modules_runs, name, 1)}
+                for name in sorted(app_modules, key=lambda name: -median(modules_runs, name, 1))}
+    }
+
+def summarize_runs(samples):
+    summary = {}
+    for phase in PHASES:
+        values = [sample[phase] for sample in samples]
+        summary[phase] = {'p50': round(percentile(values, 50), 1), 'p90': round(percentile(values, 90), 1)}
+    summary['statuses'] = sorted({sample['status'] for sample in samples})
+    return summary
+
+def change(value, before):
+    return f"{(value - before) / before * 100:+.1f}%" if before else '-'
+
+def print_table(headers, rows):
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)]
+    print('  '.join(h.ljust(w) for h, w in zip(headers, widths)))
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(value.ljust(w) for value, w in zip(row, widths)))
+
+def print_results(results, baseline=None):
+    headers = ['mode'] + [f"{phase[:-3].replace('_', ' ')} p50 ms" for phase in PHASES]
+    rows = []
+    for mode, summary in results['modes'].items():
+        row = [mode]
+        for phase in PHASES:
+            cell = str(summary[phase]['p50'])
+            before = (baseline or {}).get('modes', {}).get(mode)
+            if before:
+                cell += f" ({change(summary[phase]['p50'], before[phase]['p50'])})"
+            row.append(cell)
+        rows.append(row)
+    print_table(headers, rows)
+
+    before_modules = (baseline or {}).get('modules', {})
+    for group, title, columns in (('packages', 'Slowest packages to import', ['cumulative_ms']),
+                                  ('app', 'App modules', ['self_ms', 'cumulative_ms'])):
+        print(f"\n{title} (median ms)")
+        before_group = before_modules.get(group, {})
+        rows = []
+        for name, m in results['modules'][group].items():
+            row = [name] + [str(m[column]) for column in columns]
+            if baseline:
+                before = before_group.get(name)
+                row.append(change(m['cumulative_ms'], before['cumulative_ms']) if before else 'new')
+            rows.append(row)
+        headers = ['module' if group == 'app' else 'package'] + [column[:-3] for column in columns]
+        print_table(headers + (['Δ cumulative'] if baseline else []), rows)
+        gone = [name for name in before_group if name not in results['modules'][group]]
+        if gone:
+            print(f"  no longer listed: {', '.join(gone)}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cold start time and import time per module')
+    parser.add_argument('--runs', type=int, default=10, help='timed cold starts per mode (default 10)')
+    parser.add_argument('--import-runs', type=int, default=3, help='runs under -X importtime (default 3)')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated modes (default all)')
+    parser.add_argument('--top', type=int, default=15, help='slowest top-level imports to list (default 15)')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)} (choose from {', '.join(MODES)})")
+
+    scratch = tempfile.TemporaryDirectory(prefix='chatsphere-startup-')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(scratch.name, 'startup.db')}")
+    os.environ.setdefault('UPLOAD_FOLDER', os.path.join(scratch.name, 'uploads'))
+    os.environ.setdefault('AI_CACHE_PATH', '')
+
+    print(f"ChatSphere startup benchmark: {args.runs} cold starts per mode")
+    print(f"Database: {os.environ['DATABASE_URL']}")
+    print("-" * 50)
+
+    # Untimed run: creates the schema and compiles bytecode
+    run_once('default')
+
+    results = {'modes': {}, 'modules': {}}
+    for mode in modes:
+        samples = [run_once(mode)[0] for _ in range(args.runs)]
+        results['modes'][mode] = summarize_runs(samples)
+        print(f"  {mode}: create_app p50 {results['modes'][mode]['create_app_ms']['p50']} ms", file=sys.stderr)
+    reports = [run_once(modes[-1], importtime=True)[1] for _ in range(args.import_runs)]
+    results['modules'] = summarize_modules(reports, args.top)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} (commit {baseline.get('commit') or 'unknown'})")
+
+    print()
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(),
+                       'settings': vars(args), **results}, f, indent=2)
+        print(f"\n✓ Results written to {args.json}")
+    scratch.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+Fake Groq Server for ChatSphere
+Local stand-in for the Groq API (chat completions, streaming and Whisper
+transcriptions) with configurable latency, token rate and error injection,
+for load tests and offline development.
+
+Usage:
+    python -m benchmarks.fake_groq_server --port 8088 --latency 0.3 --tokens-per-second 200
+    GROQ_BASE_URL=http://127.0.0.1:8088 python run.py
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+NUMBERED_RE = re.compile(r'^\[(\d+)\]', re.M)
+WORD_RE = re.compile(r'\w+')
+
+FILLER = ("Sure thing! Here is a short answer that stands in for a real model "
+          "response so the rest of the pipeline has something realistic to work with.").split()
+
+class FakeSettings:
+    """Behaviour of the fake server; every field can be changed while it runs"""
+
+    def __init__(self, latency=0.3, jitter=0.1, tokens_per_second=200.0, completion_tokens=60,
+                 transcribe_latency=1.0, error_rate=0.0, rate_limit_rate=0.0, rpm=0, retry_after=1.0,
+                 seed=None):
+        self.latency = latency                      # Seconds to first token
+        self.jitter = jitter                        # Random extra latency, 0..jitter seconds
+        self.tokens_per_second = tokens_per_second  # Generation speed after the first token
+        self.completion_tokens = completion_tokens  # Length of free-text answers
+        self.transcribe_latency = transcribe_latency
+        self.error_rate = error_rate                # Fraction of requests answered with 500
+        self.rate_limit_rate = rate_limit_rate      # Fraction of requests answered with 429
+        self.rpm = rpm                              # Requests per minute before 429s (0 = unlimited)
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+class FakeStats:
+    """Request counters, safe to read from other threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'requests': 0, 'completions': 0, 'streams': 0, 'transcriptions': 0,
+                       'rate_limited': 0, 'errors': 0, 'completion_tokens': 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts, in_flight=self.in_flight, max_in_flight=self.max_in_flight)
+
+    def reset(self):
+        with self._lock:
+            for name in self.counts:
+                self.counts[name] = 0
+            self.max_in_flight = self.in_flight
+
+def _numbered(text):
+    return [int(i) for i in NUMBERED_RE.findall(text)]
+
+def respond(messages, settings):
+    """
+    Model answer for a chat prompt
+    Prompts of the ChatSphere AI helpers that expect JSON get JSON of the
+    right shape, so callers exercise their parsing paths; anything else gets
+    filler text of settings.completion_tokens words.
+    """
+    system = messages[0]['content'] if messages else ''
+    user = messages[-1]['content'] if messages else ''
+
+    if 'reply suggestions' in user or 'reply suggestions' in system:
+        return json.dumps(["Sounds good!", "Let me check and get back to you", "Thanks for letting me know"])
+    if 'Complete the partial message' in system:
+        partial = user.rpartition('Partial message:')[2].split('\n')[0].strip()
+        return json.dumps([f"{partial} later today", f"{partial} tomorrow", f"{partial} as soon as I can"])
+    if 'numbered message' in system and 'moderator' in system:
+        return json.dumps([{"id": i, "is_safe": True, "reason": ""} for i in _numbered(user)])
+    if 'content moderator' in system:
+        return json.dumps({"is_safe": True, "reason": "", "filtered_text": user})
+    if 'sentiment of each numbered' in system:
+        return json.dumps([{"id": i, "sentiment": "neutral", "confidence": 0.8, "emoji": "😐"} for i in _numbered(user)])
+    if 'sentiment' in system:
+        return json.dumps({"sentiment": "neutral", "confidence": 0.8, "emoji": "😐"})
+    if 'relevance score' in system:
+        query = set(WORD_RE.findall(user.partition('\n')[0].lower())) - {'query'}
+        scored = []
+        for line in user.split('\n'):
+            match = NUMBERED_RE.match(line)
+            if match:
+                words = set(WORD_RE.findall(line.lower()))
+                scored.append({"i": int(match.group(1)), "score": round(len(query & words) / (len(query) or 1), 2)})
+        scored.sort(key=lambda item: -item['score'])
+        return json.dumps(scored[:5])
+    if system.startswith('You are a translator') or 'improved message' in system:
+        return user
+
+    count = settings.completion_tokens
+    return ' '.join(FILLER[i % len(FILLER)] for i in range(count))
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    @property
+    def stats(self):
+        return self.server.stats
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _injected_failure(self):
+        """Send a 429 or 500 if one is due; returns True if it did"""
+        settings = self.settings
+        if self.server.limiter_exceeded() or settings.random.random() < settings.rate_limit_rate:
+            self.stats.add('rate_limited')
+            self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'tokens', 'code': 'rate_limit_exceeded'}},
+                            {'retry-after': str(settings.retry_after)})
+            return True
+        if settings.random.random() < settings.error_rate:
+            self.stats.add('errors')
+            self._send_json(500, {'error': {'message': 'Injected server error', 'type': 'internal_server_error'}})
+            return True
+        return False
+
+    def _first_token_delay(self):
+        time.sleep(self.settings.latency + self.settings.random.random() * self.settings.jitter)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.stats.snapshot())
+        elif self.path.startswith('/openai/v1/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'llama-3.3-70b-versatile', 'object': 'model'}]})
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.stats.add('requests')
+        self.stats.enter()
+        try:
+            if self.path.startswith('/openai/v1/chat/completions'):
+                self._chat(json.loads(self.rfile.read(length) or b'{}'))
+            elif self.path.startswith('/openai/v1/audio/transcriptions'):
+                self._transcribe(length)
+            else:
+                self.rfile.read(length)
+                self._send_json(404, {'error': {'message': 'Not found'}})
+        finally:
+            self.stats.leave()
+
+    def _transcribe(self, length):
+        # Read the upload in chunks, as the real API would receive it
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        if self._injected_failure():
+            return
+        time.sleep(self.settings.transcribe_latency)
+        self.stats.add('transcriptions')
+        self._send_json(200, {'text': f"Transcribed voice note ({length} bytes)."})
+
+    def _chat(self, body):
+        if self._injected_failure():
+            return
+        content = respond(body.get('messages', []), self.settings)
+        tokens = content.split(' ')
+        max_tokens = body.get('max_tokens')
+        if max_tokens and len(tokens) > max_tokens and not content.startswith(('[', '{')):
+            tokens = tokens[:max_tokens]
+        self.stats.add('completion_tokens', len(tokens))
+        usage = {'prompt_tokens': sum(len(m.get('content', '')) // 4 for m in body.get('messages', [])),
+                 'completion_tokens': len(tokens)}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        base = {'id': f"chatcmpl-{random.getrandbits(48):x}", 'created': int(time.time()),
+                'model': body.get('model', 'llama-3.3-70b-versatile')}
+
+        self._first_token_delay()
+        if body.get('stream'):
+            self.stats.add('streams')
+            self._stream(base, tokens)
+            return
+
+        time.sleep(len(tokens) / self.settings.tokens_per_second)
+        self.stats.add('completions')
+        self._send_json(200, dict(base, object='chat.completion', usage=usage, choices=[{
+            'index': 0, 'finish_reason': 'stop',
+            'message': {'role': 'assistant', 'content': ' '.join(tokens)}
+        }]))
+
+    def _stream(self, base, tokens):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(event):
+            data = b'data: ' + event + b'\n\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        interval = 1 / self.settings.tokens_per_second
+        for i, token in enumerate(tokens):
+            delta = token if i == 0 else ' ' + token
+            write(json.dumps(dict(base, object='chat.completion.chunk', choices=[{
+                'index': 0, 'finish_reason': None, 'delta': {'content': delta}
+            }])).encode())
+            time.sleep(interval)
+        write(json.dumps(dict(base, object='chat.completion.chunk', choices=[{
+            'index': 0, 'finish_reason': 'stop', 'delta': {}
+        }])).encode())
+        write(b'[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+
+class FakeGroqServer(ThreadingHTTPServer):
+    """
+    Threaded fake Groq API server
+    Point the app at it with GROQ_BASE_URL=<server.url>.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=8088, settings=None):
+        super().__init__((host, port), FakeGroqHandler)
+        self.settings = settings or FakeSettings()
+        self.stats = FakeStats()
+        self._window = []
+        self._window_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def limiter_exceeded(self):
+        """Sliding one-minute request window for the rpm limit"""
+        rpm = self.settings.rpm
+        if not rpm:
+            return False
+        now = time.monotonic()
+        with self._window_lock:
+            while self._window and self._window[0] <= now - 60:
+                self._window.pop(0)
+            if len(self._window) >= rpm:
+                return True
+            self._window.append(now)
+            return False
+
+    def start(self):
+        """Serve in a background thread; returns self"""
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-groq', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def settings_from_args(args):
+    return FakeSettings(
+        latency=args.latency, jitter=args.jitter, tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens, transcribe_latency=args.transcribe_latency,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, rpm=args.rpm,
+        retry_after=args.retry_after, seed=args.seed
+    )
+
+def add_arguments(parser):
+    """Fake server options, shared with the benchmark scripts"""
+    group = parser.add_argument_group('fake Groq server')
+    group.add_argument('--latency', type=float, default=0.3, help='seconds to first token (default 0.3)')
+    group.add_argument('--jitter', type=float, default=0.1, help='random extra latency in seconds (default 0.1)')
+    group.add_argument('--tokens-per-second', type=float, default=200, help='generation speed (default 200)')
+    group.add_argument('--completion-tokens', type=int, default=60, help='length of free-text answers (default 60)')
+    group.add_argument('--transcribe-latency', type=float, default=1.0, help='seconds per transcription (default 1.0)')
+    group.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing with 500')
+    group.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests failing with 429')
+    group.add_argument('--rpm', type=int, default=0, help='requests per minute before 429s (0 = unlimited)')
+    group.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with 429s')
+    group.add_argument('--seed', type=int, default=None, help='random seed for latency and error injection')
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Groq API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeGroqServer(args.host, args.port, settings_from_args(args))
+    print(f"Fake Groq API listening on {server.url}")
+    print(f"Use it with: GROQ_BASE_URL={server.url}")
+    print("Counters: GET /stats")
+    print("-" * 50)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
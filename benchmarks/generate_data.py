@@ -0,0 +1,231 @@
+"""
+Synthetic Dataset Generator for ChatSphere
+Fills the database configured by DATABASE_URL with users, direct and group
+messages, groups with power-law sizes, statuses, status views and reactions
+using bulk inserts.
+
+Activity follows a Zipf-like distribution: a few users send most messages
+and talk mostly to a small set of contacts, and a few groups are very large
+while most are small.
+
+Usage:
+    DATABASE_URL=sqlite:///bench.db python -m benchmarks.generate_data --users 10000 --messages 10000000
+    python -m benchmarks.generate_data --users 500 --messages 50000 --groups 40 --seed 7
+"""
+from app import create_app, db
+from app.models import User, Message, Group, Status, StatusView, MessageReaction, group_members
+from werkzeug.security import generate_password_hash
+from datetime import datetime, timedelta
+import argparse
+import bisect
+import itertools
+import random
+import time
+
+PASSWORD = 'chatsphere-bench'
+
+WORDS = ("ok sure thanks see you later tomorrow tonight meeting lunch dinner coffee call me when "
+         "free busy sorry late running traffic great idea love it haha lol nice good morning night "
+         "the project report deadline friday weekend plans movie game match trip flight hotel photo "
+         "sent check this out what do you think sounds good maybe next week cool awesome").split()
+EMOJIS = ['👍', '❤️', '😂', '😮', '😢', '🙏']
+COLORS = ['#075E54', '#128C7E', '#25D366', '#34B7F1', '#ECE5DD', '#6B46C1']
+
+class Weighted:
+    """Draws items with fixed weights in O(log n) per draw"""
+
+    def __init__(self, items, weights, rng):
+        self.items = items
+        self.cumulative = list(itertools.accumulate(weights))
+        self.rng = rng
+
+    def draw(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return self.items[bisect.bisect_right(self.cumulative, point)]
+
+def zipf_weights(count, exponent):
+    return [1 / (rank + 1) ** exponent for rank in range(count)]
+
+def group_sizes(count, users, alpha, min_size, max_size, rng):
+    """Power-law (Pareto) group sizes between min_size and max_size"""
+    max_size = min(max_size, users)
+    return [min(max_size, int(min_size * rng.paretovariate(alpha))) for _ in range(count)]
+
+def sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 14)))
+
+def contact_circle(user_id, user_ids, size, circles):
+    """A stable pseudo-random set of usual contacts for one user"""
+    if user_id not in circles:
+        circles[user_id] = random.Random(user_id).sample(user_ids, min(size, len(user_ids)))
+    return circles[user_id]
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+class BulkWriter:
+    """Buffers rows per table and writes them with executemany"""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.written = {}
+
+    def add(self, table, row):
+        rows = self.buffers.setdefault(table, [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        for name in ([table] if table is not None else list(self.buffers)):
+            rows = self.buffers.get(name)
+            if rows:
+                db.session.execute(name.insert(), rows)
+                db.session.commit()
+                self.written[name.name] = self.written.get(name.name, 0) + len(rows)
+                self.buffers[name] = []
+
+def generate(args):
+    rng = random.Random(args.seed)
+    writer = BulkWriter(args.batch_size)
+    now = datetime.utcnow()
+    start = now - timedelta(days=args.days)
+    prefix = args.prefix
+    started = time.perf_counter()
+
+    # Users: one password hash shared by all, hashing per user would dominate the run
+    password_hash = generate_password_hash(PASSWORD)
+    first_user = next_id(User)
+    user_ids = list(range(first_user, first_user + args.users))
+    for n, user_id in enumerate(user_ids):
+        writer.add(User.__table__, {
+            'id': user_id, 'username': f"{prefix}{n}", 'email': f"{prefix}{n}@example.com",
+            'password_hash': password_hash, 'phone': f"{prefix}{n}"[:20],
+            'about': "Hey there! I am using ChatSphere", 'profile_pic': 'default.png',
+            'last_seen': now - timedelta(minutes=rng.randint(0, 60 * 24 * 7)),
+            'is_online': rng.random() < args.online_fraction, 'created_at': start
+        })
+    writer.flush()
+    print(f"  users: {len(user_ids)}")
+
+    # Groups: Pareto sizes, members drawn with the same activity skew as messages
+    activity = Weighted(user_ids, zipf_weights(len(user_ids), args.activity_exponent), rng)
+    first_group = next_id(Group)
+    groups = []
+    for n, size in enumerate(group_sizes(args.groups, len(user_ids), args.group_alpha,
+                                         args.min_group_size, args.max_group_size, rng)):
+        group_id = first_group + n
+        members = {activity.draw()}
+        while len(members) < size:
+            members.add(activity.draw() if rng.random() < 0.5 else rng.choice(user_ids))
+        members = list(members)
+        groups.append((group_id, members))
+        writer.add(Group.__table__, {
+            'id': group_id, 'name': f"{prefix} group {n}", 'description': sentence(rng),
+            'group_pic': 'default_group.png', 'owner_id': members[0], 'created_at': start
+        })
+        for member in members:
+            writer.add(group_members, {'user_id': member, 'group_id': group_id, 'joined_at': start})
+    writer.flush()
+    print(f"  groups: {len(groups)} (largest {max((len(m) for _, m in groups), default=0)} members)")
+
+    # Messages: senders by activity, DMs mostly within a small contact circle,
+    # group messages weighted towards bigger groups
+    group_draw = Weighted(groups, [len(members) ** 0.8 for _, members in groups], rng) if groups else None
+    first_message = next_id(Message)
+    span = (now - start).total_seconds()
+    circles = {}
+    reacted = []
+    for n in range(args.messages):
+        message_id = first_message + n
+        timestamp = start + timedelta(seconds=span * n / max(1, args.messages))
+        if group_draw and rng.random() < args.group_fraction:
+            group_id, members = group_draw.draw()
+            sender, recipient = rng.choice(members), None
+        else:
+            group_id = None
+            sender = activity.draw()
+            circle = contact_circle(sender, user_ids, args.contacts, circles)
+            recipient = rng.choice(circle) if rng.random() < 0.9 else rng.choice(user_ids)
+            if recipient == sender:
+                recipient = user_ids[(sender - first_user + 1) % len(user_ids)]
+        age = (now - timestamp).total_seconds()
+        writer.add(Message.__table__, {
+            'id': message_id, 'sender_id': sender, 'recipient_id': recipient, 'group_id': group_id,
+            'content': sentence(rng), 'message_type': 'text', 'timestamp': timestamp,
+            'is_read': age > 3600 or rng.random() < 0.5, 'is_deleted': False
+        })
+        if rng.random() < args.reaction_fraction:
+            reacted.append((message_id, group_id, sender, recipient))
+        if n and n % 100000 == 0:
+            elapsed = time.perf_counter() - started
+            print(f"  messages: {n} ({n / elapsed:.0f}/s)")
+    writer.flush()
+    print(f"  messages: {args.messages}")
+
+    # Reactions come from the other side of a DM or from group members
+    members_by_group = dict(groups)
+    for message_id, group_id, sender, recipient in reacted:
+        for _ in range(1 if recipient else rng.randint(1, 3)):
+            reactor = recipient or rng.choice(members_by_group[group_id])
+            writer.add(MessageReaction.__table__, {
+                'message_id': message_id, 'user_id': reactor, 'emoji': rng.choice(EMOJIS), 'timestamp': now
+            })
+    writer.flush()
+
+    # Statuses active now, each viewed by some of the author's contacts
+    first_status = next_id(Status)
+    status_id = first_status
+    for user_id in user_ids:
+        if rng.random() >= args.status_fraction:
+            continue
+        circle = contact_circle(user_id, user_ids, args.contacts, circles)
+        for _ in range(rng.randint(1, 3)):
+            created = now - timedelta(minutes=rng.randint(1, 23 * 60))
+            writer.add(Status.__table__, {
+                'id': status_id, 'user_id': user_id, 'content': sentence(rng), 'media_type': 'text',
+                'background_color': rng.choice(COLORS), 'created_at': created,
+                'expires_at': created + timedelta(hours=24)
+            })
+            for viewer in circle:
+                if viewer != user_id and rng.random() < args.view_fraction:
+                    writer.add(StatusView.__table__, {'status_id': status_id, 'user_id': viewer, 'viewed_at': now})
+            status_id += 1
+    writer.flush()
+
+    print("-" * 50)
+    for table, count in sorted(writer.written.items()):
+        print(f"  {table}: {count} rows")
+    print(f"✓ Generated in {time.perf_counter() - started:.1f}s")
+    print(f"  Log in as {prefix}0 … {prefix}{args.users - 1} with password '{PASSWORD}'")
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill the database with synthetic ChatSphere data')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--group-fraction', type=float, default=0.3, help='share of messages sent to groups')
+    parser.add_argument('--group-alpha', type=float, default=1.2, help='Pareto shape of group sizes (lower = heavier tail)')
+    parser.add_argument('--min-group-size', type=int, default=3)
+    parser.add_argument('--max-group-size', type=int, default=5000)
+    parser.add_argument('--activity-exponent', type=float, default=1.0, help='Zipf exponent of user activity')
+    parser.add_argument('--contacts', type=int, default=20, help='size of each user\'s usual DM circle')
+    parser.add_argument('--online-fraction', type=float, default=0.05)
+    parser.add_argument('--status-fraction', type=float, default=0.2, help='share of users with active statuses')
+    parser.add_argument('--view-fraction', type=float, default=0.5, help='share of contacts who viewed a status')
+    parser.add_argument('--reaction-fraction', type=float, default=0.05, help='share of messages with reactions')
+    parser.add_argument('--days', type=int, default=90, help='history length')
+    parser.add_argument('--prefix', default='gen', help='username prefix (must not already be in use)')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    app = create_app()
+    print(f"Generating data in {app.config['SQLALCHEMY_DATABASE_URI']}...")
+    print("-" * 50)
+    with app.app_context():
+        generate(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+"""
+Socket.IO Load Harness for ChatSphere
+Connects many authenticated Socket.IO clients, spread over several
+processes, and drives a mix of direct messages, group messages, typing
+indicators, call signaling and reconnects through app/socket_events.py.
+
+Every payload carries its send time, so receivers measure end-to-end
+send-to-receive latency. The report covers latency percentiles per traffic
+kind, delivery ratio, events/sec and, when the server runs on this machine,
+server memory per connection.
+
+Accounts come from the database in DATABASE_URL (fill it with
+benchmarks.generate_data first). Clients use session cookies signed with
+SECRET_KEY, so the server must share both settings. Needs aiohttp for the
+asyncio client (pip install aiohttp).
+
+Usage:
+    DATABASE_URL=sqlite:///bench.db python -m benchmarks.socket_load --clients 1000 --processes 4
+    python -m benchmarks.socket_load --mix dm=50,group=30,typing=20 --rate 500 --duration 30
+    python -m benchmarks.socket_load --url http://127.0.0.1:5000 --server-pid 4242 --json sockets.json
+"""
+from benchmarks.bench_ai import percentile
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+KINDS = ('dm', 'group', 'typing', 'call', 'reconnect')
+DEFAULT_MIX = 'dm=55,group=15,typing=20,call=5,reconnect=5'
+MARKER = 'load:'
+
+def parse_mix(value):
+    """'dm=60,group=40' -> {'dm': 60.0, 'group': 40.0}"""
+    mix = {}
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown traffic kind '{kind}' (choose from {', '.join(KINDS)})")
+        mix[kind] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('the traffic mix needs at least one positive weight')
+    return mix
+
+def rss_bytes(pid):
+    """Resident memory of a local process from /proc, None if unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def plan_clients(app, count, group_count):
+    """Pick the accounts to connect and sign a session cookie for each
+
+    Members of the largest groups come first so group messages fan out to
+    many connected clients.
+    """
+    from app import db
+    from app.models import User, group_members
+    from sqlalchemy import func
+
+    with app.app_context():
+        groups = db.session.query(group_members.c.group_id, func.count().label('size')).group_by(
+            group_members.c.group_id).order_by(db.desc('size')).limit(group_count).all()
+        group_ids = [group.group_id for group in groups]
+
+        chosen = {}
+        for group_id in group_ids:
+            rows = db.session.query(group_members.c.user_id).filter(group_members.c.group_id == group_id).all()
+            for row in rows:
+                if len(chosen) >= count:
+                    break
+                chosen.setdefault(row.user_id, [])
+        if len(chosen) < count:
+            for row in db.session.query(User.id).order_by(User.id).limit(count * 2).all():
+                if len(chosen) >= count:
+                    break
+                chosen.setdefault(row.id, [])
+
+        if group_ids:
+            memberships = db.session.query(group_members.c.user_id, group_members.c.group_id).filter(
+                group_members.c.group_id.in_(group_ids)).all()
+            for user_id, group_id in memberships:
+                if user_id in chosen:
+                    chosen[user_id].append(group_id)
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        return [{'user_id': user_id, 'groups': groups_of_user,
+                 'cookie': serializer.dumps({'_user_id': str(user_id), '_fresh': True})}
+                for user_id, groups_of_user in chosen.items()]
+
+def stamp():
+    return f"{MARKER}{time.time():.6f}"
+
+def age_ms(value):
+    """Milliseconds since the stamp in value, None for foreign traffic"""
+    if isinstance(value, str) and value.startswith(MARKER):
+        return (time.time() - float(value[len(MARKER):])) * 1000
+    return None
+
+class Stats:
+    """Counters and latency samples of one worker process"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}
+        self.sent = {}
+        self.expected = {}
+        self.received = {}
+        self.errors = 0
+
+    def add(self, table, key, amount=1):
+        table[key] = table.get(key, 0) + amount
+
+    def latency(self, kind, value):
+        if value is not None:
+            self.latencies.setdefault(kind, []).append(value)
+
+class LoadClient:
+    """One simulated user holding a Socket.IO connection"""
+
+    def __init__(self, account, url, cookie_name, stats):
+        self.user_id = account['user_id']
+        self.groups = account['groups']
+        self.url = url
+        self.headers = {'Cookie': f"{cookie_name}={account['cookie']}"}
+        self.stats = stats
+        self.busy = False
+        self.sio = None
+
+    async def connect(self):
+        import socketio
+
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('*', self.on_event)
+        self.sio.on('new_message', self.on_message)
+        self.sio.on('user_typing', self.on_typing)
+        self.sio.on('incoming_call', self.on_call)
+        self.sio.on('call_answered', self.on_answer)
+        # The engine.io client removes the Cookie header from the dict it is given
+        await self.sio.connect(self.url, headers=dict(self.headers), transports=['websocket'], wait_timeout=30)
+        await self.sio.emit('join_chat', {'room': f"user_{self.user_id}"})
+        for group_id in self.groups:
+            await self.sio.emit('join_chat', {'room': f"group_{group_id}"})
+
+    async def disconnect(self):
+        if self.sio and self.sio.connected:
+            await self.sio.disconnect()
+
+    async def on_event(self, event, *args):
+        self.stats.add(self.stats.received, event)
+
+    async def on_message(self, data):
+        self.stats.add(self.stats.received, 'new_message')
+        if data.get('sender_id') != self.user_id:
+            self.stats.latency('group' if data.get('group_id') else 'dm', age_ms(data.get('content')))
+
+    async def on_typing(self, data):
+        self.stats.add(self.stats.received, 'user_typing')
+        if data.get('user_id') != self.user_id:
+            self.stats.add(self.stats.received, 'typing_delivered')
+
+    async def on_call(self, data):
+        self.stats.add(self.stats.received, 'incoming_call')
+        offer = data.get('offer') or {}
+        self.stats.latency('call', age_ms(offer.get('sdp')))
+        if offer.get('sdp', '').startswith(MARKER) and self.sio.connected:
+            await self.sio.emit('call_answer', {'caller_id': data.get('caller_id'), 'room_id': data.get('room_id'),
+                                                'answer': {'type': 'answer', 'sdp': stamp()}})
+
+    async def on_answer(self, data):
+        self.stats.add(self.stats.received, 'call_answered')
+        self.stats.latency('call_answer', age_ms((data.get('answer') or {}).get('sdp')))
+
+async def run_op(kind, client, peers, group_sizes, stats, rng):
+    """Send one unit of traffic of the given kind from client"""
+    client.busy = True
+    try:
+        peer = rng.choice(peers)
+        while peer == client.user_id and len(peers) > 1:
+            peer = rng.choice(peers)
+        sio = client.sio
+
+        if kind == 'group':
+            groups = [group_id for group_id in client.groups if group_sizes.get(group_id, 0) > 1]
+            if groups:
+                group_id = rng.choice(groups)
+                await sio.emit('send_message', {'group_id': group_id, 'content': stamp(), 'message_type': 'text'})
+                stats.add(stats.sent, 'group')
+                stats.add(stats.expected, 'group', group_sizes[group_id] - 1)
+                return
+            kind = 'dm'
+
+        if kind == 'dm':
+            await sio.emit('send_message', {'recipient_id': peer, 'content': stamp(), 'message_type': 'text'})
+        elif kind == 'typing':
+            await sio.emit('typing', {'recipient_id': peer, 'is_typing': True})
+        elif kind == 'call':
+            await sio.emit('call_initiate', {'recipient_id': peer, 'call_type': 'voice',
+                                             'room_id': f"load-{client.user_id}-{rng.random():.9f}",
+                                             'offer': {'type': 'offer', 'sdp': stamp()}})
+        elif kind == 'reconnect':
+            started = time.perf_counter()
+            await client.disconnect()
+            await client.connect()
+            stats.latency('reconnect', (time.perf_counter() - started) * 1000)
+        stats.add(stats.sent, kind)
+        stats.add(stats.expected, kind, 1)
+    except Exception:
+        stats.errors += 1
+    finally:
+        client.busy = False
+
+async def worker_main(index, accounts, options, peers, group_sizes, ready, start, results):
+    stats = Stats()
+    rng = random.Random(options['seed'] + index)
+    clients = [LoadClient(account, options['url'], options['cookie_name'], stats) for account in accounts]
+    connect_ms = []
+    limit = asyncio.Semaphore(options['connect_concurrency'])
+
+    async def connect(client):
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await client.connect()
+                connect_ms.append((time.perf_counter() - started) * 1000)
+            except Exception:
+                stats.errors += 1
+
+    await asyncio.gather(*(connect(client) for client in clients))
+    connected = [client for client in clients if client.sio and client.sio.connected]
+    ready.put((index, len(connected)))
+    await asyncio.get_running_loop().run_in_executor(None, start.wait)
+
+    # Traffic from here on; connect-storm broadcasts are not counted
+    stats.reset()
+    kinds = list(options['mix'])
+    weights = [options['mix'][kind] for kind in kinds]
+    interval = 1 / options['rate'] if options['rate'] > 0 else 0
+    tasks = set()
+    started = time.perf_counter()
+    next_at = started
+    while connected and time.perf_counter() - started < options['duration']:
+        client = rng.choice(connected)
+        if not client.busy and client.sio.connected:
+            task = asyncio.create_task(run_op(rng.choices(kinds, weights)[0], client, peers, group_sizes, stats, rng))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        next_at += interval
+        await asyncio.sleep(max(0, next_at - time.perf_counter()))
+    if tasks:
+        await asyncio.wait(tasks, timeout=options['drain'])
+    await asyncio.sleep(options['drain'])
+    elapsed = time.perf_counter() - started
+
+    results.put({'worker': index, 'connected': len(connected), 'connect_ms': connect_ms, 'elapsed': elapsed,
+                 'latencies': stats.latencies, 'sent': stats.sent, 'expected': stats.expected,
+                 'received': stats.received, 'errors': stats.errors})
+    for client in clients:
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
+
+def worker(*args):
+    asyncio.run(worker_main(*args))
+
+def serve(host, port):
+    """Run the app with the Socket.IO server, as run.py does without debug"""
+    from app import create_app, socketio
+    app = create_app()
+    socketio.run(app, host=host, port=port, allow_unsafe_werkzeug=True, log_output=False)
+
+def start_server(port):
+    env = dict(os.environ)
+    # No Groq traffic from the send path while measuring socket fanout
+    env.setdefault('SMART_REPLIES_PRECOMPUTE', 'false')
+    env.setdefault('TRANSCRIBE_ON_SEND', 'false')
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.socket_load', '--serve', '--port', str(port)],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('The server exited during startup')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit('The server did not start within 60s')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def summarize(outputs, duration):
+    """Merge worker outputs into one report"""
+    latencies, sent, expected, received = {}, {}, {}, {}
+    connect_ms, errors = [], 0
+    for output in outputs:
+        connect_ms += output['connect_ms']
+        errors += output['errors']
+        for kind, values in output['latencies'].items():
+            latencies.setdefault(kind, []).extend(values)
+        for table, values in ((sent, output['sent']), (expected, output['expected']), (received, output['received'])):
+            for key, count in values.items():
+                table[key] = table.get(key, 0) + count
+
+    # Deliveries a kind is measured by
+    delivered = {kind: len(latencies.get(kind, [])) for kind in ('dm', 'group', 'call', 'reconnect')}
+    delivered['typing'] = received.get('typing_delivered', 0)
+
+    kinds = {}
+    for kind in list(KINDS) + ['call_answer']:
+        values = latencies.get(kind, [])
+        if not values and not sent.get(kind):
+            continue
+        kinds[kind] = {
+            'sent': sent.get(kind, 0),
+            'expected': expected.get(kind),
+            'delivered': delivered.get(kind, len(values)),
+            'delivery_pct': round(delivered.get(kind, 0) / expected[kind] * 100, 1) if expected.get(kind) else None,
+            'p50_ms': round(percentile(values, 50), 1) if values else None,
+            'p90_ms': round(percentile(values, 90), 1) if values else None,
+            'p99_ms': round(percentile(values, 99), 1) if values else None,
+            'max_ms': round(max(values), 1) if values else None
+        }
+    total_events = sum(count for event, count in received.items() if event != 'typing_delivered')
+    return {
+        'connected': sum(output['connected'] for output in outputs),
+        'connect_p50_ms': round(percentile(connect_ms, 50), 1) if connect_ms else None,
+        'connect_p99_ms': round(percentile(connect_ms, 99), 1) if connect_ms else None,
+        'errors': errors,
+        'sent_per_sec': round(sum(sent.values()) / duration, 1),
+        'received_per_sec': round(total_events / duration, 1),
+        'received_events': {event: count for event, count in sorted(received.items()) if event != 'typing_delivered'},
+        'kinds': kinds
+    }
+
+def print_report(report, memory):
+    print(f"Connected clients: {report['connected']} (connect p50 {report['connect_p50_ms']} ms, "
+          f"p99 {report['connect_p99_ms']} ms), errors {report['errors']}")
+    print(f"Throughput: {report['sent_per_sec']} sent/s, {report['received_per_sec']} events received/s")
+    if memory:
+        print(f"Server memory: {memory['idle_mb']} MB idle, {memory['connected_mb']} MB connected, "
+              f"{memory['per_connection_kb']} KB per connection, {memory['after_mb']} MB after traffic")
+    print()
+    headers = ['kind', 'sent', 'expected', 'delivered', 'delivery %', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms']
+    columns = ['sent', 'expected', 'delivered', 'delivery_pct', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']
+    rows = [[kind] + [str(r[c]) if r[c] is not None else '-' for c in columns] for kind, r in report['kinds'].items()]
+    widths = [max(len(h), *(len(row[i]) for row in rows)) for i, h in enumerate(headers)] if rows else [len(h) for h in headers]
+    print('  '.join(h.ljust(w) for h, w in zip(headers, widths)))
+    print('  '.join('-' * w for w in widths))
+    for row in rows:
+        print('  '.join(value.ljust(w) for value, w in zip(row, widths)))
+    print("\n(reconnect latency is the time to reconnect and rejoin rooms)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Socket.IO handlers')
+    parser.add_argument('--url', help='server to test (default: start one on DATABASE_URL)')
+    parser.add_argument('--server-pid', type=int, help='pid of a local --url server, to report its memory')
+    parser.add_argument('--clients', type=int, default=200, help='connected clients (default 200)')
+    parser.add_argument('--processes', type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help='client processes (default up to 4)')
+    parser.add_argument('--groups', type=int, default=3, help='largest groups whose members connect first (default 3)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"traffic weights (default {DEFAULT_MIX})")
+    parser.add_argument('--rate', type=float, default=200, help='operations per second over all clients (default 200)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of traffic (default 20)')
+    parser.add_argument('--drain', type=float, default=3, help='seconds to wait for late deliveries (default 3)')
+    parser.add_argument('--connect-concurrency', type=int, default=50, help='parallel connects per process (default 50)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve('127.0.0.1', args.port)
+        return
+
+    try:
+        import aiohttp  # noqa: F401
+    except ImportError:
+        raise SystemExit('The load harness requires aiohttp (pip install aiohttp)')
+
+    from app import create_app
+    app = create_app()
+    accounts = plan_clients(app, args.clients, args.groups)
+    if len(accounts) < 2:
+        raise SystemExit('Need at least 2 users, run python -m benchmarks.generate_data first')
+
+    server = None
+    url, server_pid = args.url, args.server_pid
+    if not url:
+        port = free_port()
+        server = start_server(port)
+        url, server_pid = f"http://127.0.0.1:{port}", server.pid
+
+    group_sizes = {}
+    for account in accounts:
+        for group_id in account['groups']:
+            group_sizes[group_id] = group_sizes.get(group_id, 0) + 1
+    peers = [account['user_id'] for account in accounts]
+    processes = max(1, min(args.processes, len(accounts)))
+    options = {'url': url, 'cookie_name': app.config['SESSION_COOKIE_NAME'], 'mix': args.mix,
+               'rate': args.rate / processes, 'duration': args.duration, 'drain': args.drain,
+               'connect_concurrency': args.connect_concurrency, 'seed': args.seed}
+
+    print(f"ChatSphere Socket.IO load: {len(accounts)} clients in {processes} processes, "
+          f"{args.rate:g} ops/s for {args.duration:g}s")
+    print(f"Server: {url}" + (" (started here)" if server else ""))
+    print(f"Mix: {', '.join(f'{kind}={weight:g}' for kind, weight in args.mix.items())}; "
+          f"largest connected group {max(group_sizes.values(), default=0)} members")
+    print("-" * 50)
+
+    context = multiprocessing.get_context('spawn')
+    ready, results, start = context.Queue(), context.Queue(), context.Event()
+    idle_rss = rss_bytes(server_pid) if server_pid else None
+    workers = [context.Process(target=worker, args=(i, accounts[i::processes], options, peers, group_sizes,
+                                                    ready, start, results), daemon=True)
+               for i in range(processes)]
+    for process in workers:
+        process.start()
+
+    try:
+        connected = sum(ready.get(timeout=600)[1] for _ in workers)
+        # Let the connect-storm broadcasts settle before measuring memory
+        time.sleep(2)
+        connected_rss = rss_bytes(server_pid) if server_pid else None
+        print(f"  {connected} clients connected, sending traffic...", file=sys.stderr)
+        start.set()
+        outputs = [results.get(timeout=args.duration + args.drain * 2 + 600) for _ in workers]
+        after_rss = rss_bytes(server_pid) if server_pid else None
+    finally:
+        for process in workers:
+            process.join(timeout=30)
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+
+    report = summarize(outputs, args.duration)
+    memory = None
+    if idle_rss and connected_rss and connected:
+        memory = {
+            'idle_mb': round(idle_rss / 1048576, 1),
+            'connected_mb': round(connected_rss / 1048576, 1),
+            'after_mb': round(after_rss / 1048576, 1) if after_rss else None,
+            'per_connection_kb': round((connected_rss - idle_rss) / connected / 1024, 1)
+        }
+
+    print()
+    print_report(report, memory)
+    if args.json:
+        settings = dict(vars(args))
+        with open(args.json, 'w') as f:
+            json.dump({'settings': settings, 'memory': memory, 'results': report}, f, indent=2)
+        print(f"\n✓ Results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Garbage-collect unreferenced media blobs
+Run periodically (e.g. from cron) to reconcile reference counts and delete
+stored media no longer used by any message, status or recent upload, and
+to delete resumable uploads left unfinished for UPLOAD_SESSION_TTL seconds
+"""
+from app import create_app
+from app.media_store import collect_garbage
+from datetime import timedelta
+import sys
+
+def gc_media(grace_hours=24):
+    app = create_app()
+    with app.app_context():
+        deleted = collect_garbage(timedelta(hours=grace_hours))
+        print(f"✓ Deleted {deleted} unreferenced blob(s)")
+    return deleted
+
+if __name__ == '__main__':
+    grace_hours = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    print(f"Collecting media unreferenced for more than {grace_hours} hours...")
+    print("-" * 50)
+    gc_media(grace_hours)
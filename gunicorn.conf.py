@@ -0,0 +1,41 @@
+"""
+Gunicorn settings for ChatSphere
+
+    gunicorn run:app
+
+The app is loaded once in the master before workers are forked
+(PRELOAD_APP=true): imports, route registration, schema and upload folder
+setup run a single time and workers start serving immediately, sharing the
+loaded code copy-on-write. With PRELOAD_APP=false each worker loads the app
+with FAST_START, skipping the setup.
+
+Socket.IO runs in threading mode, so each worker serves its sockets from
+GUNICORN_THREADS threads. More than one worker needs sticky sessions at the
+load balancer and a Socket.IO message queue.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 100))
+preload_app = os.getenv('PRELOAD_APP', 'true').lower() == 'true'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+
+def on_starting(server):
+    # Runs after a preloaded app is loaded. Without preloading every worker
+    # loads the app, so leave setup to `flask --app run init-db`
+    if not preload_app:
+        os.environ.setdefault('FAST_START', 'true')
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    # Connections opened by the master must not be shared with the workers
+    from app import db, watchdog
+    app = worker.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Threads do not survive the fork. Restarted here rather than with
+    # os.register_at_fork, which would also run in process pool children
+    watchdog.restart_after_fork()
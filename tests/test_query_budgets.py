@@ -0,0 +1,104 @@
+"""
+Query Budget Tests for ChatSphere
+Runs every endpoint declared with @budget against a small dataset (direct
+and group messages with replies and reactions, statuses with views) and
+fails if one runs more SQL statements than its budget, e.g. after a change
+brings back an N+1 query in a view or template.
+
+    python -m pytest tests/test_query_budgets.py
+"""
+from datetime import datetime, timedelta
+import pytest
+
+from app import create_app, db
+from app.models import User, Message, MessageReaction, Group, Status, StatusView
+from app.query_debug import assert_query_budget
+
+PASSWORD = 'budget-test'
+CONTACTS = 5
+MESSAGES_PER_CHAT = 6
+
+BUDGETED = [
+    ('GET', '/'),
+    ('GET', '/chat/user/{contact_id}'),
+    ('GET', '/chat/group/{group_id}'),
+    ('GET', '/chat/messages/user/{contact_id}'),
+    ('GET', '/chat/messages/group/{group_id}'),
+    ('GET', '/status/'),
+    ('GET', '/status/user/{contact_id}'),
+]
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv('UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setenv('AI_CACHE_PATH', '')
+    monkeypatch.setenv('PASSWORD_HASH_WORKERS', '0')
+    monkeypatch.setenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        seed()
+    return app
+
+def seed():
+    """One user with a few contacts, a group of all of them and their statuses"""
+    users = []
+    for i in range(CONTACTS + 1):
+        user = User(username=f'user{i}', email=f'user{i}@example.com', phone=f'555000{i}')
+        user.set_password(PASSWORD)
+        users.append(user)
+    db.session.add_all(users)
+    db.session.flush()
+    me, contacts = users[0], users[1:]
+
+    group = Group(name='Everyone', owner_id=me.id)
+    group.members.extend(users)
+    db.session.add(group)
+    db.session.flush()
+
+    now = datetime.utcnow()
+    for contact in contacts:
+        previous = None
+        for n in range(MESSAGES_PER_CHAT):
+            sender, recipient = (me, contact) if n % 2 else (contact, me)
+            message = Message(sender_id=sender.id, recipient_id=recipient.id, content=f'direct {n}',
+                              timestamp=now - timedelta(minutes=MESSAGES_PER_CHAT - n),
+                              reply_to_id=previous.id if previous else None)
+            db.session.add(message)
+            db.session.flush()
+            db.session.add(MessageReaction(message_id=message.id, user_id=recipient.id, emoji='👍'))
+            previous = message
+        db.session.add(Message(sender_id=contact.id, group_id=group.id, content=f'hello from {contact.username}',
+                               timestamp=now - timedelta(seconds=contact.id)))
+
+    for user in users:
+        for media_type in ('text', 'image'):
+            status = Status(user_id=user.id, content=f'{media_type} status', media_type=media_type,
+                            media_url='/static/uploads/media/status.jpg' if media_type == 'image' else None,
+                            expires_at=now + timedelta(hours=24))
+            db.session.add(status)
+            db.session.flush()
+            db.session.add_all(StatusView(status_id=status.id, user_id=viewer.id)
+                               for viewer in users if viewer is not user)
+    db.session.commit()
+    return me, contacts, group
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    response = client.post('/auth/login', data={'username': 'user0', 'password': PASSWORD})
+    assert response.status_code == 302
+    return client
+
+@pytest.mark.parametrize('method, path', BUDGETED)
+def test_endpoint_stays_within_budget(client, method, path):
+    path = path.format(contact_id=2, group_id=1)
+    response = assert_query_budget(client, method, path)
+    assert response.status_code == 200
+
+def test_every_budgeted_endpoint_is_covered(app):
+    adapter = app.url_map.bind('localhost')
+    covered = {adapter.match(path.format(contact_id=2, group_id=1), method=method)[0] for method, path in BUDGETED}
+    budgeted = {endpoint for endpoint, view in app.view_functions.items() if hasattr(view, 'query_budget')}
+    assert budgeted <= covered